@@ -1,24 +1,44 @@
 """
 P4-AI-Reviewer — AI 审查模块
 构建 Prompt 并调用 LLM 进行代码审查。
+httpx / 端点池 / 符号索引在首次发起审查时才导入：报告、结果库等模块只需要 ReviewResult，
+无需审查的调用（空 Diff、参数错误）不承担这些导入开销。
 """
+import hashlib
 import logging
+import re
+import threading
 import time
-from dataclasses import dataclass
-
-import httpx
+from collections import OrderedDict
+from dataclasses import dataclass, field, replace
 
 from config import (
-    AI_API_BASE_URL,
-    AI_API_KEY,
     AI_MODEL,
     AI_MAX_TOKENS,
+    AI_MIN_TOKENS,
+    AI_ADAPTIVE_TOKENS,
     AI_TEMPERATURE,
     AI_SEED,
+    AI_STRUCTURED_OUTPUT,
+    AI_TRIAGE_MODEL,
+    AI_TRIAGE_BASE_URL,
+    AI_TRIAGE_API_KEY,
+    AI_TRIAGE_MAX_CHARS,
+    AI_CONCURRENCY,
+    AI_REQUEST_TIMEOUT,
     FILE_CONTENT_MAX_CHARS,
     REQUEST_MAX_CHARS,
     SYSTEM_PROMPT,
 )
+from deadline import RunCancelled, current_token, describe_reason
+from findings import (
+    STRUCTURED_OUTPUT_INSTRUCTION,
+    Finding,
+    detect_verdict,
+    parse_findings,
+    parse_structured,
+    render_markdown,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -29,15 +49,104 @@ class ReviewResult:
     depot_path: str
     review_comment: str   # AI 返回的 Markdown 格式审查意见
     error: str = ""       # 如果调用失败，记录错误信息
+    model: str = ""       # 实际使用的模型
+    elapsed: float = 0.0  # 请求耗时（秒），命中缓存时为 0
+    findings: list[Finding] = field(default_factory=list)  # 解析出的逐条问题
+    verdict: str = ""     # clean / issues / unknown，见 findings.VERDICT_*
+    duplicate_of: str = ""            # 重复变更：复用的代表文件 depot 路径
+    duplicate_similarity: float = 0.0  # 与代表文件的相似度（完全相同为 1.0）
+    route: str = ""               # 分级路由结果: "triage"（分诊判定低风险）/ "deep"（深度审查）；未启用分诊为空
+    triage_elapsed: float = 0.0   # 分诊请求耗时（秒）
+    unfinished: bool = False      # 运行截止时间到期或被中断时未完成（原因见 error）
+    truncated: bool = False       # 回答达到 max_tokens 被截断（重试后仍截断），审查意见可能不完整
+
+
+# 可选的审查结果缓存：key 为 (端点池中的模型集合, Prompt) 摘要。默认关闭，服务模式下开启
+_result_cache: "OrderedDict[str, ReviewResult]" = OrderedDict()
+_result_cache_max = 0
+_result_cache_lock = threading.Lock()
+
+
+def enable_result_cache(max_entries: int):
+    """
+    开启进程内 LRU 审查结果缓存。相同模型 + 相同 Prompt 的文件直接复用结果，
+    适用于服务模式下同一文件变更在多个任务中重复出现的情况。max_entries <= 0 表示关闭。
+    """
+    global _result_cache_max
+    with _result_cache_lock:
+        _result_cache_max = max(0, max_entries)
+        _result_cache.clear()
+
+
+def _cache_key(models: list[str], user_prompt: str) -> str:
+    """models 为可能应答请求的全部模型（AI_ENDPOINTS 各端点可配置不同模型）。"""
+    h = hashlib.sha256()
+    h.update(",".join(sorted(set(models))).encode("utf-8"))
+    h.update(b"\0")
+    h.update(user_prompt.encode("utf-8"))
+    return h.hexdigest()
+
+
+def _cache_get(key: str) -> ReviewResult | None:
+    if _result_cache_max <= 0:
+        return None
+    with _result_cache_lock:
+        cached = _result_cache.get(key)
+        if cached is not None:
+            _result_cache.move_to_end(key)
+        return cached
+
+
+def _cache_put(key: str, result: ReviewResult):
+    if _result_cache_max <= 0 or result.error or result.truncated:
+        return
+    with _result_cache_lock:
+        _result_cache[key] = result
+        _result_cache.move_to_end(key)
+        while len(_result_cache) > _result_cache_max:
+            _result_cache.popitem(last=False)
+
+
+def _post_chat(base_url: str, api_key: str, payload: dict) -> dict:
+    """
+    向 OpenAI 兼容接口发送 Chat Completions 请求，返回解析后的 JSON；HTTP 错误时抛出异常。
+    运行被取消（截止时间 / Ctrl-C）时中止请求并抛出 RunCancelled。
+    """
+    from concurrent.futures import CancelledError
+
+    from http_client import submit_post
+
+    url = f"{base_url.rstrip('/')}/chat/completions"
+    headers = {
+        "Content-Type": "application/json",
+    }
+    if api_key:
+        headers["Authorization"] = f"Bearer {api_key}"
+    token = current_token()
+    future = submit_post(url, payload, headers, token.timeout(AI_REQUEST_TIMEOUT))
+    unregister = token.register(future.cancel)
+    try:
+        return future.result()
+    except CancelledError:
+        token.check()
+        raise
+    finally:
+        unregister()
 
 
-def _build_user_prompt(depot_path: str, diff_text: str, full_content: str | None) -> str:
+def _build_user_prompt(
+    depot_path: str,
+    diff_text: str,
+    full_content: str | None,
+    related: str = "",
+) -> str:
     """
     构建单个文件的 User Prompt。
-    使用 XML 标签封装 Diff 和全量文件内容；总长超过 REQUEST_MAX_CHARS 时截断或仅发 diff。
+    使用 XML 标签封装 Diff、跨文件声明（符号索引）和全量文件内容；总长超过 REQUEST_MAX_CHARS 时截断或仅发 diff。
     """
     truncated_notice = ""
-    diff_len = len(diff_text or "")
+    # 跨文件声明计入 Diff 一侧的长度，优先于全量内容保留
+    diff_len = len(diff_text or "") + len(related)
     # 1) 先按单文件上限截断全量内容
     if full_content and len(full_content) > FILE_CONTENT_MAX_CHARS:
         full_content = full_content[:FILE_CONTENT_MAX_CHARS]
@@ -56,8 +165,10 @@ def _build_user_prompt(depot_path: str, diff_text: str, full_content: str | None
             full_content = None
             truncated_notice = ""
             # 下面会写入“仅基于 Diff”的说明
-    # Diff 过长时仅截断 diff 尾部并提示（少见）
+    # Diff 过长时放弃跨文件声明，并截断 diff 尾部提示（少见）
     if diff_len > REQUEST_MAX_CHARS - 1000:
+        related = ""
+    if len(diff_text or "") > REQUEST_MAX_CHARS - 1000:
         diff_text = (diff_text or "")[: REQUEST_MAX_CHARS - 1000]
         diff_text += "\n\n... (Diff 过长，已截断，请基于以上部分审查)"
 
@@ -69,6 +180,12 @@ def _build_user_prompt(depot_path: str, diff_text: str, full_content: str | None
     parts.append(diff_text if diff_text else "(无差异内容)")
     parts.append("</diff>\n")
 
+    if related:
+        parts.append("<related_declarations>")
+        parts.append("<!-- Diff 中涉及的标识符在其他文件中的声明（来自符号索引，可能不完整） -->")
+        parts.append(related)
+        parts.append("</related_declarations>\n")
+
     if full_content is not None:
         parts.append("<full_file_content>")
         parts.append(full_content)
@@ -82,6 +199,54 @@ def _build_user_prompt(depot_path: str, diff_text: str, full_content: str | None
     return "\n".join(parts)
 
 
+def _parse_review(content: str) -> tuple[str, list[Finding], str]:
+    """
+    解析模型返回，得到 (用于报告的 Markdown, 问题列表, 结论)。
+    JSON 模式下优先按 JSON 解析并渲染为 Markdown，解析失败时回退为文本解析。
+    """
+    if AI_STRUCTURED_OUTPUT:
+        parsed = parse_structured(content)
+        if parsed is not None:
+            verdict, findings = parsed
+            return render_markdown(verdict, findings), findings, verdict
+        logger.warning("结构化输出解析失败，按 Markdown 文本解析")
+    findings = parse_findings(content)
+    return content, findings, detect_verdict(content, findings)
+
+
+# 输出 token 估算：基础量（总结、结构化 JSON 框架）+ 每个变更行 / hunk / 分支循环等控制流行的增量
+_TOKENS_BASE = 600
+_TOKENS_PER_CHANGED_LINE = 24
+_TOKENS_PER_HUNK = 120
+_TOKENS_PER_BRANCH = 40
+_BRANCH_RE = re.compile(r"\b(?:if|else|for|while|switch|case|catch|goto|return|delete|new|malloc|free|lock|unlock)\b")
+
+
+def estimate_max_tokens(diff_text: str) -> int:
+    """
+    按 Diff 规模与复杂度估算本次审查需要的输出 token，限制在 [AI_MIN_TOKENS, AI_MAX_TOKENS]。
+    AI_ADAPTIVE_TOKENS 关闭时直接返回 AI_MAX_TOKENS。
+    """
+    if not AI_ADAPTIVE_TOKENS:
+        return AI_MAX_TOKENS
+    changed = hunks = branches = 0
+    for line in (diff_text or "").splitlines():
+        if line.startswith("@@"):
+            hunks += 1
+        elif line[:1] in ("+", "-") and not line.startswith(("+++", "---")):
+            changed += 1
+            if _BRANCH_RE.search(line):
+                branches += 1
+    estimate = (_TOKENS_BASE + changed * _TOKENS_PER_CHANGED_LINE
+                + hunks * _TOKENS_PER_HUNK + branches * _TOKENS_PER_BRANCH)
+    return max(min(AI_MIN_TOKENS, AI_MAX_TOKENS), min(AI_MAX_TOKENS, estimate))
+
+
+def _finish_reason(data: dict) -> str:
+    choices = data.get("choices") or []
+    return (choices[0].get("finish_reason") or "") if choices else ""
+
+
 def review_file(
     depot_path: str,
     diff_text: str,
@@ -89,40 +254,67 @@ def review_file(
 ) -> ReviewResult:
     """
     对单个文件发起 AI 审查请求。
-    使用 OpenAI 兼容的 Chat Completions API。
+    使用 OpenAI 兼容的 Chat Completions API。max_tokens 按 Diff 估算，回答因长度被截断时
+    以 AI_MAX_TOKENS 重试一次，仍截断则在结果中标记 truncated。
     """
-    user_prompt = _build_user_prompt(depot_path, diff_text, full_content)
+    import httpx
+    from endpoint_pool import chat_completion, get_default_pool
+    from symbol_index import related_declarations
+
+    related = related_declarations(depot_path, diff_text)
+    user_prompt = _build_user_prompt(depot_path, diff_text, full_content, related)
+
+    cache_key = _cache_key([ep.model for ep in get_default_pool().endpoints], user_prompt)
+    cached = _cache_get(cache_key)
+    if cached is not None:
+        logger.info("文件 %s 命中审查缓存，跳过请求", depot_path)
+        return replace(cached, depot_path=depot_path, elapsed=0.0)
 
+    system_prompt = SYSTEM_PROMPT
+    if AI_STRUCTURED_OUTPUT:
+        system_prompt += STRUCTURED_OUTPUT_INSTRUCTION
     messages = [
-        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "system", "content": system_prompt},
         {"role": "user", "content": user_prompt},
     ]
 
+    # model 由端点池按所选端点填入
+    max_tokens = estimate_max_tokens(diff_text)
     payload = {
-        "model": AI_MODEL,
         "messages": messages,
-        "max_tokens": AI_MAX_TOKENS,
+        "max_tokens": max_tokens,
         "temperature": AI_TEMPERATURE,
     }
     if AI_SEED and str(AI_SEED).strip().isdigit():
         payload["seed"] = int(AI_SEED)
+    if AI_STRUCTURED_OUTPUT:
+        payload["response_format"] = {"type": "json_object"}
 
-    url = f"{AI_API_BASE_URL.rstrip('/')}/chat/completions"
-
-    headers = {
-        "Content-Type": "application/json",
-    }
-    if AI_API_KEY:
-        headers["Authorization"] = f"Bearer {AI_API_KEY}"
-
-    logger.info("正在审查文件: %s (prompt 长度: %d 字符)", depot_path, len(user_prompt))
+    logger.info("正在审查文件: %s (prompt 长度: %d 字符, max_tokens: %d)",
+                depot_path, len(user_prompt), max_tokens)
     start_time = time.time()
+    model = AI_MODEL
 
     try:
-        with httpx.Client(timeout=180.0) as client:
-            response = client.post(url, json=payload, headers=headers)
-            response.raise_for_status()
-            data = response.json()
+        data, endpoint = chat_completion(get_default_pool(), payload, timeout=AI_REQUEST_TIMEOUT)
+        model = endpoint.model
+        truncated = _finish_reason(data) == "length"
+        if truncated and max_tokens < AI_MAX_TOKENS:
+            logger.info("文件 %s 的回答达到 max_tokens=%d 被截断，以 %d 重试",
+                        depot_path, max_tokens, AI_MAX_TOKENS)
+            try:
+                data, endpoint = chat_completion(get_default_pool(), {**payload, "max_tokens": AI_MAX_TOKENS},
+                                                 timeout=AI_REQUEST_TIMEOUT)
+                model = endpoint.model
+                truncated = _finish_reason(data) == "length"
+            except RunCancelled:
+                raise
+            except Exception as e:
+                # 重试失败时保留第一次（已截断）的回答，好过整个文件记为失败
+                logger.warning("文件 %s 以 max_tokens=%d 重试失败，保留截断的回答: %s: %s",
+                               depot_path, AI_MAX_TOKENS, type(e).__name__, e)
+        if truncated:
+            logger.warning("文件 %s 的回答被截断，审查意见可能不完整", depot_path)
 
         elapsed = time.time() - start_time
         logger.info("文件 %s 审查完成, 耗时 %.1fs", depot_path, elapsed)
@@ -131,14 +323,30 @@ def review_file(
         choices = data.get("choices", [])
         if choices:
             content = choices[0].get("message", {}).get("content", "")
-            return ReviewResult(depot_path=depot_path, review_comment=content)
+            comment, findings, verdict = _parse_review(content)
+            result = ReviewResult(
+                depot_path=depot_path,
+                review_comment=comment,
+                model=data.get("model") or model,
+                elapsed=elapsed,
+                findings=findings,
+                verdict=verdict,
+                truncated=truncated,
+            )
+            _cache_put(cache_key, result)
+            return result
         else:
             return ReviewResult(
                 depot_path=depot_path,
                 review_comment="",
                 error="API 返回了空的 choices",
+                model=model,
+                elapsed=elapsed,
             )
 
+    except RunCancelled:
+        raise
+
     except httpx.HTTPStatusError as e:
         error_body = ""
         try:
@@ -147,12 +355,112 @@ def review_file(
             pass
         error_msg = f"HTTP {e.response.status_code}: {error_body}"
         logger.error("审查文件 %s 失败: %s", depot_path, error_msg)
-        return ReviewResult(depot_path=depot_path, review_comment="", error=error_msg)
+        return ReviewResult(depot_path=depot_path, review_comment="", error=error_msg,
+                            model=model, elapsed=time.time() - start_time)
 
     except Exception as e:
         error_msg = f"{type(e).__name__}: {e}"
         logger.error("审查文件 %s 失败: %s", depot_path, error_msg)
-        return ReviewResult(depot_path=depot_path, review_comment="", error=error_msg)
+        return ReviewResult(depot_path=depot_path, review_comment="", error=error_msg,
+                            model=model, elapsed=time.time() - start_time)
+
+
+# ============================================================
+# 分级路由：廉价模型分诊，仅高风险文件进入深度审查
+# ============================================================
+
+TRIAGE_SYSTEM_PROMPT = """\
+你是代码变更分诊器。判断以下 Diff 是否可能引入逻辑、内存、线程安全或边界问题。
+仅修改注释、空行/格式、日志文本、版本号/时间戳、UI 坐标等数值，且无逻辑变化时回答 TRIVIAL；
+其余情况（包括无法确定）回答 RISKY。只输出一个单词：TRIVIAL 或 RISKY。
+"""
+
+TRIAGE_TRIVIAL = "trivial"
+TRIAGE_RISKY = "risky"
+
+
+def triage_file(depot_path: str, diff_text: str) -> tuple[str, float]:
+    """
+    用分诊模型判断变更风险，返回 (TRIAGE_TRIVIAL / TRIAGE_RISKY, 耗时秒)。
+    Diff 超过 AI_TRIAGE_MAX_CHARS、请求失败或回答无法识别时一律视为 risky。
+    """
+    if len(diff_text or "") > AI_TRIAGE_MAX_CHARS:
+        return TRIAGE_RISKY, 0.0
+
+    payload = {
+        "model": AI_TRIAGE_MODEL,
+        "messages": [
+            {"role": "system", "content": TRIAGE_SYSTEM_PROMPT},
+            {"role": "user", "content": f"文件: {depot_path}\n<diff>\n{diff_text}\n</diff>"},
+        ],
+        "max_tokens": 8,
+        "temperature": 0,
+    }
+    start_time = time.time()
+    try:
+        # 不走端点池：池中各端点会把 model 替换为深度审查模型，而分诊使用独立的
+        # AI_TRIAGE_MODEL / AI_TRIAGE_BASE_URL（通常是另一个更便宜的服务），请求极短也无需对冲
+        data = _post_chat(AI_TRIAGE_BASE_URL, AI_TRIAGE_API_KEY, payload)
+        choices = data.get("choices", [])
+        answer = choices[0].get("message", {}).get("content", "") if choices else ""
+    except RunCancelled:
+        raise
+    except Exception as e:
+        logger.warning("分诊文件 %s 失败，按高风险处理: %s: %s", depot_path, type(e).__name__, e)
+        return TRIAGE_RISKY, time.time() - start_time
+    elapsed = time.time() - start_time
+    answer = (answer or "").strip().upper()
+    decision = TRIAGE_TRIVIAL if answer.startswith("TRIVIAL") else TRIAGE_RISKY
+    logger.info("分诊 %s: %s (%.1fs)", depot_path, decision, elapsed)
+    return decision, elapsed
+
+
+def review_file_routed(
+    depot_path: str,
+    diff_text: str,
+    full_content: str | None,
+) -> ReviewResult:
+    """
+    未配置 AI_TRIAGE_MODEL 时等同 review_file；否则先分诊，低风险文件直接判定
+    「✅ 无问题」，高风险文件再交给 AI_MODEL 深度审查。结果中记录路由与各级耗时。
+    """
+    if not AI_TRIAGE_MODEL:
+        return review_file(depot_path, diff_text, full_content)
+
+    decision, triage_elapsed = triage_file(depot_path, diff_text)
+    if decision == TRIAGE_TRIVIAL:
+        return ReviewResult(
+            depot_path=depot_path,
+            review_comment="✅ 无问题",
+            model=AI_TRIAGE_MODEL,
+            verdict="clean",
+            route="triage",
+            triage_elapsed=triage_elapsed,
+        )
+    # review_file 可能返回缓存中的对象，复制后再标注，避免改动缓存条目
+    return replace(review_file(depot_path, diff_text, full_content),
+                   route="deep", triage_elapsed=triage_elapsed)
+
+
+def _log_routing_stats(results: list[ReviewResult]):
+    routed = [r for r in results if r.route]
+    if not routed:
+        return
+    triaged = [r for r in routed if r.route == "triage"]
+    deep = [r for r in routed if r.route == "deep"]
+    triage_total = sum(r.triage_elapsed for r in routed)
+    deep_total = sum(r.elapsed for r in deep)
+    logger.info(
+        "分级路由: %d 个文件分诊为低风险, %d 个进入深度审查; 分诊平均 %.1fs, 深度审查平均 %.1fs",
+        len(triaged), len(deep),
+        triage_total / len(routed),
+        deep_total / len(deep) if deep else 0.0,
+    )
+
+
+def _unfinished_result(depot_path: str, reason: str) -> ReviewResult:
+    return ReviewResult(depot_path=depot_path, review_comment="",
+                        error=f"未完成: {describe_reason(reason)}", unfinished=True)
 
 
 def review_files_batch(
@@ -161,14 +469,38 @@ def review_files_batch(
     """
     批量审查多个文件。
     file_data: [(depot_path, diff_text, full_content), ...]
-    按顺序逐个调用（避免并发请求过多触发 rate limit）。
+    AI_CONCURRENCY 为 1 时按顺序逐个调用（避免并发请求过多触发 rate limit）；
+    配置多个端点时可调大并发，由端点池分摊到各端点。结果顺序与输入一致。
+    运行被取消（--deadline 到期 / Ctrl-C）后不再开始新文件，进行中的请求被中止，
+    这些文件的结果标记为 unfinished。
     """
-    results: list[ReviewResult] = []
     total = len(file_data)
+    token = current_token()
 
-    for idx, (depot_path, diff_text, full_content) in enumerate(file_data, 1):
+    def review_one(item: tuple[int, tuple[str, str, str | None]]) -> ReviewResult:
+        idx, (depot_path, diff_text, full_content) = item
+        if token.cancelled:
+            return _unfinished_result(depot_path, token.reason)
         logger.info("[%d/%d] 开始审查: %s", idx, total, depot_path)
-        result = review_file(depot_path, diff_text, full_content)
-        results.append(result)
+        try:
+            return review_file_routed(depot_path, diff_text, full_content)
+        except RunCancelled as e:
+            return _unfinished_result(depot_path, e.reason)
+
+    items = list(enumerate(file_data, 1))
+    if AI_CONCURRENCY <= 1 or total <= 1:
+        results = [review_one(item) for item in items]
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=min(AI_CONCURRENCY, total),
+                                thread_name_prefix="review") as executor:
+            results = list(executor.map(review_one, items))
 
+    _log_routing_stats(results)
+    truncated = sum(1 for r in results if r.truncated)
+    if truncated:
+        logger.warning("%d 个文件的回答因 max_tokens 被截断（已在报告中标注）", truncated)
+    unfinished = sum(1 for r in results if r.unfinished)
+    if unfinished:
+        logger.warning("%s: %d / %d 个文件未完成审查", describe_reason(token.reason), unfinished, total)
     return results
@@ -3,19 +3,20 @@ P4-AI-Reviewer 配置模块
 """
 import os
 
-from dotenv import load_dotenv
-
-# 从项目根目录的 .env 加载环境变量（API 等敏感配置单独管理）
+# 从项目根目录的 .env 加载环境变量（API 等敏感配置单独管理）。
+# 没有 .env 时不导入 dotenv，减少每次启动的开销
 _env_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env")
-load_dotenv(_env_path)
+if os.path.isfile(_env_path):
+    from dotenv import load_dotenv
+    load_dotenv(_env_path)
 
 # ============================================================
 # Perforce 配置
 # ============================================================
 P4_EXECUTABLE = os.environ.get("P4_EXECUTABLE", "p4")
 
-# 代码文件与 P4 输出编码。若代码为 GB2312/GBK（Windows 中文环境常见），
-# 设为 "gbk" 可避免 Diff 与文件内容中的中文乱码。
+# 代码文件与 P4 输出的非 UTF-8 编码。编码按文件识别（BOM → UTF-8 → 本项 → GB18030，见 text_codec.py），
+# UTF-8 与 GBK 文件混杂的代码树也不会乱码；本项决定非 UTF-8 文件优先按哪种编码解码，以及都失败时的替换解码。
 # 环境变量: SOURCE_ENCODING=gbk 或 gb2312
 SOURCE_ENCODING = os.environ.get("SOURCE_ENCODING", "gbk").strip().lower()
 if SOURCE_ENCODING not in ("utf-8", "gbk", "gb2312", "gb18030"):
@@ -57,10 +58,46 @@ AI_API_KEY = os.environ.get("AI_API_KEY", "").strip()
 AI_MODEL = os.environ.get("AI_MODEL", "").strip()
 # 单条审查意见最大生成长度（tokens）。DeepSeek 最高 8192，过小可能导致长评语被截断
 AI_MAX_TOKENS = int(os.environ.get("AI_MAX_TOKENS", "8192"))
+# 按文件估算 max_tokens（变更行数、hunk 数、分支/循环等复杂度），取值限制在 [AI_MIN_TOKENS, AI_MAX_TOKENS]。
+# 小改动不再预留整份 AI_MAX_TOKENS，同样的 TPM 配额下可并发更多请求；回答因长度截断（finish_reason=length）
+# 时以 AI_MAX_TOKENS 重试一次。设为 0 则每个请求都使用 AI_MAX_TOKENS
+AI_ADAPTIVE_TOKENS = os.environ.get("AI_ADAPTIVE_TOKENS", "1").strip().lower() not in ("0", "false", "no")
+AI_MIN_TOKENS = int(os.environ.get("AI_MIN_TOKENS", "1024"))
 # 降低温度可提高多次运行结果一致性，建议 0～0.1
 AI_TEMPERATURE = float(os.environ.get("AI_TEMPERATURE", "0.1"))
 # 随机种子（部分 API 支持，如 OpenAI）。设为正整数可提升多次运行一致性，留空则不传
 AI_SEED = os.environ.get("AI_SEED", "")
+# 结构化输出：请求 response_format=json_object 并要求模型按 JSON 返回问题列表，
+# 解析更可靠；需要接口支持 JSON 模式（OpenAI、DeepSeek 等）。设为 1 开启
+AI_STRUCTURED_OUTPUT = os.environ.get("AI_STRUCTURED_OUTPUT", "0").strip().lower() in ("1", "true", "yes")
+
+# 分级路由：配置分诊模型后，每个文件先用廉价/本地模型做一次极短的风险分诊，
+# 仅高风险文件交给 AI_MODEL 深度审查。留空则不分诊
+AI_TRIAGE_MODEL = os.environ.get("AI_TRIAGE_MODEL", "").strip()
+# 分诊接口地址与密钥，默认与主模型相同（可指向本地 Ollama 等）
+AI_TRIAGE_BASE_URL = os.environ.get("AI_TRIAGE_BASE_URL", "").strip() or AI_API_BASE_URL
+AI_TRIAGE_API_KEY = os.environ.get("AI_TRIAGE_API_KEY", "").strip() or AI_API_KEY
+# Diff 超过该字符数时跳过分诊，直接深度审查（大改动默认视为高风险）
+AI_TRIAGE_MAX_CHARS = int(os.environ.get("AI_TRIAGE_MAX_CHARS", "6000"))
+
+# 单次 LLM 请求超时（秒）
+AI_REQUEST_TIMEOUT = float(os.environ.get("AI_REQUEST_TIMEOUT", "180"))
+# 同时审查的文件数。单端点建议保持 1 以免触发 rate limit；配置多个端点时可调大
+AI_CONCURRENCY = max(1, int(os.environ.get("AI_CONCURRENCY", "1")))
+
+# 多端点负载均衡：JSON 数组，每项 {"name", "base_url", "api_key", "model", "weight"}，
+# 缺省字段取上面的 AI_API_BASE_URL / AI_API_KEY / AI_MODEL。留空则只用单个主端点
+AI_ENDPOINTS = os.environ.get("AI_ENDPOINTS", "").strip()
+# 端点选择策略：least_loaded（在途请求数/权重最小）或 weighted（按权重随机）
+AI_ENDPOINT_STRATEGY = os.environ.get("AI_ENDPOINT_STRATEGY", "least_loaded").strip().lower()
+# 熔断：端点连续失败（429 / 5xx / 网络错误）达到次数后暂停使用若干秒
+AI_CIRCUIT_FAILURES = int(os.environ.get("AI_CIRCUIT_FAILURES", "3"))
+AI_CIRCUIT_COOLDOWN = float(os.environ.get("AI_CIRCUIT_COOLDOWN", "60"))
+# 对冲请求：请求超过该端点 p95 延迟仍未返回时，向另一端点发送相同请求，先返回者胜出，
+# 另一请求取消。会增加少量请求量，需至少两个端点。设为 1 开启
+AI_HEDGE = os.environ.get("AI_HEDGE", "0").strip().lower() in ("1", "true", "yes")
+# 端点累计的延迟样本数达到该值后才开始对冲（p95 才可信）
+AI_HEDGE_MIN_SAMPLES = int(os.environ.get("AI_HEDGE_MIN_SAMPLES", "20"))
 
 # 单个文件全量内容截断阈值（字符数），超过此长度截断并提示模型
 # DeepSeek 128K 上下文下可用约 10 万字符/文件，其他模型酌情减小（如 60000）
@@ -70,6 +107,19 @@ REQUEST_MAX_CHARS = int(os.environ.get("REQUEST_MAX_CHARS", "100000"))
 # 单次运行最多审查的代码文件数，0 表示不限制。文件过多时可设为正整数（如 50），其余在报告中标注“未审查”
 MAX_FILES_PER_RUN = int(os.environ.get("MAX_FILES_PER_RUN", "0"))
 
+# 重复变更检测：对增删内容相同/近似的文件只审查一个代表，其余复用其审查意见。默认关闭，设为 1 开启
+DEDUP_ENABLED = os.environ.get("DEDUP_ENABLED", "0").strip().lower() in ("1", "true", "yes")
+# 近似重复的相似度阈值（估计 Jaccard，0~1）。设为 1 仅合并归一化后完全相同的变更
+DEDUP_SIMILARITY = float(os.environ.get("DEDUP_SIMILARITY", "0.9"))
+# 参与标识符归一化与近似合并的最少增删行数；更小的改动重命名后极易撞车，只合并原文完全相同的变更
+DEDUP_MIN_LINES = int(os.environ.get("DEDUP_MIN_LINES", "5"))
+
+# 超大 CL（上万文件的集成）并行解析：p4 describe 输出超过 PARSE_PARALLEL_MIN_MB 时按文件边界切块，
+# 在进程池中并行解析、分类，并预先计算重复变更检测所需的归一化增删行。
+# PARSE_WORKERS: 进程数，0 = CPU 核数，1 = 不使用进程池
+PARSE_WORKERS = int(os.environ.get("PARSE_WORKERS", "0"))
+PARSE_PARALLEL_MIN_MB = float(os.environ.get("PARSE_PARALLEL_MIN_MB", "16"))
+
 # ============================================================
 # 输出配置
 # ============================================================
@@ -78,6 +128,49 @@ REPORT_OUTPUT_DIR = os.environ.get("REPORT_OUTPUT_DIR", "reports")
 # 仅在使用 -o 指定路径时的默认文件名（未指定 -o 时使用 目录/Review_Report_时间戳.md）
 REPORT_OUTPUT_PATH = os.environ.get("REPORT_OUTPUT_PATH", "Review_Report.md")
 
+# 报告输出格式，逗号分隔：md（Markdown）、jsonl（逐文件 JSON 记录）、json（汇总 JSON）
+REPORT_FORMATS = [
+    f.strip() for f in os.environ.get("REPORT_FORMATS", "md").lower().split(",")
+    if f.strip() in ("md", "jsonl", "json")
+] or ["md"]
+# Markdown 报告是否嵌入折叠的 Diff（大 CL 下 Diff 常使报告体积翻倍）
+REPORT_EMBED_DIFF = os.environ.get("REPORT_EMBED_DIFF", "1").strip().lower() not in ("0", "false", "no")
+
+# 符号索引（SQLite）：由 `index` 子命令从工作区建立并增量更新。存在时审查会把 Diff 中
+# 涉及标识符在其他文件中的声明签名注入 Prompt，补足单文件上下文。设为空字符串则不使用
+SYMBOL_INDEX_PATH = os.environ.get("SYMBOL_INDEX_PATH", os.path.join(REPORT_OUTPUT_DIR, "symbols.db")).strip()
+# `index` 子命令默认索引的本地目录，逗号分隔（命令行指定目录时以命令行为准）
+SYMBOL_INDEX_ROOTS = [p.strip() for p in os.environ.get("SYMBOL_INDEX_ROOTS", "").split(",") if p.strip()]
+# 每个文件注入的跨文件声明总字符数上限，0 表示不注入
+SYMBOL_CONTEXT_MAX_CHARS = int(os.environ.get("SYMBOL_CONTEXT_MAX_CHARS", "4000"))
+
+# 审查结果数据库（SQLite），每次运行的逐文件结果写入其中，可用 `query` 子命令检索。
+# 默认为空（不记录），设为路径（如 reports/reviews.db）开启
+REVIEW_STORE_PATH = os.environ.get("REVIEW_STORE_PATH", "").strip()
+
+# ============================================================
+# 监视模式配置（python p4_ai_reviewer.py local --watch）
+# ============================================================
+# 轮询 p4 opened / 文件修改时间的间隔（秒）
+WATCH_INTERVAL = float(os.environ.get("WATCH_INTERVAL", "2.0"))
+# 最后一次文件变动后静默多少秒才触发审查，避免连续保存时重复请求
+WATCH_DEBOUNCE = float(os.environ.get("WATCH_DEBOUNCE", "3.0"))
+
+# ============================================================
+# 服务模式配置（python p4_ai_reviewer.py serve）
+# ============================================================
+# HTTP API 监听地址与端口
+SERVICE_HOST = os.environ.get("SERVICE_HOST", "127.0.0.1")
+SERVICE_PORT = int(os.environ.get("SERVICE_PORT", "8765"))
+# 同时处理的任务数（每个任务为一次 CL 审查）
+SERVICE_WORKERS = int(os.environ.get("SERVICE_WORKERS", "2"))
+# SQLite 任务队列路径；其他进程也可直接向该库插入任务
+SERVICE_DB_PATH = os.environ.get("SERVICE_DB_PATH", os.path.join(REPORT_OUTPUT_DIR, "service_queue.db"))
+# 服务模式报告目录
+SERVICE_REPORT_DIR = os.environ.get("SERVICE_REPORT_DIR", os.path.join(REPORT_OUTPUT_DIR, "service"))
+# 进程内审查结果缓存条目数（相同 Prompt 复用结果），0 表示关闭
+SERVICE_CACHE_SIZE = int(os.environ.get("SERVICE_CACHE_SIZE", "2000"))
+
 # ============================================================
 # Prompt 系统角色
 # ============================================================
@@ -96,7 +189,7 @@ SYSTEM_PROMPT = """\
 - 每条建议：标注**行号**（基于 Diff）+ 严重程度 🔴/🟡/🔵，用中文简要说明，不赘述。同类问题用同一等级。
 - **若变更仅为以下之一且无逻辑/内存风险**：仅注释、仅时间戳/版本号、仅 UI 坐标/布局数值、仅空行或格式，则只输出一行「✅ 无问题」，不要追加任何建议。
 - **若存在任何逻辑/内存/线程/边界问题**：按上述等级列出，不要输出「✅ 无问题」。
-- **单文件上下文限制**：你只能看到当前文件。不要基于「在本文件中未看到声明/定义」做出「未声明、未定义、无此成员」类建议（成员或声明可能在头文件、基类、其他单元中）。
+- **单文件上下文限制**：你只能看到当前文件。不要基于「在本文件中未看到声明/定义」做出「未声明、未定义、无此成员」类建议（成员或声明可能在头文件、基类、其他单元中）。若提供了 `<related_declarations>`，可据其中的声明签名核对类型、参数与返回值；但它只收录部分声明，未列出不代表不存在。
 - **关注局部逻辑**：基于检查项重点审查当前 Diff 修改的代码，而不是全文件的编译检查。
 - 整体精简，不要客套话、总结句、重复说明。
 """
@@ -0,0 +1,145 @@
+"""
+P4-AI-Reviewer — 运行截止时间与协作式取消
+一次运行（CL / local / 范围审查）共用一个取消令牌：
+    - --deadline 到期或收到 Ctrl-C（SIGINT）时令牌被取消；
+    - p4 子进程超时取「自身超时」与「剩余时间」的较小值，HTTP 请求注册取消回调，令牌取消时立即中止；
+    - 调度器不再领取新文件，未完成的文件在报告中标注，报告照常完整写出；
+      取消发生在获取变更（describe / diff）阶段时文件列表尚不完整，不生成报告，入口以退出码 3 结束。
+服务模式与监视模式不设置令牌，使用永不取消的默认令牌。
+"""
+import logging
+import signal
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+logger = logging.getLogger(__name__)
+
+REASON_DEADLINE = "deadline"
+REASON_INTERRUPT = "interrupt"
+
+_REASON_TEXT = {
+    REASON_DEADLINE: "运行截止时间已到",
+    REASON_INTERRUPT: "用户中断 (Ctrl-C)",
+}
+
+
+class RunCancelled(Exception):
+    """运行已取消（截止时间到期或用户中断）。"""
+
+    def __init__(self, reason: str):
+        super().__init__(_REASON_TEXT.get(reason, reason))
+        self.reason = reason
+
+
+class CancelToken:
+    """取消令牌：可设截止时间（monotonic），取消时依次调用已注册的回调。"""
+
+    def __init__(self, deadline: float | None = None):
+        self.deadline = deadline
+        self.reason = ""
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks: dict[int, Callable[[], None]] = {}
+        self._next_id = 0
+        self._timer: threading.Timer | None = None
+        if deadline is not None:
+            self._timer = threading.Timer(max(0.0, deadline - time.monotonic()),
+                                          self.cancel, args=(REASON_DEADLINE,))
+            self._timer.daemon = True
+            self._timer.start()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self, reason: str):
+        """取消令牌（重复调用无效）。"""
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            callbacks = list(self._callbacks.values())
+            self._callbacks.clear()
+        logger.warning("%s，停止领取新文件并取消进行中的请求", _REASON_TEXT.get(reason, reason))
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.debug("取消回调异常: %s", e)
+
+    def check(self):
+        """已取消时抛出 RunCancelled。"""
+        if self._event.is_set():
+            raise RunCancelled(self.reason)
+
+    def timeout(self, default: float) -> float:
+        """返回不超过剩余时间的超时值；已取消或已到期时抛出 RunCancelled。"""
+        self.check()
+        if self.deadline is None:
+            return default
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            self.cancel(REASON_DEADLINE)
+            self.check()
+        return min(default, remaining)
+
+    def register(self, callback: Callable[[], None]) -> Callable[[], None]:
+        """注册取消回调，返回注销函数；令牌已取消时立即调用回调。"""
+        with self._lock:
+            if not self._event.is_set():
+                key = self._next_id
+                self._next_id += 1
+                self._callbacks[key] = callback
+                return lambda: self._callbacks.pop(key, None)
+        callback()
+        return lambda: None
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+
+
+_NEVER = CancelToken()
+_current: CancelToken = _NEVER
+
+
+def current_token() -> CancelToken:
+    """当前运行的取消令牌（未设置时为永不取消的默认令牌）。"""
+    return _current
+
+
+def describe_reason(reason: str) -> str:
+    return _REASON_TEXT.get(reason, reason)
+
+
+@contextmanager
+def run_scope(deadline_seconds: float | None = None, handle_sigint: bool = True) -> Iterator[CancelToken]:
+    """
+    在一次运行期间安装取消令牌：deadline_seconds 为从现在起的时限（秒，None 表示不限）。
+    handle_sigint 时第一次 Ctrl-C 取消令牌（尽快收尾并写出报告），第二次恢复默认行为立即退出。
+    """
+    global _current
+    deadline = time.monotonic() + deadline_seconds if deadline_seconds else None
+    token = CancelToken(deadline)
+    previous_handler = None
+
+    def on_sigint(signum, frame):
+        if token.cancelled:
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            raise KeyboardInterrupt
+        print("\n⏹  收到中断，正在取消进行中的请求并写出报告（再按一次 Ctrl-C 立即退出）...")
+        token.cancel(REASON_INTERRUPT)
+
+    if handle_sigint and threading.current_thread() is threading.main_thread():
+        previous_handler = signal.signal(signal.SIGINT, on_sigint)
+    _current = token
+    try:
+        yield token
+    finally:
+        _current = _NEVER
+        token.close()
+        if previous_handler is not None:
+            signal.signal(signal.SIGINT, previous_handler)
@@ -7,7 +7,7 @@ import os
 import logging
 from dataclasses import dataclass, field
 
-from config import CODE_EXTENSIONS, IGNORE_EXTENSIONS
+from config import CODE_EXTENSIONS, IGNORE_EXTENSIONS, PARSE_PARALLEL_MIN_MB, PARSE_WORKERS
 
 logger = logging.getLogger(__name__)
 
@@ -21,6 +21,8 @@ class FileDiff:
     diff_text: str           # 原始 unified diff 文本片段
     is_code_file: bool       # 是否为需要审查的代码文件
     cl_number: str = ""      # 所属 CL 编号（CL 模式下有值，用于多 CL 时区分同文件）
+    # 归一化增删行（并行解析时在子进程中预先计算，重复变更检测直接复用；None 表示未计算）
+    change_lines: list[str] | None = field(default=None, repr=False, compare=False)
 
 
 def _is_code_file(filepath: str) -> bool:
@@ -106,7 +108,7 @@ def _parse_local_diff_header(header: str) -> tuple[str, str]:
 
 def parse_cl_describe(raw: str) -> list[FileDiff]:
     """
-    解析 `p4 describe -du <CL>` 的输出。
+    解析 `p4 describe -du <CL>` 的输出（`p4 describe -S -du` 的 Shelved files 段同样适用）。
     典型格式:
         Change 12345 by user@ws on 2024/01/01 12:00:00
             描述文字...
@@ -119,13 +121,32 @@ def parse_cl_describe(raw: str) -> list[FileDiff]:
         --- a/depot/path/file.cpp
         +++ b/depot/path/file.cpp
         @@ ...
+    输出超过 PARSE_PARALLEL_MIN_MB 时在进程池中并行解析（结果与顺序解析一致）。
     """
-    results: list[FileDiff] = []
+    action_map = _parse_affected_actions(raw)
+
+    diff_section_match = re.search(r'Differences \.\.\.\s*\n', raw)
+    if not diff_section_match:
+        logger.warning("p4 describe 输出中未找到 Differences 段")
+        return []
 
-    # 1) 提取 affected files 中的 action 信息
+    start = diff_section_match.end()
+    workers = _parse_workers(len(raw) - start)
+    if workers > 1:
+        results = _parse_describe_parallel(raw, start, action_map, workers)
+    else:
+        results = _parse_describe_blocks(raw[start:], action_map)
+
+    logger.info("CL 模式解析完成: 共 %d 个文件, 其中 %d 个代码文件",
+                len(results), sum(1 for f in results if f.is_code_file))
+    return results
+
+
+def _parse_affected_actions(raw: str) -> dict[str, str]:
+    """提取 Affected files 段中各文件的 action。"""
     action_map: dict[str, str] = {}
     affected_section = re.search(
-        r'Affected files \.\.\.\s*\n(.*?)(?:\nDifferences \.\.\.|\Z)',
+        r'(?:Affected|Shelved) files \.\.\.\s*\n(.*?)(?:\nDifferences \.\.\.|\Z)',
         raw, re.DOTALL
     )
     if affected_section:
@@ -135,14 +156,12 @@ def parse_cl_describe(raw: str) -> list[FileDiff]:
             m = re.match(r'\.\.\.\s*(//[^\s#]+)(?:#\d+)?\s+(\w+)', line)
             if m:
                 action_map[m.group(1)] = m.group(2)
+    return action_map
 
-    # 2) 按 ==== 分隔 diff 块
-    diff_section_match = re.search(r'Differences \.\.\.\s*\n(.*)', raw, re.DOTALL)
-    if not diff_section_match:
-        logger.warning("p4 describe 输出中未找到 Differences 段")
-        return results
 
-    diff_section = diff_section_match.group(1)
+def _parse_describe_blocks(diff_section: str, action_map: dict[str, str]) -> list[FileDiff]:
+    """按 ==== 文件头拆分 Differences 段（或其中以文件头开始的一块）。"""
+    results: list[FileDiff] = []
     file_blocks = re.split(r'^(==== .+? ====)\s*$', diff_section, flags=re.MULTILINE)
 
     i = 0
@@ -165,12 +184,96 @@ def parse_cl_describe(raw: str) -> list[FileDiff]:
                 ))
         else:
             i += 1
+    return results
 
-    logger.info("CL 模式解析完成: 共 %d 个文件, 其中 %d 个代码文件",
-                len(results), sum(1 for f in results if f.is_code_file))
+
+# ------------------------------------------------------------
+# 超大 describe 输出的并行解析
+# ------------------------------------------------------------
+
+# 每个进程分到的块数（块数多于进程数，文件大小不均时负载更平衡）
+_CHUNKS_PER_WORKER = 4
+
+# 子进程状态，由 _init_parse_worker 设置
+_worker_shm = None
+_worker_actions: dict[str, str] = {}
+_worker_change_lines = False
+
+
+def _parse_workers(section_len: int) -> int:
+    """返回解析 Differences 段使用的进程数，1 表示顺序解析。"""
+    if PARSE_WORKERS == 1 or section_len < PARSE_PARALLEL_MIN_MB * 1024 * 1024:
+        return 1
+    return PARSE_WORKERS if PARSE_WORKERS > 0 else (os.cpu_count() or 1)
+
+
+def _chunk_spans(data: bytes, count: int) -> list[tuple[int, int]]:
+    """将 Differences 段按大小均分为约 count 块，每个边界后移到下一个 ==== 文件头的行首。"""
+    size = len(data)
+    bounds = [0]
+    for k in range(1, count):
+        pos = data.find(b"\n==== ", max(bounds[-1], size * k // count))
+        if pos < 0:
+            break
+        if pos + 1 > bounds[-1]:
+            bounds.append(pos + 1)
+    bounds.append(size)
+    return [(a, b) for a, b in zip(bounds, bounds[1:]) if b > a]
+
+
+def _init_parse_worker(shm_name: str, action_map: dict[str, str], change_lines: bool):
+    global _worker_shm, _worker_actions, _worker_change_lines
+    from multiprocessing import shared_memory
+
+    _worker_shm = shared_memory.SharedMemory(name=shm_name)
+    _worker_actions = action_map
+    _worker_change_lines = change_lines
+
+
+def _parse_chunk(span: tuple[int, int]) -> list[FileDiff]:
+    """子进程：从共享内存中解码一块并解析、分类；开启重复检测时预先计算代码文件的归一化增删行。"""
+    start, end = span
+    text = str(_worker_shm.buf[start:end], "utf-8")
+    results = _parse_describe_blocks(text, _worker_actions)
+    if _worker_change_lines:
+        from diff_similarity import normalized_change_lines
+        for fd in results:
+            if fd.is_code_file:
+                fd.change_lines = normalized_change_lines(fd.diff_text)
     return results
 
 
+def _parse_describe_parallel(
+    raw: str, start: int, action_map: dict[str, str], workers: int,
+) -> list[FileDiff]:
+    """
+    Differences 段编码后放入共享内存，按文件边界切块，各子进程只拷贝并解码自己的一块；
+    结果按块顺序合并，与顺序解析一致。
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import shared_memory
+
+    from config import DEDUP_ENABLED
+
+    data = raw[start:].encode("utf-8")
+    spans = _chunk_spans(data, workers * _CHUNKS_PER_WORKER)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+    try:
+        shm.buf[:len(data)] = data
+        del data
+        logger.info("Diff 输出较大，使用 %d 个进程并行解析 (%d 块)", workers, len(spans))
+        # 主进程此时可能已有后台线程（截止时间计时器等），统一用 spawn 创建子进程，避免 fork 带锁
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                 initializer=_init_parse_worker,
+                                 initargs=(shm.name, action_map, DEDUP_ENABLED)) as pool:
+            return [fd for chunk in pool.map(_parse_chunk, spans) for fd in chunk]
+    finally:
+        shm.close()
+        shm.unlink()
+
+
 def _parse_cl_diff_header(header: str) -> str:
     """
     从 ==== //depot/path/file.cpp#3 (text) ==== 中提取 depot_path。
@@ -178,3 +281,75 @@ def _parse_cl_diff_header(header: str) -> str:
     content = header.strip("= ").strip()
     m = re.match(r'(//[^\s#]+)', content)
     return m.group(1) if m else ""
+
+
+_DESCRIBE_START_RE = re.compile(r'^Change (\d+) by ', re.MULTILINE)
+
+
+def split_describe_output(raw: str) -> list[tuple[str, str]]:
+    """
+    将多个 CL 的 describe 输出（p4 describe -du 100 101 ...）按 CL 拆分，返回 [(CL 编号, 单个 describe 文本)]。
+    """
+    starts = list(_DESCRIBE_START_RE.finditer(raw))
+    parts = []
+    for idx, m in enumerate(starts):
+        end = starts[idx + 1].start() if idx + 1 < len(starts) else len(raw)
+        parts.append((m.group(1), raw[m.start():end]))
+    return parts
+
+
+# ============================================================
+# 合并 Diff 解析 (p4 diff2 -du <left> <right>)
+# ============================================================
+
+_DIFF2_HEADER_RE = re.compile(r'^==== (.+?) - (.+?) ={3,4}(?: \w+)?\s*$', re.MULTILINE)
+
+
+def parse_diff2(raw: str) -> list[FileDiff]:
+    """
+    解析 `p4 diff2 -du` 的输出。
+    典型格式:
+        ==== //depot/path/file.cpp#3 (text) - //depot/path/file.cpp#5 (text) ==== content
+        @@ ...
+        ==== <none> - //depot/path/new.cpp#1 ====
+        ==== //depot/path/old.cpp#2 (text) - <none> ===
+    左侧为 <none> 视为 add，右侧为 <none> 视为 delete；内容相同（identical）的文件不返回。
+    """
+    results: list[FileDiff] = []
+    headers = list(_DIFF2_HEADER_RE.finditer(raw))
+    for idx, m in enumerate(headers):
+        end = headers[idx + 1].start() if idx + 1 < len(headers) else len(raw)
+        if m.group(0).rstrip().endswith("identical"):
+            continue
+        left, right = m.group(1).strip(), m.group(2).strip()
+        if left.startswith("<none>"):
+            action = "add"
+        elif right.startswith("<none>"):
+            action = "delete"
+        else:
+            action = "edit"
+        path_match = re.match(r'(//[^\s#]+)', right if action != "delete" else left)
+        if not path_match:
+            continue
+        depot_path = path_match.group(1)
+        results.append(FileDiff(
+            depot_path=depot_path,
+            local_path="",
+            action=action,
+            diff_text=raw[m.end():end].strip(),
+            is_code_file=_is_code_file(depot_path),
+        ))
+
+    logger.info("合并 Diff 解析完成: 共 %d 个文件, 其中 %d 个代码文件",
+                len(results), sum(1 for f in results if f.is_code_file))
+    return results
+
+
+def filespec_matcher(path_spec: str, case_insensitive: bool = False):
+    """
+    将 depot 路径通配（`...` 匹配任意层级，`*` 匹配单层）转换为匹配函数，用于从 describe 结果中
+    只保留 filespec 范围内的文件。默认区分大小写；case_insensitive 应与服务器的 caseHandling 一致。
+    """
+    pattern = re.escape(path_spec).replace(r"\.\.\.", ".*").replace(r"\*", "[^/]*")
+    regex = re.compile(pattern + "$", re.IGNORECASE if case_insensitive else 0)
+    return lambda depot_path: bool(regex.match(depot_path))
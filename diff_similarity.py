@@ -0,0 +1,197 @@
+"""
+P4-AI-Reviewer — 重复变更检测
+宽范围的机械式 CL（多平台副本、生成代码、批量 API 改名）常对许多文件做相同修改。
+对增删行做标识符归一化（被调用的函数名保留原样）后：
+    1) 归一化内容哈希相同 → 完全相同的变更
+    2) MinHash（单次哈希分桶）+ LSH 估计 Jaccard 相似度 >= 阈值 → 近似相同的变更
+       （只对增删行数不少于下限的文件，且与簇代表本身比较，相似关系不会沿链传递）
+增删行少于下限的小改动不做标识符重命名，只合并原文（忽略空白）完全相同的变更。
+每个簇只审查一个代表文件，其余成员复用代表的审查意见。
+"""
+import hashlib
+import logging
+import os
+import re
+from dataclasses import dataclass, replace
+
+from ai_reviewer import ReviewResult
+from diff_parser import FileDiff
+
+logger = logging.getLogger(__name__)
+
+# 第 2 组非空表示标识符后紧跟「(」，即函数调用/声明
+_IDENT_RE = re.compile(r"\b([A-Za-z_]\w*)(\s*\()?")
+
+# 各语言常见关键字/类型以及被调用的函数名保留原样，其余标识符按首次出现顺序重命名为 $0, $1 ...
+_KEYWORDS = frozenset("""
+if else for while do switch case default break continue return goto try catch throw finally
+new delete sizeof typeof typename template class struct union enum namespace using public private
+protected virtual override final static const constexpr volatile mutable inline extern friend
+operator this nullptr NULL true false void bool char short int long float double unsigned signed
+auto size_t int8_t int16_t int32_t int64_t uint8_t uint16_t uint32_t uint64_t
+def import from as with pass lambda yield None True False and or not in is elif global nonlocal
+local function end then nil self var let fn pub impl mut match loop func package go defer chan
+string interface readonly ref out params base async await foreach get set
+""".split())
+
+# 签名分桶数；每个 shingle 只哈希一次，按哈希值落入某个桶并保留桶内最小值
+_NUM_BINS = 64
+_BANDS = 16
+_ROWS = _NUM_BINS // _BANDS
+_EMPTY = -1
+
+
+def normalized_change_lines(diff_text: str, rename_identifiers: bool = True) -> list[str]:
+    """
+    提取增删行并做标识符归一化（按首次出现顺序 alpha 重命名），
+    使仅变量名不同的同构修改（如平台后缀、批量改名）得到相同结果。
+    被调用的函数名不参与重命名：free(p) 与 close(p) 语义不同，不能视为同一变更。
+    rename_identifiers=False 时只压缩空白，保留原标识符。
+    """
+    names: dict[str, str] = {}
+
+    def rename(m: re.Match) -> str:
+        tok = m.group(1)
+        if m.group(2) is not None:
+            return tok + "("
+        if tok in _KEYWORDS:
+            return tok
+        alias = names.get(tok)
+        if alias is None:
+            alias = names[tok] = f"${len(names)}"
+        return alias
+
+    lines: list[str] = []
+    for line in (diff_text or "").splitlines():
+        if not line or line[0] not in "+-" or line.startswith(("+++", "---")):
+            continue
+        body = " ".join(line[1:].split())
+        if body:
+            lines.append(line[0] + (_IDENT_RE.sub(rename, body) if rename_identifiers else body))
+    return lines
+
+
+def _minhash(lines: list[str]) -> list[int]:
+    """
+    单次哈希（one permutation hashing）MinHash 签名，以归一化后的增删行为 shingle，
+    O(行数)。
+    """
+    sig = [_EMPTY] * _NUM_BINS
+    for line in set(lines):
+        h = int.from_bytes(hashlib.blake2b(line.encode("utf-8"), digest_size=8).digest(), "little")
+        b, v = h % _NUM_BINS, h // _NUM_BINS
+        if sig[b] == _EMPTY or v < sig[b]:
+            sig[b] = v
+    return sig
+
+
+def _estimated_similarity(sig_a: list[int], sig_b: list[int]) -> float:
+    """估计 Jaccard 相似度：只统计至少一方非空的桶，避免小集合的空桶虚高。"""
+    considered = matched = 0
+    for x, y in zip(sig_a, sig_b):
+        if x == _EMPTY and y == _EMPTY:
+            continue
+        considered += 1
+        if x == y:
+            matched += 1
+    return matched / considered if considered else 0.0
+
+
+@dataclass
+class DuplicateGroup:
+    """一个重复簇：代表文件 + 成员（成员附带与代表的相似度，完全相同为 1.0）"""
+    representative: FileDiff
+    members: list[tuple[FileDiff, float]]
+
+
+def group_duplicates(files: list[FileDiff], threshold: float, min_lines: int = 0) -> list[DuplicateGroup]:
+    """
+    将文件划分为重复簇，保持输入顺序（代表为簇内首个文件）。
+    只在扩展名相同的文件之间合并；threshold >= 1.0 时只合并完全相同的变更。
+    近似合并按 leader 聚类：按输入顺序，每个文件只与已有簇的代表比较，归入相似度最高且
+    >= threshold 的簇，否则自成新簇；增删行少于 min_lines 的文件不参与近似合并。
+    返回的簇覆盖全部输入文件（无重复的文件自成一簇），成员相似度即与代表的相似度。
+    """
+    # 并行解析时已在子进程中算好（FileDiff.change_lines）
+    normalized = [f.change_lines if f.change_lines is not None else normalized_change_lines(f.diff_text)
+                  for f in files]
+    exts = [os.path.splitext(f.depot_path)[1].lower() for f in files]
+
+    # 1) 完全相同（归一化后）：exact_rep[i] 为同内容的首个文件。
+    #    小改动重命名后太容易撞车（+x = 1; 与 +y = 1; 都成了 +$0 = 1;），改用原文比较
+    exact_rep = list(range(len(files)))
+    exact: dict[tuple[str, bool, str], int] = {}
+    for i, lines in enumerate(normalized):
+        if not lines:
+            continue
+        renamed = len(lines) >= max(1, min_lines)
+        if not renamed:
+            lines = normalized_change_lines(files[i].diff_text, rename_identifiers=False)
+        key = (exts[i], renamed, hashlib.sha1("\n".join(lines).encode("utf-8")).hexdigest())
+        exact_rep[i] = exact.setdefault(key, i)
+
+    # 2) 近似相同：只有簇代表进入 LSH 分桶，候选代表再用估计相似度确认
+    leader: dict[int, tuple[int, float]] = {}  # 完全相同组的首个文件 → (簇代表, 与代表的相似度)
+    if threshold < 1.0:
+        signatures: dict[int, list[int]] = {}
+        buckets: dict[tuple, list[int]] = {}
+        for i in exact.values():
+            if len(normalized[i]) < max(1, min_lines):
+                continue
+            sig = signatures[i] = _minhash(normalized[i])
+            keys = []
+            for band in range(_BANDS):
+                rows = tuple(sig[band * _ROWS:(band + 1) * _ROWS])
+                if any(v != _EMPTY for v in rows):
+                    keys.append((exts[i], band, rows))
+            best, best_sim = -1, threshold
+            for r in dict.fromkeys(r for key in keys for r in buckets.get(key, ())):
+                sim = _estimated_similarity(signatures[r], sig)
+                if sim >= best_sim and (best < 0 or sim > best_sim):
+                    best, best_sim = r, sim
+            if best >= 0:
+                leader[i] = (best, best_sim)
+                continue
+            for key in keys:
+                buckets.setdefault(key, []).append(i)
+
+    groups: dict[int, DuplicateGroup] = {}
+    order: list[int] = []
+    for i, f in enumerate(files):
+        root, sim = leader.get(exact_rep[i], (exact_rep[i], 1.0))
+        if root not in groups:
+            groups[root] = DuplicateGroup(representative=files[root], members=[])
+            order.append(root)
+        if i != root:
+            groups[root].members.append((f, sim))
+    result = [groups[r] for r in order]
+
+    merged = sum(len(g.members) for g in result)
+    if merged:
+        logger.info("重复变更检测: %d 个文件归为 %d 组，省去 %d 次审查请求",
+                    len(files), len(result), merged)
+    return result
+
+
+def expand_group_results(
+    groups: list[DuplicateGroup],
+    rep_results: list[ReviewResult],
+    files: list[FileDiff],
+) -> list[ReviewResult]:
+    """
+    将代表文件的审查结果复制给簇内成员，按 files 原顺序返回与之一一对应的结果列表。
+    成员结果标注 duplicate_of 与相似度，耗时记为 0。
+    """
+    by_file: dict[int, ReviewResult] = {}
+    for group, result in zip(groups, rep_results):
+        by_file[id(group.representative)] = result
+        for member, sim in group.members:
+            by_file[id(member)] = replace(
+                result,
+                depot_path=member.depot_path,
+                elapsed=0.0,
+                findings=list(result.findings),
+                duplicate_of=group.representative.depot_path,
+                duplicate_similarity=sim,
+            )
+    return [by_file[id(f)] for f in files]
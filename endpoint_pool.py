@@ -0,0 +1,294 @@
+"""
+P4-AI-Reviewer — 多端点负载均衡
+管理多个 OpenAI 兼容端点（地址 / 密钥 / 模型 / 权重）：
+    - 选择策略：least_loaded（按 在途请求数 / 权重 最小）或 weighted（按权重随机）
+    - 熔断：连续 AI_CIRCUIT_FAILURES 次可重试失败（429 / 5xx / 网络错误）后熔断
+      AI_CIRCUIT_COOLDOWN 秒，冷却后放行一次试探请求
+    - 对冲：请求超过该端点 p95 延迟仍未返回时，向另一端点发出相同请求，先返回者胜出，另一请求取消
+"""
+import concurrent.futures
+import json
+import logging
+import random
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+
+import httpx
+
+from config import (
+    AI_API_BASE_URL,
+    AI_API_KEY,
+    AI_MODEL,
+    AI_ENDPOINTS,
+    AI_ENDPOINT_STRATEGY,
+    AI_CIRCUIT_FAILURES,
+    AI_CIRCUIT_COOLDOWN,
+    AI_HEDGE,
+    AI_HEDGE_MIN_SAMPLES,
+)
+from deadline import current_token
+from http_client import submit_post
+
+logger = logging.getLogger(__name__)
+
+# 每个端点保留的最近延迟样本数（用于 p95）
+_LATENCY_WINDOW = 200
+
+
+@dataclass
+class Endpoint:
+    """单个端点及其运行时状态"""
+    name: str
+    base_url: str
+    api_key: str
+    model: str
+    weight: float = 1.0
+    in_flight: int = 0
+    consecutive_failures: int = 0
+    open_until: float = 0.0          # 熔断截止时间（time.monotonic）
+    half_open_probe: bool = False    # 冷却结束后是否已有试探请求在途
+    latencies: deque = field(default_factory=lambda: deque(maxlen=_LATENCY_WINDOW))
+
+    def p95(self) -> float | None:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """是否属于端点健康问题（计入熔断、可换端点重试）。"""
+    if isinstance(exc, httpx.HTTPStatusError):
+        status = exc.response.status_code
+        return status == 429 or status >= 500
+    return isinstance(exc, (httpx.TransportError, TimeoutError))
+
+
+class EndpointPool:
+    """线程安全的端点池"""
+
+    def __init__(
+        self,
+        endpoints: list[Endpoint],
+        strategy: str = "least_loaded",
+        failure_threshold: int = 3,
+        cooldown: float = 60.0,
+        hedge: bool = False,
+        hedge_min_samples: int = 20,
+    ):
+        if not endpoints:
+            raise ValueError("端点列表为空")
+        self.endpoints = endpoints
+        self.strategy = strategy
+        self.failure_threshold = max(1, failure_threshold)
+        self.cooldown = cooldown
+        self.hedge = hedge and len(endpoints) > 1
+        self.hedge_min_samples = hedge_min_samples
+        self._lock = threading.Lock()
+
+    def _available(self, ep: Endpoint, now: float) -> bool:
+        if ep.open_until <= 0:
+            return True
+        if now < ep.open_until:
+            return False
+        # 冷却结束：半开状态，只放行一个试探请求
+        return not ep.half_open_probe
+
+    def acquire(self, exclude: tuple[Endpoint, ...] = ()) -> Endpoint | None:
+        """选择一个可用端点并计入在途请求；全部熔断时返回 None。"""
+        with self._lock:
+            now = time.monotonic()
+            candidates = [ep for ep in self.endpoints
+                          if ep not in exclude and self._available(ep, now)]
+            if not candidates:
+                return None
+            if self.strategy == "weighted":
+                ep = random.choices(candidates, weights=[max(c.weight, 0.01) for c in candidates])[0]
+            else:
+                ep = min(candidates, key=lambda c: (c.in_flight + 1) / max(c.weight, 0.01))
+            if ep.open_until > 0:
+                ep.half_open_probe = True
+            ep.in_flight += 1
+            return ep
+
+    def release(self, ep: Endpoint, latency: float | None, error: BaseException | None):
+        """
+        请求结束后归还端点。成功时记录延迟并关闭熔断；
+        可重试失败累计次数，达到阈值时熔断；取消（CancelledError）不计入健康状态。
+        """
+        with self._lock:
+            ep.in_flight = max(0, ep.in_flight - 1)
+            if isinstance(error, concurrent.futures.CancelledError):
+                ep.half_open_probe = False
+                return
+            if error is None or not is_retryable(error):
+                if latency is not None and error is None:
+                    ep.latencies.append(latency)
+                ep.consecutive_failures = 0
+                ep.open_until = 0.0
+                ep.half_open_probe = False
+                return
+            ep.consecutive_failures += 1
+            ep.half_open_probe = False
+            if ep.consecutive_failures >= self.failure_threshold:
+                ep.open_until = time.monotonic() + self.cooldown
+                logger.warning("端点 %s 连续失败 %d 次，熔断 %.0fs",
+                               ep.name, ep.consecutive_failures, self.cooldown)
+
+    def hedge_delay(self, ep: Endpoint) -> float | None:
+        """返回触发对冲前的等待秒数（该端点的 p95）；样本不足或未开启对冲时返回 None。"""
+        if not self.hedge or len(ep.latencies) < self.hedge_min_samples:
+            return None
+        return ep.p95()
+
+
+def _submit(ep: Endpoint, payload: dict, timeout: float) -> concurrent.futures.Future:
+    headers = {"Content-Type": "application/json"}
+    if ep.api_key:
+        headers["Authorization"] = f"Bearer {ep.api_key}"
+    url = f"{ep.base_url.rstrip('/')}/chat/completions"
+    return submit_post(url, {**payload, "model": ep.model}, headers, timeout)
+
+
+def chat_completion(pool: EndpointPool, payload: dict, timeout: float = 180.0) -> tuple[dict, Endpoint]:
+    """
+    通过端点池发送 Chat Completions 请求（payload 中的 model 由端点决定）。
+    - 超过端点 p95 未返回时对冲到另一端点，先成功者胜出，其余请求取消；
+    - 可重试失败时换一个端点再试一次。
+    返回 (响应 JSON, 实际应答的端点)；全部失败时抛出最后一个异常，运行被取消时抛出 RunCancelled。
+    """
+    token = current_token()
+    tried: list[Endpoint] = []
+    last_error: BaseException | None = None
+
+    for _attempt in range(2):
+        # 超时不超过运行剩余时间；运行已取消时抛出 RunCancelled
+        request_timeout = token.timeout(timeout)
+        ep = pool.acquire(exclude=tuple(tried))
+        if ep is None:
+            break
+        tried.append(ep)
+        inflight: dict[concurrent.futures.Future, tuple[Endpoint, float]] = {
+            _submit(ep, payload, request_timeout): (ep, time.monotonic()),
+        }
+        # 取消回调在 SIGINT / 截止计时器线程中执行，与本线程对 inflight 的增删共用一把锁
+        inflight_lock = threading.Lock()
+
+        def cancel_inflight():
+            with inflight_lock:
+                pending = list(inflight)
+            for fut in pending:
+                fut.cancel()
+
+        # 运行取消时中止全部在途请求（等待随之返回）
+        unregister = token.register(cancel_inflight)
+
+        winner: tuple[dict, Endpoint] | None = None
+        try:
+            delay = pool.hedge_delay(ep)
+            if delay is not None:
+                done, _ = concurrent.futures.wait(inflight, timeout=delay)
+                if not done and not token.cancelled:
+                    backup = pool.acquire(exclude=tuple(tried))
+                    if backup is not None:
+                        logger.info("请求超过端点 %s 的 p95 (%.1fs)，对冲至 %s", ep.name, delay, backup.name)
+                        tried.append(backup)
+                        backup_future = _submit(backup, payload, request_timeout)
+                        with inflight_lock:
+                            inflight[backup_future] = (backup, time.monotonic())
+                        # 回调可能已在加入前执行过（快照中没有这个请求）
+                        if token.cancelled:
+                            backup_future.cancel()
+
+            while inflight and winner is None:
+                with inflight_lock:
+                    waiting = list(inflight)
+                done, _ = concurrent.futures.wait(waiting, return_when=concurrent.futures.FIRST_COMPLETED)
+                for fut in done:
+                    with inflight_lock:
+                        fut_ep, started = inflight.pop(fut)
+                    if fut.cancelled():
+                        pool.release(fut_ep, None, concurrent.futures.CancelledError())
+                        continue
+                    error = fut.exception()
+                    pool.release(fut_ep, time.monotonic() - started, error)
+                    if error is None and winner is None:
+                        winner = (fut.result(), fut_ep)
+                    elif error is not None:
+                        last_error = error
+        finally:
+            unregister()
+
+        # 取消落败的对冲请求
+        for fut, (fut_ep, _started) in inflight.items():
+            fut.cancel()
+            pool.release(fut_ep, None, concurrent.futures.CancelledError())
+
+        if winner is not None:
+            return winner
+        token.check()
+        if last_error is not None and not is_retryable(last_error):
+            break
+
+    if last_error is not None:
+        raise last_error
+    raise RuntimeError("没有可用的 AI 端点（全部处于熔断状态）")
+
+
+def load_endpoints() -> list[Endpoint]:
+    """
+    解析 AI_ENDPOINTS（JSON 数组）：
+        [{"name": "gw1", "base_url": "...", "api_key": "...", "model": "...", "weight": 2}, ...]
+    base_url / api_key / model 缺省时取 AI_API_BASE_URL / AI_API_KEY / AI_MODEL。
+    未配置时返回由主配置组成的单个端点。
+    """
+    if not AI_ENDPOINTS:
+        return [Endpoint("default", AI_API_BASE_URL, AI_API_KEY, AI_MODEL)]
+    try:
+        items = json.loads(AI_ENDPOINTS)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"AI_ENDPOINTS 不是合法 JSON: {e}") from e
+    if not isinstance(items, list) or not items:
+        raise ValueError("AI_ENDPOINTS 必须是非空 JSON 数组")
+    endpoints = []
+    for i, item in enumerate(items):
+        if not isinstance(item, dict):
+            raise ValueError(f"AI_ENDPOINTS[{i}] 必须是 JSON 对象，实际为 {item!r}")
+        try:
+            weight = float(item.get("weight", 1.0))
+        except (TypeError, ValueError):
+            raise ValueError(f"AI_ENDPOINTS[{i}] 的 weight 不是数字: {item.get('weight')!r}") from None
+        endpoints.append(Endpoint(
+            name=str(item.get("name") or f"ep{i}"),
+            base_url=str(item.get("base_url") or AI_API_BASE_URL),
+            api_key=str(item.get("api_key") or AI_API_KEY),
+            model=str(item.get("model") or AI_MODEL),
+            weight=weight,
+        ))
+    return endpoints
+
+
+_default_pool: EndpointPool | None = None
+_default_pool_lock = threading.Lock()
+
+
+def get_default_pool() -> EndpointPool:
+    """按配置构建的共享端点池（进程内单例）。"""
+    global _default_pool
+    if _default_pool is None:
+        with _default_pool_lock:
+            if _default_pool is None:
+                _default_pool = EndpointPool(
+                    load_endpoints(),
+                    strategy=AI_ENDPOINT_STRATEGY,
+                    failure_threshold=AI_CIRCUIT_FAILURES,
+                    cooldown=AI_CIRCUIT_COOLDOWN,
+                    hedge=AI_HEDGE,
+                    hedge_min_samples=AI_HEDGE_MIN_SAMPLES,
+                )
+                logger.info("AI 端点: %s (策略 %s%s)",
+                            ", ".join(ep.name for ep in _default_pool.endpoints),
+                            _default_pool.strategy, ", 对冲" if _default_pool.hedge else "")
+    return _default_pool
@@ -0,0 +1,260 @@
+"""
+P4-AI-Reviewer — 审查意见解析
+从模型返回的审查意见中提取逐条问题（行号、严重程度、维度、说明）与整体结论，
+支持 Markdown 文本与结构化 JSON 两种输出；并提供跨文件聚合、去重与 CI 判定。
+"""
+import json
+import re
+from dataclasses import dataclass
+
+SEVERITY_MARKERS = {
+    "🔴": "critical",
+    "🟡": "warning",
+    "🔵": "suggestion",
+}
+
+# 严重程度排序权重（越大越严重）
+SEVERITY_RANK = {"critical": 3, "warning": 2, "suggestion": 1}
+
+SEVERITY_EMOJI = {severity: marker for marker, severity in SEVERITY_MARKERS.items()}
+
+# 整体结论
+VERDICT_CLEAN = "clean"      # 「✅ 无问题」
+VERDICT_ISSUES = "issues"    # 至少一条问题
+VERDICT_UNKNOWN = "unknown"  # 既无问题标记也无「无问题」结论（格式异常或审查失败）
+
+_CLEAN_RE = re.compile(r"✅\s*\**\s*无问题")
+
+# 「第 42 行」「第 42-45 行」「第42、43行」「L42」「Line 42」「行 42」
+_LINE_PATTERNS = [
+    re.compile(r"第\s*(\d+)\s*(?:[-~～–—至到、,，]\s*\d+\s*)*行"),
+    re.compile(r"\b[Ll]ine\s*(\d+)"),
+    re.compile(r"\bL(\d+)\b"),
+    re.compile(r"行号?\s*[:：]?\s*(\d+)"),
+]
+
+_HEADING_RE = re.compile(r"^\s*#{1,6}\s*(.+?)\s*#*\s*$")
+_BOLD_HEADING_RE = re.compile(r"^\s*\*\*([^*]+?)\*\*\s*[:：]?\s*$")
+_BULLET_RE = re.compile(r"^\s*(?:[-*+]|\d+[.)、])\s+")
+# 去掉行首的「**第 42 行**:」「第 42 行：」之类的前缀
+_LINE_PREFIX_RE = re.compile(
+    r"^\s*\**\s*(?:第\s*\d+\s*(?:[-~～–—至到、,，]\s*\d+\s*)*行|[Ll]ine\s*\d+(?:\s*-\s*\d+)?|L\d+)\s*\**\s*[:：]?\s*"
+)
+
+
+@dataclass
+class Finding:
+    """单条审查问题"""
+    severity: str          # critical / warning / suggestion
+    line: int | None       # 基于 Diff 的行号（无法识别时为 None）
+    dimension: str         # 所属维度标题（如「内存管理」），无标题时为空
+    text: str              # 问题说明
+
+    def to_dict(self) -> dict:
+        return {
+            "line": self.line,
+            "severity": self.severity,
+            "dimension": self.dimension,
+            "text": self.text,
+        }
+
+
+def _severity_of(line: str) -> str | None:
+    for marker, severity in SEVERITY_MARKERS.items():
+        if marker in line:
+            return severity
+    return None
+
+
+def _line_number_of(line: str) -> int | None:
+    for pattern in _LINE_PATTERNS:
+        m = pattern.search(line)
+        if m:
+            return int(m.group(1))
+    return None
+
+
+def _clean_text(line: str) -> str:
+    text = _BULLET_RE.sub("", line, count=1)
+    for marker in SEVERITY_MARKERS:
+        text = text.replace(marker, "")
+    text = text.strip()
+    # 去掉严重程度文字标签（如「严重：」「**警告**」）
+    text = re.sub(r"^(?:\*\*\s*(?:严重|警告|建议)\s*\*\*\s*[:：]?|(?:严重|警告|建议)\s*[:：])\s*", "", text)
+    text = _LINE_PREFIX_RE.sub("", text)
+    return text.strip()
+
+
+def parse_findings(review_comment: str) -> list[Finding]:
+    """
+    解析审查意见为 Finding 列表。
+    含 🔴/🟡/🔵 的行视为一条问题；紧随其后、缩进且不含标记的行视为该问题的补充说明；
+    标题行（Markdown 标题或单独的粗体行）作为后续问题的维度。标题中带标记且没有行号时
+    （如「### 🔴 严重问题」）是分级小节而不是问题，小节内不带标记的列表项按小节的严重程度计入。
+    """
+    findings: list[Finding] = []
+    dimension = ""
+    section_severity: str | None = None
+    current: Finding | None = None
+
+    for raw_line in (review_comment or "").splitlines():
+        if not raw_line.strip():
+            current = None
+            continue
+        severity = _severity_of(raw_line)
+        heading = _HEADING_RE.match(raw_line) or _BOLD_HEADING_RE.match(raw_line)
+        if heading and (severity is None or _line_number_of(raw_line) is None):
+            if severity is None:
+                dimension = heading.group(1).strip().strip("*").strip()
+            section_severity = severity
+            current = None
+            continue
+        if severity is None:
+            if section_severity and _BULLET_RE.match(raw_line) and not _is_empty_item(raw_line):
+                severity = section_severity
+            else:
+                if current is not None and raw_line[:1] in (" ", "\t"):
+                    current.text = f"{current.text} {raw_line.strip()}".strip()
+                continue
+        current = Finding(
+            severity=severity,
+            line=_line_number_of(raw_line),
+            dimension=dimension,
+            text=_clean_text(heading.group(1) if heading else raw_line),
+        )
+        findings.append(current)
+    return findings
+
+
+def _is_empty_item(line: str) -> bool:
+    """分级小节下「- 无」「- ✅ 无问题」之类的占位列表项。"""
+    text = _clean_text(line).strip("*。. ")
+    return not text or text in ("无", "暂无", "N/A", "None") or bool(_CLEAN_RE.search(line))
+
+
+def count_by_severity(findings: list[Finding]) -> dict[str, int]:
+    """按严重程度计数，三个等级总是出现在结果中。"""
+    counts = {severity: 0 for severity in SEVERITY_RANK}
+    for f in findings:
+        counts[f.severity] += 1
+    return counts
+
+
+def detect_verdict(review_comment: str, findings: list[Finding]) -> str:
+    """根据问题列表与「✅ 无问题」标记判断整体结论；存在问题时以问题为准。"""
+    if findings:
+        return VERDICT_ISSUES
+    if _CLEAN_RE.search(review_comment or ""):
+        return VERDICT_CLEAN
+    return VERDICT_UNKNOWN
+
+
+# ============================================================
+# 结构化（JSON）输出
+# ============================================================
+
+# JSON 模式下追加到系统提示词的输出格式约定
+STRUCTURED_OUTPUT_INSTRUCTION = """
+输出格式（JSON 模式，覆盖上文的 Markdown 输出要求，其余规则不变）：
+只输出一个 JSON 对象，不要代码块或其他文字：
+{"verdict": "clean" 或 "issues", "findings": [{"line": 行号或 null, "severity": "critical" | "warning" | "suggestion", "dimension": "维度，如 内存管理", "message": "中文简要说明"}]}
+无问题时输出 {"verdict": "clean", "findings": []}。
+"""
+
+
+def parse_structured(content: str) -> tuple[str, list[Finding]] | None:
+    """
+    解析 JSON 模式的返回。成功时返回 (verdict, findings)，格式不符时返回 None（调用方回退为文本解析）。
+    兼容模型在 JSON 外包裹 ```json 代码块的情况。
+    """
+    text = (content or "").strip()
+    if text.startswith("```"):
+        text = re.sub(r"^```[a-zA-Z]*\s*|\s*```$", "", text)
+    try:
+        data = json.loads(text)
+    except (json.JSONDecodeError, ValueError):
+        return None
+    if not isinstance(data, dict) or not isinstance(data.get("findings", []), list):
+        return None
+
+    findings: list[Finding] = []
+    for item in data.get("findings", []):
+        if not isinstance(item, dict):
+            continue
+        severity = str(item.get("severity", "")).strip().lower()
+        if severity not in SEVERITY_RANK:
+            severity = SEVERITY_MARKERS.get(severity, "suggestion")
+        line = item.get("line")
+        try:
+            line = int(line) if line is not None else None
+        except (TypeError, ValueError):
+            line = None
+        findings.append(Finding(
+            severity=severity,
+            line=line,
+            dimension=str(item.get("dimension") or "").strip(),
+            text=str(item.get("message") or item.get("text") or "").strip(),
+        ))
+    verdict = VERDICT_ISSUES if findings else (
+        VERDICT_CLEAN if data.get("verdict") == VERDICT_CLEAN else VERDICT_UNKNOWN)
+    return verdict, findings
+
+
+def render_markdown(verdict: str, findings: list[Finding]) -> str:
+    """将结构化结果渲染为与文本模式一致的 Markdown（按维度分组），供报告展示。"""
+    if not findings:
+        return "✅ 无问题" if verdict == VERDICT_CLEAN else ""
+    lines: list[str] = []
+    groups: dict[str, list[Finding]] = {}
+    for f in findings:
+        groups.setdefault(f.dimension, []).append(f)
+    for dimension, items in groups.items():
+        if dimension:
+            lines.append(f"### {dimension}")
+        for f in items:
+            where = f"**第 {f.line} 行**: " if f.line is not None else ""
+            lines.append(f"- {SEVERITY_EMOJI[f.severity]} {where}{f.text}")
+        lines.append("")
+    return "\n".join(lines).strip()
+
+
+# ============================================================
+# 跨文件聚合与 CI 判定
+# ============================================================
+
+@dataclass
+class AggregatedFinding:
+    """跨文件去重后的问题：同一严重程度 + 维度 + 说明视为同一问题"""
+    severity: str
+    dimension: str
+    text: str
+    locations: list[tuple[str, int | None]]   # [(depot_path, line), ...]
+
+
+def _normalize_text(text: str) -> str:
+    return re.sub(r"\s+", " ", text).strip().rstrip("。.;；").lower()
+
+
+def aggregate_findings(per_file: list[tuple[str, list[Finding]]]) -> list[AggregatedFinding]:
+    """
+    聚合多个文件的问题并去重，按严重程度降序、出现次数降序排序。
+    per_file: [(depot_path, findings), ...]
+    """
+    merged: dict[tuple[str, str, str], AggregatedFinding] = {}
+    for depot_path, findings in per_file:
+        for f in findings:
+            key = (f.severity, f.dimension, _normalize_text(f.text))
+            agg = merged.get(key)
+            if agg is None:
+                agg = merged[key] = AggregatedFinding(f.severity, f.dimension, f.text, [])
+            agg.locations.append((depot_path, f.line))
+    return sorted(
+        merged.values(),
+        key=lambda a: (-SEVERITY_RANK[a.severity], -len(a.locations)),
+    )
+
+
+def exceeds_threshold(findings: list[Finding], fail_on: str) -> bool:
+    """是否存在严重程度 >= fail_on 的问题（用于 CI 判定）。"""
+    threshold = SEVERITY_RANK[fail_on]
+    return any(SEVERITY_RANK[f.severity] >= threshold for f in findings)
@@ -0,0 +1,83 @@
+"""
+P4-AI-Reviewer — 共享 HTTP 客户端
+后台线程运行一个 asyncio 事件循环与共享的 httpx.AsyncClient（连接池复用）。
+同步代码通过 submit_post() 得到 concurrent.futures.Future：
+    - future.result() 等待结果；
+    - future.cancel() 会真正取消事件循环中的请求并关闭连接（用于对冲请求与中断）。
+"""
+import asyncio
+import concurrent.futures
+import logging
+import threading
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+
+class _HttpRunner:
+    """后台事件循环线程 + 共享 AsyncClient"""
+
+    def __init__(self):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name="http-client-loop", daemon=True
+        )
+        self._thread.start()
+        self._client = asyncio.run_coroutine_threadsafe(self._create_client(), self._loop).result()
+
+    @staticmethod
+    async def _create_client() -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            timeout=180.0,
+            limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+        )
+
+    async def _post_json(self, url: str, payload: dict, headers: dict, timeout: float) -> dict:
+        response = await self._client.post(url, json=payload, headers=headers, timeout=timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def submit_post(
+        self, url: str, payload: dict, headers: dict, timeout: float
+    ) -> concurrent.futures.Future:
+        return asyncio.run_coroutine_threadsafe(
+            self._post_json(url, payload, headers, timeout), self._loop
+        )
+
+    def close(self):
+        try:
+            asyncio.run_coroutine_threadsafe(self._client.aclose(), self._loop).result(timeout=5)
+        except Exception as e:
+            logger.debug("关闭 HTTP 客户端异常: %s", e)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=5)
+
+
+_runner: _HttpRunner | None = None
+_runner_lock = threading.Lock()
+
+
+def _get_runner() -> _HttpRunner:
+    global _runner
+    if _runner is None:
+        with _runner_lock:
+            if _runner is None:
+                _runner = _HttpRunner()
+    return _runner
+
+
+def submit_post(
+    url: str, payload: dict, headers: dict, timeout: float = 180.0
+) -> concurrent.futures.Future:
+    """异步提交 POST JSON 请求，返回可取消的 Future（结果为响应 JSON，HTTP 错误时抛出 httpx.HTTPStatusError）。"""
+    return _get_runner().submit_post(url, payload, headers, timeout)
+
+
+def close_http_client():
+    """关闭共享 HTTP 客户端与事件循环（服务退出时调用）。"""
+    global _runner
+    with _runner_lock:
+        if _runner is not None:
+            _runner.close()
+            _runner = None
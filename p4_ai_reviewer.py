@@ -6,27 +6,34 @@ Perforce AI 代码审查助手
 用法:
     python p4_ai_reviewer.py local              # 审查本地未提交修改
     python p4_ai_reviewer.py 12345              # 审查指定 CL
+    python p4_ai_reviewer.py shelved:12345      # 审查 shelve 在 CL 中的文件（提交前）
+    python p4_ai_reviewer.py //depot/Engine/...@100,@200 [--combined]  # 审查范围内已提交的 CL
     python p4_ai_reviewer.py local -o report.md # 自定义输出路径
+    python p4_ai_reviewer.py local --watch      # 监视本地修改，增量审查
+    python p4_ai_reviewer.py serve              # 服务模式（HTTP API + 任务队列）
+    python p4_ai_reviewer.py query --path //depot/Engine/ --severity critical  # 检索历史审查结果
+    python p4_ai_reviewer.py 12345 --shard 1/4  # 分片审查（各 CI 节点各跑一片）
+    python p4_ai_reviewer.py merge reports/*.shard-*.json -o report.md  # 合并分片结果
+    python p4_ai_reviewer.py index D:/Workspace/Source  # 建立/增量更新符号索引
 """
+from __future__ import annotations
+
 import argparse
 import logging
+import re
 import sys
 import os
-from datetime import datetime
+import time
+from typing import TYPE_CHECKING, Callable
 
 # 确保模块可以被找到
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-from config import REPORT_OUTPUT_PATH, REPORT_OUTPUT_DIR, MAX_FILES_PER_RUN
-from p4_client import (
-    get_diff_local,
-    get_diff_cl,
-    get_file_content_local,
-    get_file_content_cl,
-)
-from diff_parser import parse_local_diff, parse_cl_describe, FileDiff
-from ai_reviewer import review_files_batch
-from report_generator import generate_report
+# 业务模块在各函数内按需导入：--help、参数错误、空 Diff 等提前退出的调用
+# 不必加载 .env、httpx、SQLite 等（提交触发器高频调用时启动开销明显），见 startup_benchmark.py
+if TYPE_CHECKING:
+    from ai_reviewer import ReviewResult
+    from diff_parser import FileDiff
 
 
 def setup_logging(verbose: bool = False):
@@ -39,160 +46,591 @@ def setup_logging(verbose: bool = False):
     )
 
 
-def run_local_mode(output_path: str):
+def _split_by_limit(code_diffs: list[FileDiff]) -> tuple[list[FileDiff], list[FileDiff]]:
     """
-    本地模式：审查工作区中未提交的修改。
+    按 MAX_FILES_PER_RUN 拆分为（本次审查, 因限制未审查）两部分。
     """
+    from config import MAX_FILES_PER_RUN
+
     logger = logging.getLogger("main")
+    if MAX_FILES_PER_RUN > 0 and len(code_diffs) > MAX_FILES_PER_RUN:
+        logger.info("共 %d 个代码文件，因 MAX_FILES_PER_RUN=%d 仅审查前 %d 个",
+                    len(code_diffs), MAX_FILES_PER_RUN, MAX_FILES_PER_RUN)
+        return code_diffs[:MAX_FILES_PER_RUN], code_diffs[MAX_FILES_PER_RUN:]
+    return code_diffs, []
 
-    # 1. 获取 diff
-    logger.info("=" * 60)
-    logger.info("P4-AI-Reviewer — 本地模式")
-    logger.info("=" * 60)
 
-    raw_diff = get_diff_local()
-    if not raw_diff.strip():
-        logger.warning("没有检测到本地未提交的修改。")
-        print("\n✅ 没有检测到本地未提交的修改，无需审查。")
-        return
+def _fetch_content_local(fd: FileDiff) -> str | None:
+    """本地模式：优先使用 local_path，否则尝试 depot_path。"""
+    from p4_client import get_file_content_local
+
+    if fd.local_path:
+        return get_file_content_local(fd.local_path)
+    if fd.depot_path:
+        return get_file_content_local(fd.depot_path)
+    return None
+
+
+def _fetch_content_cl(fd: FileDiff) -> str | None:
+    """CL 模式：删除的文件无快照可取。"""
+    from p4_client import get_file_content_cl
+
+    if fd.action == "delete":
+        return None
+    return get_file_content_cl(fd.depot_path, fd.cl_number)
+
+
+def _fetch_content_shelved(fd: FileDiff) -> str | None:
+    """Shelved 模式：取 shelve 中的文件版本；删除的文件无内容可取。"""
+    from p4_client import get_file_content_shelved
+
+    if fd.action == "delete":
+        return None
+    return get_file_content_shelved(fd.depot_path, fd.cl_number)
+
+
+def collect_cl_diffs(cl_numbers: list[str], shelved: bool = False) -> list[FileDiff]:
+    """
+    逐个 CL 获取 describe 输出并解析，返回所有文件 diff（带 cl_number）。
+    shelved=True 时取 shelve 在 CL 中的文件（p4 describe -S）。
+    """
+    from p4_client import get_diff_cl, get_diff_shelved
+
+    logger = logging.getLogger("main")
+    all_file_diffs: list[FileDiff] = []
+    for cl_num in cl_numbers:
+        raw_describe = get_diff_shelved(cl_num) if shelved else get_diff_cl(cl_num)
+        if not raw_describe.strip():
+            logger.warning("CL %s 的 describe 输出为空，跳过。", cl_num)
+            continue
+        # 空 CL（提交触发器最常见的调用）不需要解析器，推迟到确有输出时再导入
+        from diff_parser import parse_cl_describe
+
+        file_diffs = parse_cl_describe(raw_describe)
+        for fd in file_diffs:
+            fd.cl_number = cl_num
+            all_file_diffs.append(fd)
+    return all_file_diffs
+
+
+# 范围目标: //depot/path/...@100,@200（起止可为 CL 号、日期、标签等 p4 版本标识）
+_RANGE_TARGET_RE = re.compile(r"^(//[^@]+)@([^,@]+),@?([^,@]+)$")
 
-    # 2. 解析 diff
-    file_diffs = parse_local_diff(raw_diff)
-    if not file_diffs:
-        logger.warning("Diff 解析结果为空。")
-        print("\n✅ Diff 解析结果为空，无需审查。")
-        return
 
+def parse_range_target(target: str) -> tuple[str, str, str] | None:
+    """解析范围目标，返回 (路径通配, 起, 止)；不是范围目标时返回 None。"""
+    m = _RANGE_TARGET_RE.match(target.strip())
+    return (m.group(1), m.group(2), m.group(3)) if m else None
+
+
+def collect_range_diffs(path_spec: str, start: str, end: str) -> tuple[list[FileDiff], list[str]]:
+    """
+    列出范围内影响 path_spec 的已提交 CL，批量获取 describe 并解析。
+    只保留 path_spec 范围内的文件。返回 (文件 diff 列表, CL 列表)。
+    """
+    from diff_parser import filespec_matcher, parse_cl_describe, split_describe_output
+    from p4_client import get_describe_bulk, get_submitted_changes, server_case_insensitive
+
+    cl_numbers = get_submitted_changes(f"{path_spec}@{start},@{end}")
+    if not cl_numbers:
+        return [], []
+    in_scope = filespec_matcher(path_spec, case_insensitive=server_case_insensitive())
+    file_diffs: list[FileDiff] = []
+    for cl_num, raw_describe in split_describe_output(get_describe_bulk(cl_numbers)):
+        for fd in parse_cl_describe(raw_describe):
+            if in_scope(fd.depot_path):
+                fd.cl_number = cl_num
+                file_diffs.append(fd)
+    return file_diffs, cl_numbers
+
+
+def collect_combined_diffs(path_spec: str, start: str, end: str) -> tuple[list[FileDiff], list[str]]:
+    """
+    合并 Diff：比较范围内第一个 CL 之前与最后一个 CL 时的文件状态 (p4 diff2)，
+    多次修改的文件只出现一次（对比最终状态）。文件 cl_number 记为最后一个 CL，全量内容取该版本。
+    返回 (文件 diff 列表, CL 列表)。
+    """
+    from diff_parser import parse_diff2
+    from p4_client import get_diff2, get_submitted_changes
+
+    cl_numbers = get_submitted_changes(f"{path_spec}@{start},@{end}")
+    if not cl_numbers:
+        return [], []
+    first, last = cl_numbers[0], cl_numbers[-1]
+    file_diffs = parse_diff2(get_diff2(f"{path_spec}@{int(first) - 1}", f"{path_spec}@{last}"))
+    for fd in file_diffs:
+        fd.cl_number = last
+    return file_diffs, cl_numbers
+
+
+def review_and_report(
+    mode: str,
+    cl_display: str | None,
+    file_diffs: list[FileDiff],
+    output_path: str,
+    fetch_content: Callable[[FileDiff], str | None],
+    *,
+    formats: list[str] | None = None,
+    include_diff: bool | None = None,
+    shard: tuple[int, int] | None = None,
+) -> tuple[list[FileDiff], list[ReviewResult], list[FileDiff], list[str]]:
+    """
+    过滤代码文件 → 获取全量内容 → AI 审查 → 生成报告。
+    formats 为报告输出格式列表（None 时取 REPORT_FORMATS），include_diff 控制 Markdown 是否嵌入 Diff。
+    shard=(i, N) 时只审查第 i 片，写出分片结果 JSON（不生成报告，由 merge 汇总）。
+    返回 (实际审查的文件, 审查结果, 因限制未审查的文件, 实际写入的报告路径)；分片时报告路径为空。
+    """
+    from ai_reviewer import review_files_batch
+    from config import DEDUP_ENABLED, DEDUP_MIN_LINES, DEDUP_SIMILARITY, REPORT_FORMATS
+    from deadline import RunCancelled, current_token
+    from diff_similarity import DuplicateGroup, expand_group_results, group_duplicates
+    from report_generator import write_reports
+    from review_store import record_results
+    from shard import partial_path_for, select_shard, write_partial
+
+    formats = formats or REPORT_FORMATS
+    logger = logging.getLogger("main")
     code_diffs = [f for f in file_diffs if f.is_code_file]
-    if MAX_FILES_PER_RUN > 0 and len(code_diffs) > MAX_FILES_PER_RUN:
-        code_diffs_to_review = code_diffs[:MAX_FILES_PER_RUN]
-        skipped_by_limit = code_diffs[MAX_FILES_PER_RUN:]
-        logger.info("共 %d 个代码文件，因 MAX_FILES_PER_RUN=%d 仅审查前 %d 个",
-                    len(code_diffs), MAX_FILES_PER_RUN, len(code_diffs_to_review))
-    else:
-        code_diffs_to_review = code_diffs
-        skipped_by_limit = []
+    code_diffs_to_review, skipped_by_limit = _split_by_limit(code_diffs)
 
     logger.info("共 %d 个变更文件, %d 个代码文件需要审查",
                 len(file_diffs), len(code_diffs))
 
-    if not code_diffs:
+    if not code_diffs and shard is None:
         logger.info("没有需要审查的代码文件。")
-        generate_report("local", None, file_diffs, [], output_path)
-        print(f"\n📄 报告已生成: {output_path}")
-        return
+        report_paths = write_reports(formats, mode, cl_display, file_diffs, [], output_path,
+                                     include_diff=include_diff)
+        return [], [], [], report_paths
 
-    # 3. 获取全量文件内容并组装数据
+    # 重复变更只审查代表文件（也省去成员的全量内容获取）
+    if DEDUP_ENABLED:
+        groups = group_duplicates(code_diffs_to_review, DEDUP_SIMILARITY, DEDUP_MIN_LINES)
+    else:
+        groups = [DuplicateGroup(representative=fd, members=[]) for fd in code_diffs_to_review]
+    if shard is not None:
+        groups = select_shard(groups, *shard)
+        mine = {id(g.representative) for g in groups}
+        mine.update(id(m) for g in groups for m, _ in g.members)
+        code_diffs_to_review = [fd for fd in code_diffs_to_review if id(fd) in mine]
+    representatives = [g.representative for g in groups]
+
+    # 获取全量文件内容并组装数据（运行已取消时不再获取，这些文件随后标记为未完成）
+    token = current_token()
     file_data: list[tuple[str, str, str | None]] = []
-    for fd in code_diffs_to_review:
-        full_content = None
-        # 优先使用 local_path，否则尝试 depot_path
-        if fd.local_path:
-            full_content = get_file_content_local(fd.local_path)
-        elif fd.depot_path:
-            full_content = get_file_content_local(fd.depot_path)
-        file_data.append((fd.depot_path, fd.diff_text, full_content))
-
-    # 4. 调用 AI 审查
+    for fd in representatives:
+        content = None
+        if not token.cancelled:
+            try:
+                content = fetch_content(fd)
+            except RunCancelled:
+                pass
+        file_data.append((fd.depot_path, fd.diff_text, content))
+
+    # 调用 AI 审查
     logger.info("开始 AI 审查 (%d 个文件) ...", len(file_data))
     results = review_files_batch(file_data)
+    results = expand_group_results(groups, results, code_diffs_to_review)
+    record_results(mode, code_diffs_to_review, results)
 
-    # 5. 生成报告
-    generate_report(
-        "local", None, file_diffs, results, output_path,
+    if shard is not None:
+        write_partial(partial_path_for(output_path, *shard), mode, cl_display, file_diffs,
+                      code_diffs_to_review, results, skipped_by_limit, shard)
+        return code_diffs_to_review, results, skipped_by_limit, []
+
+    # 生成报告
+    report_paths = write_reports(
+        formats, mode, cl_display, file_diffs, results, output_path,
         reviewed_code_files=code_diffs_to_review,
         skipped_by_limit=skipped_by_limit if skipped_by_limit else None,
+        include_diff=include_diff,
     )
+    return code_diffs_to_review, results, skipped_by_limit, report_paths
+
+
+def _print_report_paths(report_paths: list[str]):
+    """打印实际写入的报告（--format 只含 json / jsonl 时不会有 .md）。"""
+    print(f"\n📄 报告已生成: {', '.join(report_paths)}")
+
 
+def _print_summary(
+    title: str,
+    reviewed: list[FileDiff],
+    results: list[ReviewResult],
+    skipped_by_limit: list[FileDiff],
+    report_paths: list[str],
+):
+    """打印控制台汇总。"""
     success_count = sum(1 for r in results if not r.error)
-    fail_count = sum(1 for r in results if r.error)
+    fail_count = sum(1 for r in results if r.error and not r.unfinished)
+    unfinished_count = sum(1 for r in results if r.unfinished)
     print(f"\n{'=' * 60}")
-    print(f"  P4-AI-Reviewer 审查完成")
-    print(f"  审查文件: {len(code_diffs_to_review)} | 成功: {success_count} | 失败: {fail_count}", end="")
+    print(f"  {title}")
+    print(f"  审查文件: {len(reviewed)} | 成功: {success_count} | 失败: {fail_count}", end="")
+    if unfinished_count:
+        print(f" | 未完成: {unfinished_count}", end="")
     if skipped_by_limit:
         print(f" | 因限制未审查: {len(skipped_by_limit)}", end="")
     print()
-    print(f"  报告路径: {os.path.abspath(output_path)}")
+    print(f"  报告路径: {', '.join(os.path.abspath(p) for p in report_paths)}")
     print(f"{'=' * 60}")
 
 
-def run_cl_mode(cl_numbers: list[str], output_path: str):
+def run_local_mode(output_path: str, **report_options) -> list[ReviewResult]:
     """
-    CL 模式：审查指定变更列表（支持多个 CL）。
+    本地模式：审查工作区中未提交的修改。返回审查结果（供 --fail-on 判定）。
     """
+    from diff_parser import parse_local_diff
+    from p4_client import get_diff_local
+
     logger = logging.getLogger("main")
-    cl_display = ", ".join(cl_numbers)
 
+    # 1. 获取 diff
     logger.info("=" * 60)
-    logger.info("P4-AI-Reviewer — CL 模式 (CL: %s)", cl_display)
+    logger.info("P4-AI-Reviewer — 本地模式")
     logger.info("=" * 60)
 
-    # 1. 逐个 CL 获取 describe 输出并解析
-    all_file_diffs: list[FileDiff] = []
-    for cl_num in cl_numbers:
-        raw_describe = get_diff_cl(cl_num)
-        if not raw_describe.strip():
-            logger.warning("CL %s 的 describe 输出为空，跳过。", cl_num)
-            continue
-        file_diffs = parse_cl_describe(raw_describe)
-        for fd in file_diffs:
-            fd.cl_number = cl_num
-            all_file_diffs.append(fd)
+    raw_diff = get_diff_local()
+    if not raw_diff.strip():
+        logger.warning("没有检测到本地未提交的修改。")
+        print("\n✅ 没有检测到本地未提交的修改，无需审查。")
+        return []
 
-    if not all_file_diffs:
+    # 2. 解析 diff
+    file_diffs = parse_local_diff(raw_diff)
+    if not file_diffs:
+        logger.warning("Diff 解析结果为空。")
+        print("\n✅ Diff 解析结果为空，无需审查。")
+        return []
+
+    # 3. 审查并生成报告
+    reviewed, results, skipped_by_limit, report_paths = review_and_report(
+        "local", None, file_diffs, output_path, _fetch_content_local, **report_options,
+    )
+    if not reviewed:
+        _print_report_paths(report_paths)
+        return []
+    _print_summary("P4-AI-Reviewer 审查完成", reviewed, results, skipped_by_limit, report_paths)
+    return results
+
+
+def _review_changes(
+    title: str,
+    cl_display: str,
+    file_diffs: list[FileDiff],
+    output_path: str,
+    fetch_content: Callable[[FileDiff], str | None],
+    shard: tuple[int, int] | None,
+    report_options: dict,
+) -> list[ReviewResult]:
+    """CL / shelved / 范围模式共用：审查、写报告（或分片结果）并打印汇总。"""
+    from shard import partial_path_for
+
+    reviewed, results, skipped_by_limit, report_paths = review_and_report(
+        "cl", cl_display, file_diffs, output_path, fetch_content,
+        shard=shard, **report_options,
+    )
+    if shard is not None:
+        print(f"\n📦 分片 {shard[0]}/{shard[1]} 完成: 审查 {len(reviewed)} 个文件, "
+              f"结果已保存至 {partial_path_for(output_path, *shard)}")
+        return results
+    if not reviewed:
+        _print_report_paths(report_paths)
+        return []
+    _print_summary(title, reviewed, results, skipped_by_limit, report_paths)
+    return results
+
+
+def run_cl_mode(
+    cl_numbers: list[str],
+    output_path: str,
+    shard: tuple[int, int] | None = None,
+    shelved: bool = False,
+    **report_options,
+) -> list[ReviewResult]:
+    """
+    CL 模式：审查指定变更列表（支持多个 CL）。返回审查结果（供 --fail-on 判定）。
+    shelved=True 时审查 shelve 在 CL 中的文件（提交前检查）；
+    shard=(i, N) 时只审查第 i 片并写出分片结果。
+    """
+    logger = logging.getLogger("main")
+    cl_display = ", ".join(cl_numbers) + (" (shelved)" if shelved else "")
+
+    logger.info("=" * 60)
+    logger.info("P4-AI-Reviewer — %s模式 (CL: %s)", "Shelved " if shelved else "CL ", cl_display)
+    logger.info("=" * 60)
+
+    # 1. 逐个 CL 获取 describe 输出并解析
+    file_diffs = collect_cl_diffs(cl_numbers, shelved=shelved)
+    if not file_diffs:
         logger.warning("未解析到任何文件变更。")
         print(f"\n⚠️ CL {cl_display} 未解析到文件变更，请确认 CL 编号正确。")
-        return
+        return []
 
-    file_diffs = all_file_diffs
-    code_diffs = [f for f in file_diffs if f.is_code_file]
-    if MAX_FILES_PER_RUN > 0 and len(code_diffs) > MAX_FILES_PER_RUN:
-        code_diffs_to_review = code_diffs[:MAX_FILES_PER_RUN]
-        skipped_by_limit = code_diffs[MAX_FILES_PER_RUN:]
-        logger.info("共 %d 个代码文件，因 MAX_FILES_PER_RUN=%d 仅审查前 %d 个",
-                    len(code_diffs), MAX_FILES_PER_RUN, len(code_diffs_to_review))
-    else:
-        code_diffs_to_review = code_diffs
-        skipped_by_limit = []
+    # 2. 审查并生成报告
+    return _review_changes(
+        f"P4-AI-Reviewer 审查完成 (CL: {cl_display})", cl_display, file_diffs, output_path,
+        _fetch_content_shelved if shelved else _fetch_content_cl, shard, report_options,
+    )
 
-    logger.info("共 %d 个变更文件, %d 个代码文件需要审查",
-                len(file_diffs), len(code_diffs))
 
-    if not code_diffs:
-        logger.info("没有需要审查的代码文件。")
-        generate_report("cl", cl_display, file_diffs, [], output_path)
-        print(f"\n📄 报告已生成: {output_path}")
+def run_range_mode(
+    path_spec: str,
+    start: str,
+    end: str,
+    output_path: str,
+    combined: bool = False,
+    shard: tuple[int, int] | None = None,
+    **report_options,
+) -> list[ReviewResult]:
+    """
+    范围模式：审查 path_spec@start,@end 内的全部已提交 CL。
+    combined=False 时逐 CL 审查（同一文件多次修改各审查一次）；
+    combined=True 时用 p4 diff2 合并为一份 Diff，每个文件只按最终状态审查一次。
+    """
+    logger = logging.getLogger("main")
+    target = f"{path_spec}@{start},@{end}"
+
+    logger.info("=" * 60)
+    logger.info("P4-AI-Reviewer — 范围模式 (%s%s)", target, ", 合并 Diff" if combined else "")
+    logger.info("=" * 60)
+
+    collect = collect_combined_diffs if combined else collect_range_diffs
+    file_diffs, cl_numbers = collect(path_spec, start, end)
+    if not cl_numbers:
+        print(f"\n✅ {target} 范围内没有已提交的 CL，无需审查。")
+        return []
+    logger.info("范围内共 %d 个 CL (%s ~ %s)", len(cl_numbers), cl_numbers[0], cl_numbers[-1])
+    if not file_diffs:
+        print(f"\n✅ {target} 范围内没有文件变更，无需审查。")
+        return []
+
+    cl_display = f"{target} ({len(cl_numbers)} 个 CL{', 合并 Diff' if combined else ''})"
+    return _review_changes(
+        f"P4-AI-Reviewer 审查完成 ({cl_display})", cl_display, file_diffs, output_path,
+        _fetch_content_cl, shard, report_options,
+    )
+
+
+def _exit_on_findings(results: list[ReviewResult], fail_on: str):
+    """CI 门禁：存在 fail_on 及以上等级的问题时打印汇总并以退出码 2 结束。"""
+    from findings import exceeds_threshold
+
+    offending = [r for r in results if not r.error and exceeds_threshold(r.findings, fail_on)]
+    if offending:
+        print(f"\n❌ {len(offending)} 个文件存在 {fail_on} 及以上等级的问题:")
+        for r in offending:
+            print(f"   - {r.depot_path}")
+        sys.exit(2)
+
+
+def _review_cl_for_service(cl_numbers: list[str], output_path: str) -> dict:
+    """
+    服务模式下单个任务的执行体：审查 CL 并写报告，返回任务汇总。
+    """
+    file_diffs = collect_cl_diffs(cl_numbers)
+    if not file_diffs:
+        raise ValueError(f"CL {', '.join(cl_numbers)} 未解析到文件变更")
+    reviewed, results, skipped_by_limit, _report_paths = review_and_report(
+        "cl", ", ".join(cl_numbers), file_diffs, output_path, _fetch_content_cl,
+    )
+    return {
+        "files": len(file_diffs),
+        "reviewed": len(reviewed),
+        "succeeded": sum(1 for r in results if not r.error),
+        "failed": sum(1 for r in results if r.error),
+        "skipped_by_limit": len(skipped_by_limit),
+    }
+
+
+def _parse_duration(value: str) -> float:
+    """解析时长：纯数字为秒，或带 s / m / h 后缀（如 90s、10m、1h）。"""
+    text = value.strip().lower()
+    scale = {"s": 1, "m": 60, "h": 3600}.get(text[-1:], None)
+    number = text[:-1] if scale else text
+    try:
+        seconds = float(number) * (scale or 1)
+    except ValueError:
+        raise ValueError(f"无法解析时长: {value}（如 600、90s、10m、1h）") from None
+    if seconds <= 0:
+        raise ValueError(f"时长必须为正数: {value}")
+    return seconds
+
+
+def _parse_date(value: str) -> float:
+    """解析 YYYY-MM-DD 或 YYYY-MM-DD HH:MM:SS 为时间戳。"""
+    from datetime import datetime
+
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(value, fmt).timestamp()
+        except ValueError:
+            continue
+    raise ValueError(f"无法解析日期: {value}（格式: YYYY-MM-DD 或 'YYYY-MM-DD HH:MM:SS'）")
+
+
+def run_index_mode(roots: list[str]):
+    """建立/增量更新符号索引（SYMBOL_INDEX_PATH），roots 为空时取 SYMBOL_INDEX_ROOTS。"""
+    from config import SYMBOL_INDEX_PATH, SYMBOL_INDEX_ROOTS
+    from symbol_index import SymbolIndex
+
+    roots = roots or SYMBOL_INDEX_ROOTS
+    if not SYMBOL_INDEX_PATH:
+        print("⚠️  SYMBOL_INDEX_PATH 为空，符号索引已禁用。")
+        sys.exit(1)
+    if not roots:
+        print("⚠️  请指定要索引的目录，例如: index D:/Workspace/Engine/Source（或设置 SYMBOL_INDEX_ROOTS）")
+        sys.exit(1)
+    missing = [r for r in roots if not os.path.isdir(r)]
+    if missing:
+        print(f"⚠️  目录不存在: {', '.join(missing)}")
+        sys.exit(1)
+
+    start = time.time()
+    scanned, updated, removed = SymbolIndex(SYMBOL_INDEX_PATH).update(roots)
+    print(f"\n🔎 符号索引已更新: 扫描 {scanned} 个文件, 重新解析 {updated}, 移除 {removed}, "
+          f"耗时 {time.time() - start:.1f}s ({SYMBOL_INDEX_PATH})")
+
+
+def run_query_mode(args: argparse.Namespace):
+    """
+    查询模式：检索审查结果数据库中的历史记录。
+    """
+    import json
+    from dataclasses import asdict
+    from datetime import datetime
+
+    from review_store import SEVERITY_NAMES, get_default_store
+
+    store = get_default_store()
+    if store is None:
+        print("⚠️  REVIEW_STORE_PATH 为空，未启用审查结果数据库。")
+        sys.exit(1)
+
+    cl_min = cl_max = None
+    try:
+        if args.cl:
+            low, sep, high = args.cl.partition("-")
+            cl_min = int(low) if low else None
+            cl_max = int(high) if high else (None if sep else cl_min)
+        since = _parse_date(args.since) if args.since else None
+        until = _parse_date(args.until) if args.until else None
+    except ValueError as e:
+        print(f"⚠️  无效的查询参数: {e}")
+        sys.exit(1)
+
+    rows = store.query(
+        path_prefix=args.path,
+        cl_min=cl_min,
+        cl_max=cl_max,
+        min_severity=SEVERITY_NAMES[args.severity] if args.severity else None,
+        since=since,
+        until=until,
+        limit=args.limit,
+    )
+    if args.json:
+        for row in rows:
+            print(json.dumps(asdict(row), ensure_ascii=False))
         return
+    if not rows:
+        print("没有符合条件的记录。")
+        return
+    for row in rows:
+        when = datetime.fromtimestamp(row.created_at).strftime("%Y-%m-%d %H:%M")
+        cl = row.cl_number if row.cl_number is not None else "local"
+        status = f"⚠️ {row.error[:40]}" if row.error else (
+            f"🔴{row.critical} 🟡{row.warning} 🔵{row.suggestion}" + (" ✂️截断" if row.truncated else ""))
+        print(f"{when}  CL {cl:<8}  {status:<16}  {row.depot_path}")
+    print(f"\n共 {len(rows)} 条（--limit {args.limit}）")
 
-    # 2. 获取全量文件内容
-    file_data: list[tuple[str, str, str | None]] = []
-    for fd in code_diffs_to_review:
-        full_content = None
-        if fd.action != "delete":
-            full_content = get_file_content_cl(fd.depot_path, fd.cl_number)
-        file_data.append((fd.depot_path, fd.diff_text, full_content))
 
-    # 3. 调用 AI 审查
-    logger.info("开始 AI 审查 (%d 个文件) ...", len(file_data))
-    results = review_files_batch(file_data)
+def run_serve_mode(host: str | None, port: int | None, workers: int | None):
+    """
+    服务模式：常驻进程，通过 HTTP API / SQLite 队列接收 CL 审查任务。
+    """
+    from config import (
+        SERVICE_HOST, SERVICE_PORT, SERVICE_WORKERS,
+        SERVICE_DB_PATH, SERVICE_REPORT_DIR, SERVICE_CACHE_SIZE,
+    )
+    from ai_reviewer import enable_result_cache
+    from http_client import close_http_client
+    from review_service import serve
 
-    # 4. 生成报告
-    generate_report(
-        "cl", cl_display, file_diffs, results, output_path,
-        reviewed_code_files=code_diffs_to_review,
+    logger = logging.getLogger("main")
+    logger.info("=" * 60)
+    logger.info("P4-AI-Reviewer — 服务模式")
+    logger.info("=" * 60)
+
+    enable_result_cache(SERVICE_CACHE_SIZE)
+    try:
+        serve(
+            _review_cl_for_service,
+            host or SERVICE_HOST,
+            port or SERVICE_PORT,
+            workers or SERVICE_WORKERS,
+            SERVICE_DB_PATH,
+            SERVICE_REPORT_DIR,
+        )
+    finally:
+        close_http_client()
+
+
+def run_merge_mode(partial_paths: list[str], output_path: str, **report_options) -> list[ReviewResult]:
+    """
+    合并 --shard 各节点写出的分片结果，生成与单机审查一致的完整报告。返回审查结果（供 --fail-on 判定）。
+    """
+    from config import REPORT_FORMATS
+    from report_generator import write_reports
+    from shard import merge_partials
+
+    try:
+        mode, cl_display, file_diffs, reviewed, results, skipped_by_limit = merge_partials(partial_paths)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print(f"⚠️  合并分片结果失败: {e}")
+        sys.exit(1)
+
+    formats = report_options.get("formats") or REPORT_FORMATS
+    report_paths = write_reports(
+        formats, mode, cl_display, file_diffs, results, output_path,
+        reviewed_code_files=reviewed,
         skipped_by_limit=skipped_by_limit if skipped_by_limit else None,
+        include_diff=report_options.get("include_diff"),
     )
+    title = "P4-AI-Reviewer 分片合并完成" + (f" (CL: {cl_display})" if cl_display else "")
+    _print_summary(title, reviewed, results, skipped_by_limit, report_paths)
+    return results
 
-    success_count = sum(1 for r in results if not r.error)
-    fail_count = sum(1 for r in results if r.error)
-    print(f"\n{'=' * 60}")
-    print(f"  P4-AI-Reviewer 审查完成 (CL: {cl_display})")
-    print(f"  审查文件: {len(code_diffs_to_review)} | 成功: {success_count} | 失败: {fail_count}", end="")
-    if skipped_by_limit:
-        print(f" | 因限制未审查: {len(skipped_by_limit)}", end="")
-    print()
-    print(f"  报告路径: {os.path.abspath(output_path)}")
-    print(f"{'=' * 60}")
+
+def _resolve_output_path(output: str | None) -> str:
+    """未指定 -o 时：在报告目录下生成带时间戳的新文件，不覆盖旧报告。"""
+    from datetime import datetime
+
+    from config import REPORT_OUTPUT_DIR
+
+    if output is None:
+        os.makedirs(REPORT_OUTPUT_DIR, exist_ok=True)
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        output = os.path.join(REPORT_OUTPUT_DIR, f"Review_Report_{timestamp}.md")
+        logging.getLogger("main").info("报告将保存至: %s", output)
+    else:
+        parent = os.path.dirname(output)
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+    return output
+
+
+def _parse_report_options(args: argparse.Namespace) -> dict:
+    """由 --format / --no-diff 组装传给报告后端的参数。"""
+    report_options: dict = {}
+    if args.format:
+        formats = [f.strip().lower() for f in args.format.split(",") if f.strip()]
+        unknown = [f for f in formats if f not in ("md", "jsonl", "json")]
+        if unknown or not formats:
+            print(f"⚠️  无效的报告格式: {args.format}（可选: md, jsonl, json）")
+            sys.exit(1)
+        report_options["formats"] = formats
+    if args.no_diff:
+        report_options["include_diff"] = False
+    return report_options
 
 
 def main():
@@ -213,7 +651,8 @@ def main():
   AI_API_BASE_URL    LLM API 地址 (默认: https://api.openai.com/v1)
   AI_API_KEY         LLM API 密钥
   AI_MODEL           模型名称 (默认: gpt-4o)
-  AI_MAX_TOKENS      最大生成 token 数 (默认: 4096)
+  AI_MAX_TOKENS      最大生成 token 数上限 (默认: 8192)
+  AI_MIN_TOKENS      按 Diff 估算 max_tokens 时的下限 (默认: 1024，AI_ADAPTIVE_TOKENS=0 关闭估算)
   AI_TEMPERATURE     生成温度 (默认: 0.2)
         """,
     )
@@ -221,22 +660,200 @@ def main():
     parser.add_argument(
         "target",
         nargs="+",
-        help="审查目标: 'local' 表示本地未提交修改; 或一个或多个 CL 编号 (如 12345 12346 或 12345,12346)",
+        help="审查目标: 'local' 表示本地未提交修改; 'serve' 启动服务模式; 'query' 检索历史结果; "
+             "'shelved:12345' 审查 shelved 文件; '//depot/path/...@100,@200' 审查范围内已提交的 CL; "
+             "'merge 分片文件...' 合并分片结果; 'index [目录...]' 建立/更新符号索引; 或一个或多个 CL 编号 (如 12345 12346 或 12345,12346)",
     )
     parser.add_argument(
         "-o", "--output",
         default=None,
-        help=f"输出报告路径。不指定时在 {REPORT_OUTPUT_DIR}/ 下生成 Review_Report_时间戳.md，不覆盖旧报告",
+        help="输出报告路径。不指定时在 REPORT_OUTPUT_DIR（默认 reports）下生成 Review_Report_时间戳.md，不覆盖旧报告",
     )
     parser.add_argument(
         "-v", "--verbose",
         action="store_true",
         help="启用详细日志输出",
     )
+    parser.add_argument(
+        "--format",
+        default=None,
+        help="报告格式，逗号分隔: md, jsonl, json (默认取 REPORT_FORMATS)。"
+             "jsonl/json 与 Markdown 报告同名、扩展名分别为 .jsonl / .summary.json",
+    )
+    parser.add_argument(
+        "--no-diff",
+        action="store_true",
+        help="Markdown 报告中不嵌入 Diff",
+    )
+    parser.add_argument(
+        "--fail-on",
+        choices=["critical", "warning", "suggestion"],
+        default=None,
+        help="CI 门禁: 存在该等级及以上的问题时以退出码 2 结束 (critical=🔴, warning=🟡, suggestion=🔵)",
+    )
+    parser.add_argument(
+        "--deadline",
+        default=None,
+        help="整次运行的时限 (如 600、90s、10m)：到期后停止领取新文件、取消进行中的请求，"
+             "报告照常写出并标注未完成的文件，退出码 3（变更尚未获取完成时不生成报告）；Ctrl-C 效果相同",
+    )
+    parser.add_argument(
+        "--shard",
+        default=None,
+        help="CL 模式: 分片审查 i/N (如 1/4)，只审查第 i 片并写出分片结果 JSON，最后用 merge 汇总",
+    )
+    parser.add_argument(
+        "--combined",
+        action="store_true",
+        help="范围模式: 用 p4 diff2 合并整个范围的 Diff，多次修改的文件只按最终状态审查一次",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="local 模式: 持续监视本地修改，仅重新审查 Diff 变化的文件并原地更新报告",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=None,
+        help="--watch: 轮询间隔秒数 (默认取 WATCH_INTERVAL)",
+    )
+    parser.add_argument(
+        "--debounce",
+        type=float,
+        default=None,
+        help="--watch: 最后一次修改后静默多少秒再审查 (默认取 WATCH_DEBOUNCE)",
+    )
+    parser.add_argument(
+        "--path",
+        default=None,
+        help="query 模式: depot 路径前缀 (如 //depot/Engine/)",
+    )
+    parser.add_argument(
+        "--cl",
+        default=None,
+        help="query 模式: CL 或 CL 范围 (如 12345 或 12000-12999，省略一端表示不限)",
+    )
+    parser.add_argument(
+        "--severity",
+        choices=["critical", "warning", "suggestion"],
+        default=None,
+        help="query 模式: 最低严重程度 (critical=🔴, warning=🟡及以上, suggestion=🔵及以上)",
+    )
+    parser.add_argument(
+        "--since",
+        default=None,
+        help="query 模式: 起始日期 (YYYY-MM-DD)",
+    )
+    parser.add_argument(
+        "--until",
+        default=None,
+        help="query 模式: 截止日期 (YYYY-MM-DD，不含)",
+    )
+    parser.add_argument(
+        "--limit",
+        type=int,
+        default=100,
+        help="query 模式: 最多返回条数 (默认 100)",
+    )
+    parser.add_argument(
+        "--json",
+        action="store_true",
+        help="query 模式: 以 JSON Lines 输出",
+    )
+    parser.add_argument(
+        "--host",
+        default=None,
+        help="serve 模式: HTTP API 监听地址 (默认取 SERVICE_HOST)",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=None,
+        help="serve 模式: HTTP API 端口 (默认取 SERVICE_PORT)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="serve 模式: 并行处理的任务数 (默认取 SERVICE_WORKERS)",
+    )
 
     args = parser.parse_args()
     setup_logging(args.verbose)
 
+    if len(args.target) == 1 and args.target[0].strip().lower() == "query":
+        run_query_mode(args)
+        return
+
+    if args.target[0].strip().lower() == "index":
+        run_index_mode(args.target[1:])
+        return
+
+    if args.target[0].strip().lower() == "merge":
+        if len(args.target) < 2:
+            print("⚠️  请指定要合并的分片结果文件，例如: merge reports/*.shard-*.json")
+            sys.exit(1)
+        results = run_merge_mode(args.target[1:], _resolve_output_path(args.output),
+                                 **_parse_report_options(args))
+        if args.fail_on:
+            _exit_on_findings(results, args.fail_on)
+        return
+
+    targets = args.target
+    is_serve = len(targets) == 1 and targets[0].strip().lower() == "serve"
+
+    # 先校验参数（不加载配置、不建目录），无效调用尽快退出
+    shard: tuple[int, int] | None = None
+    if args.shard:
+        from shard import parse_shard_spec
+        try:
+            shard = parse_shard_spec(args.shard)
+        except ValueError as e:
+            print(f"⚠️  {e}")
+            sys.exit(1)
+
+    # 解析 target：支持 local、12345 12346 / 12345,12346、shelved:12345、//depot/path/...@100,@200
+    is_local = len(targets) == 1 and targets[0].strip().lower() == "local"
+    range_target = parse_range_target(targets[0]) if len(targets) == 1 else None
+    shelved_flags = [t.strip().lower().startswith("shelved:") for t in targets]
+    shelved = all(shelved_flags)
+    cl_numbers: list[str] = []
+    if not (is_serve or is_local or range_target):
+        # shelved 与已提交 CL 不能混用，任何无法识别的部分都不静默丢弃
+        valid = shelved or not any(shelved_flags)
+        for t in targets:
+            if shelved:
+                t = t.strip()[len("shelved:"):]
+            for part in t.replace(",", " ").split():
+                part = part.strip()
+                if part.isdigit():
+                    cl_numbers.append(part)
+                else:
+                    valid = False
+        if not cl_numbers or not valid:
+            print(f"⚠️  无效的目标参数: {targets}")
+            print("   请使用 'local'、CL 编号 (如 12345 或 12345 12346 或 12345,12346)、"
+                  "'shelved:12345' 或范围 '//depot/path/...@100,@200'。")
+            sys.exit(1)
+    if args.combined and range_target is None:
+        print("⚠️  --combined 仅用于范围目标（如 //depot/path/...@100,@200）。")
+        sys.exit(1)
+    if is_local and shard is not None:
+        print("⚠️  --shard 仅支持 CL 模式（各节点需审查同一批变更）。")
+        sys.exit(1)
+    deadline: float | None = None
+    if args.deadline:
+        if is_serve or args.watch:
+            print("⚠️  --deadline 仅用于单次审查（不适用于 serve 与 --watch）。")
+            sys.exit(1)
+        try:
+            deadline = _parse_duration(args.deadline)
+        except ValueError as e:
+            print(f"⚠️  {e}")
+            sys.exit(1)
+    report_options = _parse_report_options(args)
+
     # 检查 API Key
     from config import AI_API_KEY, AI_API_BASE_URL, AI_MODEL
     if not AI_API_KEY:
@@ -248,35 +865,47 @@ def main():
     logger = logging.getLogger("main")
     logger.info("AI 配置: API=%s, Model=%s", AI_API_BASE_URL, AI_MODEL)
 
-    # 未指定 -o 时：在报告目录下生成带时间戳的新文件，不覆盖旧报告
-    output_path = args.output
-    if output_path is None:
-        os.makedirs(REPORT_OUTPUT_DIR, exist_ok=True)
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        output_path = os.path.join(REPORT_OUTPUT_DIR, f"Review_Report_{timestamp}.md")
-        logger.info("报告将保存至: %s", output_path)
-    else:
-        parent = os.path.dirname(output_path)
-        if parent:
-            os.makedirs(parent, exist_ok=True)
+    if is_serve:
+        run_serve_mode(args.host, args.port, args.workers)
+        return
 
-    # 解析 target：支持 local 或 12345 12346 或 12345,12346
-    targets = args.target
-    if len(targets) == 1 and targets[0].strip().lower() == "local":
-        run_local_mode(output_path)
-    else:
-        cl_numbers: list[str] = []
-        for t in targets:
-            for part in t.replace(",", " ").split():
-                part = part.strip()
-                if part.isdigit():
-                    cl_numbers.append(part)
-        if cl_numbers:
-            run_cl_mode(cl_numbers, output_path)
-        else:
-            print(f"⚠️  无效的目标参数: {targets}")
-            print("   请使用 'local' 或 CL 编号 (如 12345 或 12345 12346 或 12345,12346)。")
-            sys.exit(1)
+    output_path = _resolve_output_path(args.output)
+
+    if is_local and args.watch:
+        from config import WATCH_INTERVAL, WATCH_DEBOUNCE
+        from watch_mode import watch_local
+        watch_local(
+            output_path,
+            args.interval if args.interval is not None else WATCH_INTERVAL,
+            args.debounce if args.debounce is not None else WATCH_DEBOUNCE,
+            **report_options,
+        )
+        return
+
+    from deadline import RunCancelled, describe_reason, run_scope
+
+    # --deadline 到期或 Ctrl-C：停止领取新文件并取消进行中的请求，报告照常写出（未完成的文件单独标注）。
+    # 例外：取消发生在获取变更（describe / diff）阶段时还不知道完整的文件列表，不写报告，直接以退出码 3 结束
+    results: list[ReviewResult] = []
+    with run_scope(deadline) as token:
+        try:
+            if is_local:
+                results = run_local_mode(output_path, **report_options)
+            elif range_target is not None:
+                results = run_range_mode(*range_target, output_path, combined=args.combined,
+                                         shard=shard, **report_options)
+            else:
+                results = run_cl_mode(cl_numbers, output_path, shard=shard, shelved=shelved,
+                                      **report_options)
+        except RunCancelled as e:
+            print(f"\n⏹️  {e}：变更尚未获取完成，未生成报告。")
+            sys.exit(3)
+
+    if args.fail_on:
+        _exit_on_findings(results, args.fail_on)
+    if token.cancelled:
+        print(f"\n⏹️  {describe_reason(token.reason)}：报告已写出，未完成的文件已在报告中标注。")
+        sys.exit(3)
 
 
 if __name__ == "__main__":
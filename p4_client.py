@@ -7,37 +7,36 @@ import logging
 import os
 from typing import Optional
 
-from config import P4_EXECUTABLE, SOURCE_ENCODING
+from config import FILE_CONTENT_MAX_CHARS, P4_EXECUTABLE
+from deadline import current_token
+from text_codec import decode_output, decode_prefix, read_text
 
 logger = logging.getLogger(__name__)
 
 
-def _run_p4(args: list[str], timeout: int = 120) -> str:
+def _run_p4_bytes(args: list[str], timeout: int = 120) -> bytes:
     """
-    执行 p4 命令并返回 stdout 文本。
-    使用 SOURCE_ENCODING（如 gbk）解码，避免 Windows 下 Diff 中文乱码。
-    如果命令失败则抛出异常。
+    执行 p4 命令并返回 stdout 原始字节。
+    如果命令失败则抛出异常；超时不超过运行剩余时间，运行被取消（--deadline / Ctrl-C）时抛出 RunCancelled。
     """
+    token = current_token()
+    timeout = token.timeout(timeout)
     cmd = [P4_EXECUTABLE] + args
     logger.debug("执行命令: %s", " ".join(cmd))
     try:
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            timeout=timeout,
-            encoding=SOURCE_ENCODING,
-            errors="replace",
-        )
+        result = subprocess.run(cmd, capture_output=True, timeout=timeout)
     except FileNotFoundError:
         raise RuntimeError(
             f"找不到 p4 可执行文件 '{P4_EXECUTABLE}'。"
             "请确保 Perforce 命令行工具已安装并在 PATH 中。"
         )
     except subprocess.TimeoutExpired:
+        token.timeout(timeout)  # 运行截止时间到期导致的超时按取消处理
         raise RuntimeError(f"p4 命令超时 ({timeout}s): {' '.join(cmd)}")
 
     if result.returncode != 0:
-        stderr = result.stderr.strip()
+        token.check()  # Ctrl-C 同时中断了 p4 子进程
+        stderr = decode_output(result.stderr).strip()
         # p4 diff 在没有差异时也可能返回非零，但 stderr 为空
         if stderr:
             raise RuntimeError(f"p4 命令失败 (rc={result.returncode}): {stderr}")
@@ -45,17 +44,36 @@ def _run_p4(args: list[str], timeout: int = 120) -> str:
     return result.stdout
 
 
+def _run_p4(args: list[str], timeout: int = 120) -> str:
+    """
+    执行 p4 命令并返回 stdout 文本。
+    按文件分段识别编码（UTF-8 / SOURCE_ENCODING / GB18030），混合编码的代码树中 Diff 中文不乱码。
+    """
+    return decode_output(_run_p4_bytes(args, timeout))
+
+
 # ----------------------------------------------------------------
 # Diff 获取
 # ----------------------------------------------------------------
 
-def get_diff_local() -> str:
+# 单条 p4 命令携带的文件参数上限，避免命令行过长
+_MAX_FILE_ARGS = 200
+
+
+def get_diff_local(paths: list[str] | None = None) -> str:
     """
     获取本地工作区未提交的修改 (p4 diff -du)。
+    paths 非空时仅 diff 指定文件（depot 或本地路径），分批执行后拼接。
     返回 unified diff 格式的原始文本。
     """
-    logger.info("获取本地未提交修改 (p4 diff -du) ...")
-    return _run_p4(["diff", "-du"])
+    if not paths:
+        logger.info("获取本地未提交修改 (p4 diff -du) ...")
+        return _run_p4(["diff", "-du"])
+    logger.info("获取 %d 个文件的本地修改 (p4 diff -du) ...", len(paths))
+    outputs = []
+    for i in range(0, len(paths), _MAX_FILE_ARGS):
+        outputs.append(_run_p4(["diff", "-du"] + paths[i:i + _MAX_FILE_ARGS]))
+    return "\n".join(outputs)
 
 
 def get_diff_cl(cl_number: int | str) -> str:
@@ -67,10 +85,78 @@ def get_diff_cl(cl_number: int | str) -> str:
     return _run_p4(["describe", "-du", str(cl_number)])
 
 
+def get_diff_shelved(cl_number: int | str) -> str:
+    """
+    获取 shelve 在指定 CL 中的文件 diff (p4 describe -S -du <CL>)，用于提交前审查。
+    """
+    logger.info("获取 CL %s 的 shelved 变更 (p4 describe -S -du) ...", cl_number)
+    return _run_p4(["describe", "-S", "-du", str(cl_number)])
+
+
+# 单条 p4 describe 携带的 CL 数上限（输出较大，批次小一些）
+_MAX_DESCRIBE_CLS = 50
+
+
+def get_describe_bulk(cl_numbers: list[str]) -> str:
+    """
+    批量获取多个 CL 的 describe 输出（p4 describe -du <CL> <CL> ...），分批执行后拼接。
+    用 diff_parser.split_describe_output 按 CL 拆分。
+    """
+    outputs = []
+    for i in range(0, len(cl_numbers), _MAX_DESCRIBE_CLS):
+        batch = cl_numbers[i:i + _MAX_DESCRIBE_CLS]
+        logger.info("获取 CL %s ~ %s 的变更 (p4 describe -du, %d 个) ...", batch[0], batch[-1], len(batch))
+        outputs.append(_run_p4(["describe", "-du"] + batch, timeout=600))
+    return "\n".join(outputs)
+
+
+def get_submitted_changes(filespec: str) -> list[str]:
+    """
+    列出影响 filespec 的已提交 CL（p4 changes -s submitted），按 CL 号升序返回。
+    filespec 形如 //depot/path/...@100,@200。
+    """
+    output = _run_p4(["changes", "-s", "submitted", filespec])
+    changes = set()
+    for line in output.splitlines():
+        # 格式: Change 12345 on 2024/01/01 by user@ws 'desc'
+        parts = line.split()
+        if len(parts) >= 2 and parts[0] == "Change" and parts[1].isdigit():
+            changes.add(int(parts[1]))
+    return [str(c) for c in sorted(changes)]
+
+
+def server_case_insensitive() -> bool:
+    """
+    服务器是否按大小写不敏感处理路径（p4 -ztag info 的 caseHandling，Windows 服务器常为 insensitive）。
+    获取失败时按大小写敏感处理（不会把其他目录的文件误纳入范围）。
+    """
+    try:
+        output = _run_p4(["-ztag", "info"])
+    except RuntimeError as e:
+        logger.warning("p4 info 失败，路径按大小写敏感匹配: %s", e)
+        return False
+    for line in output.splitlines():
+        if line.startswith("... caseHandling "):
+            return line[len("... caseHandling "):].strip().lower() == "insensitive"
+    return False
+
+
+def get_diff2(left_spec: str, right_spec: str) -> str:
+    """
+    比较两个版本的文件集合 (p4 diff2 -du <left> <right>)，用于 CL 范围的合并 Diff。
+    """
+    logger.info("获取合并 Diff (p4 diff2 -du %s %s) ...", left_spec, right_spec)
+    return _run_p4(["diff2", "-du", left_spec, right_spec], timeout=600)
+
+
 # ----------------------------------------------------------------
 # 全量文件获取
 # ----------------------------------------------------------------
 
+# 全量内容只解码 Prompt 用得到的前缀；多取 1 个字符，ai_reviewer 据此判断是否截断并加注说明
+_CONTENT_WINDOW_CHARS = FILE_CONTENT_MAX_CHARS + 1
+
+
 def get_file_content_local(depot_or_local_path: str) -> Optional[str]:
     """
     本地模式：直接从磁盘读取文件内容。
@@ -84,11 +170,10 @@ def get_file_content_local(depot_or_local_path: str) -> Optional[str]:
             logger.warning("无法将 depot 路径映射到本地: %s", depot_or_local_path)
             return None
 
-    # 使用配置的编码读取（SOURCE_ENCODING=gbk 时兼容 GB2312/GBK 代码文件）
+    # 按文件识别编码，大文件经 mmap 只解码前缀
     try:
-        with open(local_path, "r", encoding=SOURCE_ENCODING, errors="replace") as f:
-            return f.read()
-    except (OSError, IOError) as e:
+        return read_text(local_path, _CONTENT_WINDOW_CHARS)
+    except (OSError, IOError, ValueError) as e:
         logger.warning("读取本地文件失败 %s: %s", local_path, e)
         return None
 
@@ -100,13 +185,25 @@ def get_file_content_cl(depot_path: str, cl_number: int | str) -> Optional[str]:
     file_spec = f"{depot_path}@{cl_number}"
     logger.debug("获取文件快照: p4 print -q %s", file_spec)
     try:
-        content = _run_p4(["print", "-q", file_spec])
-        return content
+        return decode_prefix(_run_p4_bytes(["print", "-q", file_spec]), depot_path, _CONTENT_WINDOW_CHARS)
     except RuntimeError as e:
         logger.warning("获取文件快照失败 %s: %s", file_spec, e)
         return None
 
 
+def get_file_content_shelved(depot_path: str, cl_number: int | str) -> Optional[str]:
+    """
+    Shelved 模式：通过 p4 print 获取 shelve 在 CL 中的文件版本（@=CL）。
+    """
+    file_spec = f"{depot_path}@={cl_number}"
+    logger.debug("获取 shelved 文件: p4 print -q %s", file_spec)
+    try:
+        return decode_prefix(_run_p4_bytes(["print", "-q", file_spec]), depot_path, _CONTENT_WINDOW_CHARS)
+    except RuntimeError as e:
+        logger.warning("获取 shelved 文件失败 %s: %s", file_spec, e)
+        return None
+
+
 def _depot_to_local(depot_path: str) -> Optional[str]:
     """
     使用 p4 where 将 depot 路径转换为本地路径。
@@ -132,10 +229,33 @@ def _depot_to_local(depot_path: str) -> Optional[str]:
     return None
 
 
-def get_opened_files() -> list[str]:
+def where_local_paths(depot_paths: list[str]) -> dict[str, str]:
+    """
+    批量将 depot 路径映射为本地路径 (p4 -ztag where)。
+    返回 {depot_path: local_path}，无法映射的路径不出现在结果中。
+    """
+    mapping: dict[str, str] = {}
+    for i in range(0, len(depot_paths), _MAX_FILE_ARGS):
+        try:
+            output = _run_p4(["-ztag", "where"] + depot_paths[i:i + _MAX_FILE_ARGS])
+        except RuntimeError as e:
+            logger.warning("p4 where 失败: %s", e)
+            continue
+        depot_file = None
+        # -ztag 输出: 每个文件一组 "... depotFile / ... clientFile / ... path"，路径可含空格
+        for line in output.splitlines():
+            if line.startswith("... depotFile "):
+                depot_file = line[len("... depotFile "):].strip()
+            elif line.startswith("... path ") and depot_file:
+                mapping[depot_file] = line[len("... path "):].strip()
+                depot_file = None
+    return mapping
+
+
+def get_opened_files() -> list[str] | None:
     """
     获取当前工作区已 open 的文件列表（用于 local 模式补全路径信息）。
-    返回 depot 路径列表。
+    返回 depot 路径列表；p4 opened 失败时返回 None，以便调用方区分「没有 open 的文件」。
     """
     try:
         output = _run_p4(["opened"])
@@ -146,5 +266,6 @@ def get_opened_files() -> list[str]:
                 depot_path = line.split("#")[0]
                 files.append(depot_path)
         return files
-    except RuntimeError:
-        return []
+    except RuntimeError as e:
+        logger.warning("p4 opened 失败: %s", e)
+        return None
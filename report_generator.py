@@ -1,12 +1,20 @@
 """
 P4-AI-Reviewer — 报告生成器
-将审查结果汇总为 Markdown 报告。
+将审查结果汇总为报告。支持多种输出格式：
+    md     Markdown 报告（人工阅读）
+    jsonl  每个文件一条 JSON 记录，含解析后的问题列表（流式写入，供 CI 等工具读取）
+    json   紧凑的汇总 JSON（总数、各等级问题数、逐文件状态）
 """
+import json
 import logging
+import os
 from datetime import datetime
+from typing import Callable, Iterator
 
+from config import REPORT_EMBED_DIFF
 from diff_parser import FileDiff
 from ai_reviewer import ReviewResult
+from findings import SEVERITY_EMOJI, aggregate_findings, count_by_severity
 
 logger = logging.getLogger(__name__)
 
@@ -20,6 +28,7 @@ def generate_report(
     *,
     reviewed_code_files: list[FileDiff] | None = None,
     skipped_by_limit: list[FileDiff] | None = None,
+    include_diff: bool | None = None,
 ) -> str:
     """
     生成 Markdown 格式的审查报告。
@@ -32,7 +41,10 @@ def generate_report(
         output_path: 报告输出路径
         reviewed_code_files: 实际参与审查的代码文件列表；为 None 时取 file_diffs 中所有 is_code_file
         skipped_by_limit: 因 MAX_FILES_PER_RUN 限制未审查的代码文件列表
+        include_diff: 是否在报告中嵌入折叠的 Diff；为 None 时取 REPORT_EMBED_DIFF
     """
+    if include_diff is None:
+        include_diff = REPORT_EMBED_DIFF
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     lines: list[str] = []
 
@@ -51,7 +63,8 @@ def generate_report(
         lines.append(f"- **审查模式**: 变更列表 CL `{cl_number}`")
 
     reviewed = [r for r in review_results if not r.error]
-    failed = [r for r in review_results if r.error]
+    failed = [r for r in review_results if r.error and not r.unfinished]
+    unfinished = [r for r in review_results if r.unfinished]
     lines.append(f"- **变更文件总数**: {len(file_diffs)}")
     lines.append(f"- **代码文件数**: {len(code_files_all)}")
     lines.append(f"- **跳过（非代码文件）**: {len(skipped_files)}")
@@ -60,10 +73,37 @@ def generate_report(
     lines.append(f"- **审查成功**: {len(reviewed)}")
     if failed:
         lines.append(f"- **审查失败**: {len(failed)}")
+    if unfinished:
+        lines.append(f"- **未完成（截止时间到期 / 中断）**: {len(unfinished)}")
+    routed = [r for r in review_results if r.route]
+    if routed:
+        triaged = sum(1 for r in routed if r.route == "triage")
+        lines.append(f"- **分级路由**: 分诊判定低风险 {triaged} | 深度审查 {len(routed) - triaged}")
     lines.append("")
     lines.append("---")
     lines.append("")
 
+    # ── 问题汇总（跨文件去重，按严重程度排序）────────────
+    all_findings = [(r.depot_path, r.findings) for r in reviewed]
+    counts = count_by_severity([f for _, fs in all_findings for f in fs])
+    if any(counts.values()):
+        lines.append("## 问题汇总")
+        lines.append("")
+        lines.append(f"🔴 严重 {counts['critical']} | 🟡 警告 {counts['warning']} | 🔵 建议 {counts['suggestion']}")
+        lines.append("")
+        for agg in aggregate_findings(all_findings):
+            if agg.severity == "suggestion":
+                continue
+            where = ", ".join(
+                f"`{p.rsplit('/', 1)[-1]}`" + (f" L{line}" if line is not None else "")
+                for p, line in agg.locations
+            )
+            dimension = f"[{agg.dimension}] " if agg.dimension else ""
+            lines.append(f"- {SEVERITY_EMOJI[agg.severity]} {dimension}{agg.text} — {where}")
+        lines.append("")
+        lines.append("---")
+        lines.append("")
+
     # ── 跳过的文件（非代码）──────────────────────────
     if skipped_files:
         lines.append("## 跳过的文件（非代码文件）")
@@ -104,7 +144,7 @@ def generate_report(
             lines.append("")
 
             # Diff 折叠显示
-            if f.diff_text:
+            if include_diff and f.diff_text:
                 lines.append("<details>")
                 lines.append(f"<summary>查看 Diff（点击展开）</summary>")
                 lines.append("")
@@ -119,8 +159,25 @@ def generate_report(
             if result and not result.error:
                 lines.append("#### AI 审查意见")
                 lines.append("")
+                if result.duplicate_of:
+                    kind = ("相同" if result.duplicate_similarity >= 1.0
+                            else f"相似（约 {result.duplicate_similarity:.0%}）")
+                    lines.append(f"> ♻️ 变更与 `{result.duplicate_of}` {kind}，"
+                                 "未单独审查，以下为其审查意见，行号以该文件为准。")
+                    lines.append("")
+                if result.route == "triage":
+                    lines.append(f"> 🚦 分诊模型 `{result.model}` 判定为低风险变更，未进行深度审查。")
+                    lines.append("")
                 lines.append(result.review_comment)
                 lines.append("")
+                if result.truncated:
+                    lines.append("> ✂️ 回答达到输出长度上限 (`AI_MAX_TOKENS`) 被截断，以上审查意见可能不完整。")
+                    lines.append("")
+            elif result and result.unfinished:
+                lines.append("#### AI 审查意见")
+                lines.append("")
+                lines.append(f"> ⏹️ {result.error}，本文件未审查。")
+                lines.append("")
             elif result and result.error:
                 lines.append("#### AI 审查意见")
                 lines.append("")
@@ -149,3 +206,201 @@ def generate_report(
         logger.error("写入报告失败: %s", e)
 
     return report_text
+
+
+def _file_records(
+    file_diffs: list[FileDiff],
+    review_results: list[ReviewResult],
+    reviewed_code_files: list[FileDiff] | None,
+    skipped_by_limit: list[FileDiff] | None,
+) -> Iterator[dict]:
+    """按 file_diffs 顺序逐个生成文件记录（含解析后的问题），供 JSON 类输出复用。"""
+    code_files = (reviewed_code_files if reviewed_code_files is not None
+                  else [f for f in file_diffs if f.is_code_file])
+    result_by_file = {id(f): r for f, r in zip(code_files, review_results)}
+    limited = {id(f) for f in (skipped_by_limit or [])}
+
+    for f in file_diffs:
+        record = {
+            "depot_path": f.depot_path,
+            "cl_number": f.cl_number or None,
+            "action": f.action,
+        }
+        result = result_by_file.get(id(f))
+        if not f.is_code_file:
+            record["status"] = "skipped_non_code"
+        elif id(f) in limited:
+            record["status"] = "skipped_by_limit"
+        elif result is None:
+            record["status"] = "not_reviewed"
+        elif result.unfinished:
+            record.update(status="unfinished", error=result.error)
+        elif result.error:
+            record.update(status="failed", error=result.error,
+                          model=result.model, elapsed=round(result.elapsed, 3))
+            if result.duplicate_of:
+                record["duplicate_of"] = result.duplicate_of
+        else:
+            record.update(
+                status="reviewed",
+                model=result.model,
+                elapsed=round(result.elapsed, 3),
+                verdict=result.verdict,
+                counts=count_by_severity(result.findings),
+                findings=[x.to_dict() for x in result.findings],
+                review_comment=result.review_comment,
+            )
+            if result.route:
+                record.update(route=result.route, triage_elapsed=round(result.triage_elapsed, 3))
+            if result.duplicate_of:
+                record.update(duplicate_of=result.duplicate_of,
+                              duplicate_similarity=round(result.duplicate_similarity, 3))
+            if result.truncated:
+                record["truncated"] = True
+        yield record
+
+
+def write_jsonl_report(
+    mode: str,
+    cl_number: str | None,
+    file_diffs: list[FileDiff],
+    review_results: list[ReviewResult],
+    output_path: str,
+    *,
+    reviewed_code_files: list[FileDiff] | None = None,
+    skipped_by_limit: list[FileDiff] | None = None,
+    include_diff: bool | None = None,
+) -> str:
+    """
+    流式写入 JSONL：首行为 {"type": "run", ...}，其后每个文件一行 {"type": "file", ...}。
+    不嵌入 Diff。返回输出路径。
+    """
+    try:
+        with open(output_path, "w", encoding="utf-8") as out:
+            header = {
+                "type": "run",
+                "generated_at": datetime.now().isoformat(timespec="seconds"),
+                "mode": mode,
+                "cl": cl_number,
+            }
+            out.write(json.dumps(header, ensure_ascii=False) + "\n")
+            for record in _file_records(file_diffs, review_results,
+                                        reviewed_code_files, skipped_by_limit):
+                out.write(json.dumps({"type": "file", **record}, ensure_ascii=False) + "\n")
+        logger.info("JSONL 报告已保存至: %s", output_path)
+    except IOError as e:
+        logger.error("写入 JSONL 报告失败: %s", e)
+    return output_path
+
+
+def write_summary_json(
+    mode: str,
+    cl_number: str | None,
+    file_diffs: list[FileDiff],
+    review_results: list[ReviewResult],
+    output_path: str,
+    *,
+    reviewed_code_files: list[FileDiff] | None = None,
+    skipped_by_limit: list[FileDiff] | None = None,
+    include_diff: bool | None = None,
+) -> str:
+    """
+    写入紧凑汇总 JSON：运行信息、文件统计、各等级问题总数、逐文件状态与计数。
+    返回输出路径。
+    """
+    totals = {
+        "files": len(file_diffs),
+        "code_files": sum(1 for f in file_diffs if f.is_code_file),
+        "skipped_non_code": 0,
+        "skipped_by_limit": 0,
+        "reviewed": 0,
+        "failed": 0,
+        "unfinished": 0,
+    }
+    finding_totals = {"critical": 0, "warning": 0, "suggestion": 0}
+    files = []
+    for record in _file_records(file_diffs, review_results,
+                                reviewed_code_files, skipped_by_limit):
+        status = record["status"]
+        if status in totals:
+            totals[status] += 1
+        entry = {"depot_path": record["depot_path"], "status": status}
+        if record.get("cl_number"):
+            entry["cl_number"] = record["cl_number"]
+        if record.get("verdict"):
+            entry["verdict"] = record["verdict"]
+        if "counts" in record:
+            entry.update(record["counts"])
+            for severity, n in record["counts"].items():
+                finding_totals[severity] += n
+        if status == "skipped_non_code":
+            continue
+        files.append(entry)
+
+    aggregated = aggregate_findings(
+        [(r.depot_path, r.findings) for r in review_results if not r.error]
+    )
+    summary = {
+        "generated_at": datetime.now().isoformat(timespec="seconds"),
+        "mode": mode,
+        "cl": cl_number,
+        "totals": totals,
+        "findings": finding_totals,
+        "top_findings": [
+            {
+                "severity": a.severity,
+                "dimension": a.dimension,
+                "text": a.text,
+                "locations": [{"depot_path": p, "line": line} for p, line in a.locations],
+            }
+            for a in aggregated if a.severity != "suggestion"
+        ],
+        "files": files,
+    }
+    try:
+        with open(output_path, "w", encoding="utf-8") as out:
+            json.dump(summary, out, ensure_ascii=False, indent=2)
+        logger.info("汇总 JSON 已保存至: %s", output_path)
+    except IOError as e:
+        logger.error("写入汇总 JSON 失败: %s", e)
+    return output_path
+
+
+# 输出格式 → (写入函数, 相对 Markdown 报告路径的扩展名)
+REPORT_BACKENDS: dict[str, tuple[Callable[..., str], str]] = {
+    "md": (generate_report, ".md"),
+    "jsonl": (write_jsonl_report, ".jsonl"),
+    "json": (write_summary_json, ".summary.json"),
+}
+
+
+def report_path_for(output_path: str, fmt: str) -> str:
+    """由主报告路径推导其他格式的输出路径（Review_Report_x.md → Review_Report_x.jsonl 等）。"""
+    if fmt == "md":
+        return output_path
+    base, ext = os.path.splitext(output_path)
+    if ext.lower() != ".md":
+        base = output_path
+    return base + REPORT_BACKENDS[fmt][1]
+
+
+def write_reports(
+    formats: list[str],
+    mode: str,
+    cl_number: str | None,
+    file_diffs: list[FileDiff],
+    review_results: list[ReviewResult],
+    output_path: str,
+    **kwargs,
+) -> list[str]:
+    """
+    按 formats 依次调用各输出后端，返回实际写入的路径列表。
+    kwargs 原样传给各后端（reviewed_code_files / skipped_by_limit / include_diff）。
+    """
+    paths = []
+    for fmt in formats:
+        writer, _ = REPORT_BACKENDS[fmt]
+        path = report_path_for(output_path, fmt)
+        writer(mode, cl_number, file_diffs, review_results, path, **kwargs)
+        paths.append(path)
+    return paths
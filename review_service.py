@@ -0,0 +1,426 @@
+"""
+P4-AI-Reviewer — 服务模式
+常驻进程：SQLite 任务队列 + 工作线程池 + 本地 HTTP API。
+
+避免每次提交触发都重新启动 Python、读取 .env、建立 HTTP 连接；
+同一 CL 的重复提交会被去重，报告保存在磁盘上并可通过 API 获取。
+
+HTTP API:
+    POST /jobs               {"cl": "12345"} 或 {"cls": ["12345", "12346"], "force": false}
+    GET  /jobs?status=queued 最近的任务列表
+    GET  /jobs/<id>          任务状态
+    GET  /jobs/<id>/report   Markdown 报告
+    GET  /reviews?path=//depot/Engine/&cl_min=100&cl_max=200&severity=critical&since=<ts>&limit=100
+                             检索审查结果数据库
+    GET  /health             服务状态
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from dataclasses import asdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+from urllib.parse import parse_qs, urlparse
+
+from report_generator import report_path_for
+from review_store import SEVERITY_NAMES, get_default_store
+
+logger = logging.getLogger(__name__)
+
+# 队列空闲时的轮询间隔（秒），用于发现其他进程直接写入 SQLite 的任务
+_POLL_INTERVAL = 2.0
+
+_ACTIVE_STATUSES = ("queued", "running")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    cl_key      TEXT NOT NULL,
+    status      TEXT NOT NULL,
+    created_at  REAL NOT NULL,
+    started_at  REAL,
+    finished_at REAL,
+    report_path TEXT,
+    summary     TEXT,
+    error       TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_key ON jobs(cl_key, status);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, id);
+"""
+
+
+def normalize_cl_key(cl_numbers: list[str]) -> str:
+    """将 CL 列表规范化为去重键：去重、按数值排序、逗号连接。"""
+    unique = {c.strip() for c in cl_numbers if c.strip().isdigit()}
+    return ",".join(sorted(unique, key=int))
+
+
+class JobQueue:
+    """
+    基于 SQLite 的任务队列。每次操作使用独立连接，可被多线程/多进程安全共享。
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        parent = os.path.dirname(db_path)
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @staticmethod
+    def _row_to_dict(row: sqlite3.Row | None) -> dict | None:
+        if row is None:
+            return None
+        job = dict(row)
+        job["cl_numbers"] = job["cl_key"].split(",") if job["cl_key"] else []
+        job["summary"] = json.loads(job["summary"]) if job["summary"] else None
+        return job
+
+    def submit(self, cl_numbers: list[str], force: bool = False) -> tuple[dict, bool]:
+        """
+        提交任务。返回 (任务, 是否被去重)。
+        相同 CL 集合已在排队/运行中时直接返回该任务；已完成的任务除非 force 也直接复用。
+        """
+        cl_key = normalize_cl_key(cl_numbers)
+        if not cl_key:
+            raise ValueError("未提供有效的 CL 编号")
+        statuses = _ACTIVE_STATUSES if force else _ACTIVE_STATUSES + ("done",)
+        placeholders = ",".join("?" for _ in statuses)
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    f"SELECT * FROM jobs WHERE cl_key = ? AND status IN ({placeholders}) "
+                    "ORDER BY id DESC LIMIT 1",
+                    (cl_key, *statuses),
+                ).fetchone()
+                if row is not None:
+                    conn.execute("COMMIT")
+                    return self._row_to_dict(row), True
+                cur = conn.execute(
+                    "INSERT INTO jobs (cl_key, status, created_at) VALUES (?, 'queued', ?)",
+                    (cl_key, time.time()),
+                )
+                job_id = cur.lastrowid
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return self.get(job_id), False
+
+    def claim(self) -> dict | None:
+        """原子地领取最早的排队任务并标记为 running；无任务时返回 None。"""
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT id FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1"
+                ).fetchone()
+                if row is None:
+                    conn.execute("COMMIT")
+                    return None
+                conn.execute(
+                    "UPDATE jobs SET status = 'running', started_at = ? WHERE id = ?",
+                    (time.time(), row["id"]),
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return self.get(row["id"])
+
+    def finish(self, job_id: int, report_path: str, summary: dict):
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'done', finished_at = ?, report_path = ?, summary = ? "
+                "WHERE id = ?",
+                (time.time(), report_path, json.dumps(summary, ensure_ascii=False), job_id),
+            )
+
+    def fail(self, job_id: int, error: str):
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'failed', finished_at = ?, error = ? WHERE id = ?",
+                (time.time(), error, job_id),
+            )
+
+    def requeue_running(self) -> int:
+        """服务启动时将上次异常退出遗留的 running 任务重新排队。"""
+        with closing(self._connect()) as conn:
+            cur = conn.execute(
+                "UPDATE jobs SET status = 'queued', started_at = NULL WHERE status = 'running'"
+            )
+            return cur.rowcount
+
+    def get(self, job_id: int) -> dict | None:
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._row_to_dict(row)
+
+    def list(self, status: str | None = None, limit: int = 50) -> list[dict]:
+        with closing(self._connect()) as conn:
+            if status:
+                rows = conn.execute(
+                    "SELECT * FROM jobs WHERE status = ? ORDER BY id DESC LIMIT ?",
+                    (status, limit),
+                ).fetchall()
+            else:
+                rows = conn.execute(
+                    "SELECT * FROM jobs ORDER BY id DESC LIMIT ?", (limit,)
+                ).fetchall()
+        return [self._row_to_dict(r) for r in rows]
+
+    def counts(self) -> dict[str, int]:
+        with closing(self._connect()) as conn:
+            rows = conn.execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        return {r["status"]: r["n"] for r in rows}
+
+
+class WorkerPool:
+    """
+    固定数量的工作线程，从 JobQueue 领取任务并调用 review_cl 执行审查。
+    review_cl(cl_numbers, output_path) 返回写入任务记录的汇总 dict。
+    """
+
+    def __init__(
+        self,
+        queue: JobQueue,
+        review_cl: Callable[[list[str], str], dict],
+        report_dir: str,
+        workers: int,
+    ):
+        self.queue = queue
+        self.review_cl = review_cl
+        self.report_dir = report_dir
+        self.workers = max(1, workers)
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._threads: list[threading.Thread] = []
+
+    def start(self):
+        os.makedirs(self.report_dir, exist_ok=True)
+        for i in range(self.workers):
+            t = threading.Thread(target=self._run, name=f"review-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def notify(self):
+        """有新任务提交时唤醒空闲线程。"""
+        self._wakeup.set()
+
+    def stop(self, timeout: float | None = None):
+        self._stop.set()
+        self._wakeup.set()
+        for t in self._threads:
+            t.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            job = self.queue.claim()
+            if job is None:
+                self._wakeup.wait(_POLL_INTERVAL)
+                self._wakeup.clear()
+                continue
+            self._process(job)
+
+    def _process(self, job: dict):
+        job_id = job["id"]
+        cl_numbers = job["cl_numbers"]
+        report_path = os.path.join(
+            self.report_dir, f"Review_CL_{job['cl_key'].replace(',', '_')}_{job_id}.md"
+        )
+        logger.info("任务 #%d 开始: CL %s", job_id, job["cl_key"])
+        try:
+            summary = self.review_cl(cl_numbers, report_path)
+        except Exception as e:
+            error_msg = f"{type(e).__name__}: {e}"
+            logger.error("任务 #%d 失败: %s", job_id, error_msg)
+            self.queue.fail(job_id, error_msg)
+            return
+        self.queue.finish(job_id, report_path, summary)
+        logger.info("任务 #%d 完成: %s", job_id, report_path)
+
+
+# GET /jobs/<id>/report 依次尝试的报告格式及 Content-Type
+_REPORT_CONTENT_TYPES = {
+    "md": "text/markdown; charset=utf-8",
+    "json": "application/json; charset=utf-8",
+    "jsonl": "application/x-ndjson; charset=utf-8",
+}
+
+
+class _ServiceHandler(BaseHTTPRequestHandler):
+    """HTTP API 处理器。self.server 上挂载 queue / pool。"""
+
+    server_version = "P4-AI-Reviewer"
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+    def _send_json(self, status: int, obj):
+        body = json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error_json(self, status: int, message: str):
+        self._send_json(status, {"error": message})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = [p for p in url.path.split("/") if p]
+        queue: JobQueue = self.server.queue
+
+        if parts == ["health"]:
+            self._send_json(200, {"status": "ok", "jobs": queue.counts()})
+            return
+        if parts == ["jobs"]:
+            query = parse_qs(url.query)
+            status = query.get("status", [None])[0]
+            try:
+                limit = int(query.get("limit", ["50"])[0])
+            except ValueError:
+                self._send_error_json(400, "limit 必须为整数")
+                return
+            self._send_json(200, queue.list(status, limit))
+            return
+        if parts == ["reviews"]:
+            self._send_reviews(parse_qs(url.query))
+            return
+        if len(parts) in (2, 3) and parts[0] == "jobs" and parts[1].isdigit():
+            job = queue.get(int(parts[1]))
+            if job is None:
+                self._send_error_json(404, "任务不存在")
+                return
+            if len(parts) == 2:
+                self._send_json(200, job)
+                return
+            if parts[2] == "report":
+                self._send_report(job)
+                return
+        self._send_error_json(404, "未知路径")
+
+    def _send_reviews(self, query: dict[str, list[str]]):
+        store = get_default_store()
+        if store is None:
+            self._send_error_json(404, "未启用审查结果数据库 (REVIEW_STORE_PATH 为空)")
+            return
+
+        def arg(name: str, convert=str):
+            value = query.get(name, [None])[0]
+            return convert(value) if value not in (None, "") else None
+
+        try:
+            severity = arg("severity")
+            if severity is not None and severity not in SEVERITY_NAMES:
+                raise ValueError(f"未知 severity: {severity}")
+            rows = store.query(
+                path_prefix=arg("path"),
+                cl_min=arg("cl_min", int),
+                cl_max=arg("cl_max", int),
+                min_severity=SEVERITY_NAMES[severity] if severity else None,
+                since=arg("since", float),
+                until=arg("until", float),
+                limit=arg("limit", int) or 100,
+            )
+        except ValueError as e:
+            self._send_error_json(400, str(e))
+            return
+        self._send_json(200, [asdict(r) for r in rows])
+
+    def _send_report(self, job: dict):
+        if job["status"] != "done" or not job["report_path"]:
+            self._send_error_json(409, f"任务状态为 {job['status']}，报告尚未生成")
+            return
+        # report_path 为 Markdown 路径；REPORT_FORMATS 不含 md 时改为返回实际写出的格式
+        for fmt in _REPORT_CONTENT_TYPES:
+            path = report_path_for(job["report_path"], fmt)
+            if os.path.isfile(path):
+                break
+        else:
+            self._send_error_json(404, "报告文件不存在（已被删除，或 REPORT_FORMATS 未包含 md / json / jsonl）")
+            return
+        try:
+            with open(path, "rb") as f:
+                body = f.read()
+        except OSError as e:
+            self._send_error_json(410, f"报告文件不可读: {e}")
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", _REPORT_CONTENT_TYPES[fmt])
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path.rstrip("/") != "/jobs":
+            self._send_error_json(404, "未知路径")
+            return
+        try:
+            length = int(self.headers.get("Content-Length", "0"))
+            payload = json.loads(self.rfile.read(length) or b"{}")
+        except (ValueError, json.JSONDecodeError):
+            self._send_error_json(400, "请求体必须为 JSON")
+            return
+        if not isinstance(payload, dict):
+            self._send_error_json(400, "请求体必须为 JSON 对象，如 {\"cl\": \"12345\"}")
+            return
+
+        cl_numbers: list[str] = []
+        if isinstance(payload.get("cl"), (str, int)):
+            cl_numbers.append(str(payload["cl"]))
+        if isinstance(payload.get("cls"), list):
+            cl_numbers.extend(str(c) for c in payload["cls"])
+        try:
+            job, deduplicated = self.server.queue.submit(cl_numbers, bool(payload.get("force")))
+        except ValueError as e:
+            self._send_error_json(400, str(e))
+            return
+        if not deduplicated:
+            self.server.pool.notify()
+        self._send_json(202 if not deduplicated else 200, {**job, "deduplicated": deduplicated})
+
+
+def serve(
+    review_cl: Callable[[list[str], str], dict],
+    host: str,
+    port: int,
+    workers: int,
+    db_path: str,
+    report_dir: str,
+):
+    """启动服务并阻塞，直到 Ctrl-C。"""
+    queue = JobQueue(db_path)
+    requeued = queue.requeue_running()
+    if requeued:
+        logger.info("重新排队 %d 个上次未完成的任务", requeued)
+
+    pool = WorkerPool(queue, review_cl, report_dir, workers)
+    pool.start()
+
+    httpd = ThreadingHTTPServer((host, port), _ServiceHandler)
+    httpd.daemon_threads = True
+    httpd.queue = queue
+    httpd.pool = pool
+    logger.info("服务已启动: http://%s:%d (工作线程 %d, 队列 %s)", host, port, pool.workers, db_path)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("收到中断，正在停止服务 ...")
+    finally:
+        httpd.server_close()
+        pool.stop(timeout=5)
@@ -0,0 +1,259 @@
+"""
+P4-AI-Reviewer — 审查结果数据库
+将每个文件的 ReviewResult 写入带索引的 SQLite，支持按路径前缀、CL 范围、严重程度、日期检索。
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import closing
+from dataclasses import dataclass
+
+from ai_reviewer import ReviewResult
+from config import REVIEW_STORE_PATH
+from diff_parser import FileDiff
+from findings import count_by_severity
+
+logger = logging.getLogger(__name__)
+
+# 最高严重程度编码，便于按等级做范围查询
+SEVERITY_NONE = 0
+SEVERITY_SUGGESTION = 1
+SEVERITY_WARNING = 2
+SEVERITY_CRITICAL = 3
+
+SEVERITY_NAMES = {
+    "critical": SEVERITY_CRITICAL,
+    "warning": SEVERITY_WARNING,
+    "suggestion": SEVERITY_SUGGESTION,
+    "none": SEVERITY_NONE,
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS reviews (
+    id             INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id         TEXT NOT NULL,
+    created_at     REAL NOT NULL,
+    mode           TEXT NOT NULL,
+    cl_number      INTEGER,
+    depot_path     TEXT NOT NULL,
+    action         TEXT,
+    diff_hash      TEXT,
+    model          TEXT,
+    elapsed        REAL,
+    critical       INTEGER NOT NULL DEFAULT 0,
+    warning        INTEGER NOT NULL DEFAULT 0,
+    suggestion     INTEGER NOT NULL DEFAULT 0,
+    max_severity   INTEGER NOT NULL DEFAULT 0,
+    error          TEXT,
+    review_comment TEXT,
+    route          TEXT,
+    triage_elapsed REAL,
+    truncated      INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_reviews_path ON reviews(depot_path, created_at);
+CREATE INDEX IF NOT EXISTS idx_reviews_cl ON reviews(cl_number);
+CREATE INDEX IF NOT EXISTS idx_reviews_created ON reviews(created_at);
+CREATE INDEX IF NOT EXISTS idx_reviews_severity ON reviews(max_severity, created_at);
+CREATE INDEX IF NOT EXISTS idx_reviews_diff_hash ON reviews(diff_hash);
+"""
+
+# 旧版本数据库缺少的列：(列名, 类型)，打开时自动补齐
+_ADDED_COLUMNS = [
+    ("route", "TEXT"),
+    ("triage_elapsed", "REAL"),
+    ("truncated", "INTEGER NOT NULL DEFAULT 0"),
+]
+
+
+def count_severities(result: ReviewResult) -> tuple[int, int, int]:
+    """统计 🔴/🟡/🔵 问题数，返回 (严重, 警告, 建议)。"""
+    counts = count_by_severity(result.findings)
+    return counts["critical"], counts["warning"], counts["suggestion"]
+
+
+def diff_hash(diff_text: str) -> str:
+    return hashlib.sha1((diff_text or "").encode("utf-8", errors="replace")).hexdigest()
+
+
+def _prefix_upper_bound(prefix: str) -> str:
+    """返回字典序上界，使 depot_path >= prefix AND depot_path < bound 等价于前缀匹配且可走索引。"""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+@dataclass
+class StoredReview:
+    """查询结果行"""
+    id: int
+    created_at: float
+    mode: str
+    cl_number: int | None
+    depot_path: str
+    model: str
+    elapsed: float
+    critical: int
+    warning: int
+    suggestion: int
+    error: str
+    review_comment: str
+    route: str = ""
+    triage_elapsed: float = 0.0
+    truncated: bool = False     # 回答被截断，审查意见可能不完整
+
+
+class ReviewStore:
+    """审查结果库。每次操作使用独立连接，可被多线程共享。"""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        parent = os.path.dirname(db_path)
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+        self._lock = threading.Lock()
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            existing = {row["name"] for row in conn.execute("PRAGMA table_info(reviews)")}
+            for name, col_type in _ADDED_COLUMNS:
+                if name not in existing:
+                    conn.execute(f"ALTER TABLE reviews ADD COLUMN {name} {col_type}")
+            conn.commit()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def record_run(
+        self,
+        mode: str,
+        reviewed_files: list[FileDiff],
+        results: list[ReviewResult],
+    ) -> str:
+        """写入一次运行的全部结果（与 reviewed_files 一一对应），返回 run_id。"""
+        run_id = uuid.uuid4().hex
+        now = time.time()
+        rows = []
+        for fd, r in zip(reviewed_files, results):
+            critical, warning, suggestion = count_severities(r)
+            if critical:
+                max_severity = SEVERITY_CRITICAL
+            elif warning:
+                max_severity = SEVERITY_WARNING
+            elif suggestion:
+                max_severity = SEVERITY_SUGGESTION
+            else:
+                max_severity = SEVERITY_NONE
+            cl_number = int(fd.cl_number) if fd.cl_number.isdigit() else None
+            rows.append((
+                run_id, now, mode, cl_number, fd.depot_path, fd.action,
+                diff_hash(fd.diff_text), r.model, r.elapsed,
+                critical, warning, suggestion, max_severity,
+                r.error or None, r.review_comment,
+                r.route or None, r.triage_elapsed, int(r.truncated),
+            ))
+        with self._lock, closing(self._connect()) as conn, conn:
+            conn.executemany(
+                "INSERT INTO reviews (run_id, created_at, mode, cl_number, depot_path, action, "
+                "diff_hash, model, elapsed, critical, warning, suggestion, max_severity, "
+                "error, review_comment, route, triage_elapsed, truncated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+        logger.info("已记录 %d 条审查结果到 %s", len(rows), self.db_path)
+        return run_id
+
+    def query(
+        self,
+        *,
+        path_prefix: str | None = None,
+        cl_min: int | None = None,
+        cl_max: int | None = None,
+        min_severity: int | None = None,
+        since: float | None = None,
+        until: float | None = None,
+        limit: int = 100,
+    ) -> list[StoredReview]:
+        """
+        按条件检索，结果按时间倒序。
+        路径前缀使用范围比较以命中索引；min_severity 取 SEVERITY_* 常量。
+        """
+        where: list[str] = []
+        params: list = []
+        if path_prefix:
+            where.append("depot_path >= ? AND depot_path < ?")
+            params += [path_prefix, _prefix_upper_bound(path_prefix)]
+        if cl_min is not None:
+            where.append("cl_number >= ?")
+            params.append(cl_min)
+        if cl_max is not None:
+            where.append("cl_number <= ?")
+            params.append(cl_max)
+        if min_severity is not None:
+            where.append("max_severity >= ?")
+            params.append(min_severity)
+        if since is not None:
+            where.append("created_at >= ?")
+            params.append(since)
+        if until is not None:
+            where.append("created_at < ?")
+            params.append(until)
+
+        sql = ("SELECT id, created_at, mode, cl_number, depot_path, model, elapsed, "
+               "critical, warning, suggestion, error, review_comment, route, triage_elapsed, truncated "
+               "FROM reviews")
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY created_at DESC LIMIT ?"
+        params.append(limit)
+
+        with closing(self._connect()) as conn:
+            rows = conn.execute(sql, params).fetchall()
+        return [
+            StoredReview(
+                id=row["id"],
+                created_at=row["created_at"],
+                mode=row["mode"],
+                cl_number=row["cl_number"],
+                depot_path=row["depot_path"],
+                model=row["model"] or "",
+                elapsed=row["elapsed"] or 0.0,
+                critical=row["critical"],
+                warning=row["warning"],
+                suggestion=row["suggestion"],
+                error=row["error"] or "",
+                review_comment=row["review_comment"] or "",
+                route=row["route"] or "",
+                triage_elapsed=row["triage_elapsed"] or 0.0,
+                truncated=bool(row["truncated"]),
+            )
+            for row in rows
+        ]
+
+
+_default_store: ReviewStore | None = None
+_default_store_lock = threading.Lock()
+
+
+def get_default_store() -> ReviewStore | None:
+    """按 REVIEW_STORE_PATH 返回共享的 ReviewStore；配置为空时返回 None。"""
+    global _default_store
+    if not REVIEW_STORE_PATH:
+        return None
+    with _default_store_lock:
+        if _default_store is None:
+            _default_store = ReviewStore(REVIEW_STORE_PATH)
+    return _default_store
+
+
+def record_results(mode: str, reviewed_files: list[FileDiff], results: list[ReviewResult]):
+    """写入默认数据库；数据库不可用时只记录日志，不影响审查流程。"""
+    try:
+        store = get_default_store()
+        if store is not None and results:
+            store.record_run(mode, reviewed_files, results)
+    except sqlite3.Error as e:
+        logger.warning("写入审查结果数据库失败: %s", e)
@@ -0,0 +1,181 @@
+"""
+P4-AI-Reviewer — 分片审查与合并
+超大 CL（上千文件）可拆到多台 CI 节点并行审查：
+    1) 各节点以 --shard i/N 运行同一 CL，按确定性规则只审查属于自己的文件，写出分片结果 JSON；
+    2) merge 子命令收集全部分片，校验来自同一次输入且分片齐全后生成完整报告。
+分片规则只依赖文件列表本身（重复变更簇 → 按 Diff 大小贪心均衡，depot 路径稳定哈希定序），
+各节点独立计算即可得到一致的划分；同一重复簇总在同一分片内，不会被多个节点重复审查。
+"""
+import hashlib
+import json
+import logging
+import os
+from dataclasses import asdict
+
+from ai_reviewer import ReviewResult
+from diff_parser import FileDiff
+from diff_similarity import DuplicateGroup
+from findings import Finding
+
+logger = logging.getLogger(__name__)
+
+PARTIAL_VERSION = 1
+
+# 估算审查成本时每个文件的固定开销（Prompt 模板、全量文件内容等），按字符计
+_FILE_OVERHEAD_CHARS = 2000
+
+
+def parse_shard_spec(spec: str) -> tuple[int, int]:
+    """解析「i/N」（i 从 1 开始），非法时抛出 ValueError。"""
+    try:
+        index_str, count_str = spec.split("/", 1)
+        index, count = int(index_str), int(count_str)
+    except ValueError:
+        raise ValueError(f"无效的分片参数: {spec}（格式为 i/N，如 1/4）") from None
+    if count < 1 or not 1 <= index <= count:
+        raise ValueError(f"无效的分片参数: {spec}（要求 1 <= i <= N）")
+    return index, count
+
+
+def _stable_hash(fd: FileDiff) -> int:
+    key = f"{fd.cl_number}\0{fd.depot_path}".encode("utf-8")
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "big")
+
+
+def assign_shards(groups: list[DuplicateGroup], count: int) -> list[int]:
+    """
+    为每个重复簇分配分片号（0 ~ count-1）。
+    成本 = 代表文件 Diff 长度 + 固定开销（成员复用结果，不计成本）；
+    按成本降序（同成本按路径哈希）依次放入当前负载最小的分片（LPT 贪心）。
+    """
+    order = sorted(
+        range(len(groups)),
+        key=lambda i: (-(len(groups[i].representative.diff_text) + _FILE_OVERHEAD_CHARS),
+                       _stable_hash(groups[i].representative)),
+    )
+    loads = [0] * count
+    assignment = [0] * len(groups)
+    for i in order:
+        target = min(range(count), key=lambda s: (loads[s], s))
+        assignment[i] = target
+        loads[target] += len(groups[i].representative.diff_text) + _FILE_OVERHEAD_CHARS
+    return assignment
+
+
+def select_shard(groups: list[DuplicateGroup], index: int, count: int) -> list[DuplicateGroup]:
+    """返回第 index 片（从 1 开始）负责的重复簇，保持原顺序。"""
+    assignment = assign_shards(groups, count)
+    selected = [g for g, s in zip(groups, assignment) if s == index - 1]
+    logger.info("分片 %d/%d: 负责 %d / %d 组变更", index, count, len(selected), len(groups))
+    return selected
+
+
+def input_fingerprint(file_diffs: list[FileDiff]) -> str:
+    """输入文件列表指纹，用于 merge 时确认各分片审查的是同一批变更。"""
+    h = hashlib.sha1()
+    for fd in file_diffs:
+        h.update(f"{fd.cl_number}\0{fd.depot_path}\0{fd.action}\0".encode("utf-8"))
+        h.update(hashlib.sha1(fd.diff_text.encode("utf-8")).digest())
+    return h.hexdigest()
+
+
+def partial_path_for(output_path: str, index: int, count: int) -> str:
+    """由报告路径推导分片结果路径（Review_Report_x.md → Review_Report_x.shard-1-of-4.json）。"""
+    base, ext = os.path.splitext(output_path)
+    if ext.lower() != ".md":
+        base = output_path
+    return f"{base}.shard-{index}-of-{count}.json"
+
+
+def write_partial(
+    path: str,
+    mode: str,
+    cl_display: str | None,
+    file_diffs: list[FileDiff],
+    reviewed: list[FileDiff],
+    results: list[ReviewResult],
+    skipped_by_limit: list[FileDiff],
+    shard: tuple[int, int],
+) -> str:
+    """
+    写出分片结果。文件列表只记录元数据（按索引引用），Diff 正文只保存本分片审查的文件。
+    """
+    index_of = {id(fd): i for i, fd in enumerate(file_diffs)}
+    data = {
+        "version": PARTIAL_VERSION,
+        "mode": mode,
+        "cl": cl_display,
+        "shard": shard[0],
+        "shards": shard[1],
+        "fingerprint": input_fingerprint(file_diffs),
+        "files": [
+            {"depot_path": fd.depot_path, "local_path": fd.local_path, "action": fd.action,
+             "is_code_file": fd.is_code_file, "cl_number": fd.cl_number}
+            for fd in file_diffs
+        ],
+        "skipped_by_limit": [index_of[id(fd)] for fd in skipped_by_limit],
+        "reviewed": [
+            {"index": index_of[id(fd)], "diff_text": fd.diff_text, "result": asdict(result)}
+            for fd, result in zip(reviewed, results)
+        ],
+    }
+    parent = os.path.dirname(path)
+    if parent:
+        os.makedirs(parent, exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+    logger.info("分片结果已保存至: %s", path)
+    return path
+
+
+def _result_from_dict(data: dict) -> ReviewResult:
+    findings = [Finding(**f) for f in data.get("findings", [])]
+    return ReviewResult(**{**data, "findings": findings})
+
+
+def merge_partials(
+    paths: list[str],
+) -> tuple[str, str | None, list[FileDiff], list[FileDiff], list[ReviewResult], list[FileDiff]]:
+    """
+    合并分片结果。校验版本、输入指纹与分片完整性（缺片、重复、分片数不一致时抛出 ValueError）。
+    返回 (mode, cl_display, file_diffs, 审查的代码文件, 审查结果, 因限制未审查的文件)，
+    审查文件与结果按原始文件顺序排列，可直接传给 write_reports。
+    """
+    partials = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") != PARTIAL_VERSION:
+            raise ValueError(f"{path}: 不支持的分片结果版本 {data.get('version')}")
+        partials.append((path, data))
+    if not partials:
+        raise ValueError("没有分片结果文件")
+
+    first_path, first = partials[0]
+    count = first["shards"]
+    seen: dict[int, str] = {}
+    for path, data in partials:
+        if data["fingerprint"] != first["fingerprint"] or data["shards"] != count:
+            raise ValueError(f"{path} 与 {first_path} 不是同一次分片审查的结果")
+        if data["shard"] in seen:
+            raise ValueError(f"分片 {data['shard']}/{count} 重复: {seen[data['shard']]}, {path}")
+        seen[data["shard"]] = path
+    missing = [i for i in range(1, count + 1) if i not in seen]
+    if missing:
+        raise ValueError(f"缺少分片: {', '.join(f'{i}/{count}' for i in missing)}")
+
+    file_diffs = [FileDiff(diff_text="", **meta) for meta in first["files"]]
+    reviewed_by_index: dict[int, ReviewResult] = {}
+    for _path, data in partials:
+        for entry in data["reviewed"]:
+            file_diffs[entry["index"]].diff_text = entry["diff_text"]
+            reviewed_by_index[entry["index"]] = _result_from_dict(entry["result"])
+
+    order = sorted(reviewed_by_index)
+    reviewed = [file_diffs[i] for i in order]
+    results = [reviewed_by_index[i] for i in order]
+    skipped_by_limit = [file_diffs[i] for i in first["skipped_by_limit"]]
+    logger.info("已合并 %d 个分片: %d 个文件的审查结果", count, len(results))
+    return first["mode"], first["cl"], file_diffs, reviewed, results, skipped_by_limit
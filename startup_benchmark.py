@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+P4-AI-Reviewer — 启动耗时基准
+提交触发器每分钟多次调用本工具，且大多是无需审查的 CL，启动开销直接决定触发器延迟。
+本脚本对提前退出的调用路径计时（扣除解释器本身的启动时间），并用 `-X importtime`
+找出耗时最多的导入，同时检查这些路径上没有加载 httpx / asyncio / sqlite3 等重量级模块。
+
+用法:
+    python startup_benchmark.py                    # 默认预算 STARTUP_BUDGET_MS（80ms）
+    python startup_benchmark.py --runs 20 --budget-ms 30 --top 15
+
+超出预算或加载了禁止的模块时退出码为 1，可放入 CI。
+"""
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+ENTRY = os.path.join(ROOT, "p4_ai_reviewer.py")
+
+# 提前退出路径上不应加载的模块（加载即说明某处恢复了顶层导入）
+HEAVY_MODULES = ("httpx", "asyncio", "sqlite3", "ssl", "concurrent.futures", "review_store", "endpoint_pool")
+
+
+def _scenarios(tmp_dir: str) -> list[tuple[str, list[str], dict, tuple[str, ...]]]:
+    """返回 [(名称, 参数, 额外环境变量, 禁止加载的模块)]。"""
+    scenarios = [
+        ("help", [ENTRY, "--help"], {}, HEAVY_MODULES + ("config", "dotenv")),
+        ("invalid-args", [ENTRY, "not-a-target"], {}, HEAVY_MODULES + ("config", "dotenv")),
+    ]
+    # 空 CL：p4 describe 无输出（用 true 代替 p4），加载配置并启动一次 p4 子进程后退出（不导入解析器）
+    true_exe = shutil.which("true")
+    if true_exe:
+        scenarios.append((
+            "noop-cl",
+            [ENTRY, "12345", "-o", os.path.join(tmp_dir, "noop.md")],
+            {"P4_EXECUTABLE": true_exe, "AI_API_KEY": os.environ.get("AI_API_KEY") or "benchmark"},
+            HEAVY_MODULES + ("diff_parser",),
+        ))
+    return scenarios
+
+
+def _run(args: list[str], env: dict, runs: int) -> float:
+    """运行 runs 次，返回耗时中位数（毫秒）。"""
+    full_env = {**os.environ, **env}
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args, env=full_env, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL, check=False)
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def _import_times(args: list[str], env: dict) -> dict[str, tuple[int, int, int]]:
+    """用 -X importtime 运行一次，返回 {模块名: (自身 us, 累计 us, 缩进层级)}。"""
+    proc = subprocess.run([sys.executable, "-X", "importtime"] + args, env={**os.environ, **env},
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                          encoding="utf-8", errors="replace", check=False)
+    modules = {}
+    for line in proc.stderr.splitlines():
+        # 格式: "import time:   self [us] | cumulative |   imported package"，缩进表示嵌套层级
+        parts = line.split("|")
+        if not line.startswith("import time:") or len(parts) != 3:
+            continue
+        try:
+            self_us = int(parts[0].split(":", 1)[1])
+            cumulative_us = int(parts[1])
+        except ValueError:
+            continue  # 表头
+        raw_name = parts[2]
+        depth = (len(raw_name) - len(raw_name.lstrip()) - 1) // 2
+        modules[raw_name.strip()] = (self_us, cumulative_us, depth)
+    return modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description="P4-AI-Reviewer 启动耗时基准")
+    parser.add_argument("--runs", type=int, default=10, help="每个场景运行次数 (默认 10)")
+    parser.add_argument("--budget-ms", type=float,
+                        default=float(os.environ.get("STARTUP_BUDGET_MS", "80")),
+                        help="扣除解释器启动后的耗时预算，毫秒 (默认取 STARTUP_BUDGET_MS 或 80)")
+    parser.add_argument("--top", type=int, default=10, help="列出耗时最多的导入数 (默认 10)")
+    args = parser.parse_args()
+
+    baseline_ms = _run(["-c", "pass"], {}, args.runs)
+    baseline_modules = set(_import_times(["-c", "pass"], {}))
+    print(f"解释器基线 (python -c pass): {baseline_ms:.1f} ms\n")
+
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, scenario_args, env, forbidden in _scenarios(tmp_dir):
+            total_ms = _run(scenario_args, env, args.runs)
+            overhead_ms = max(0.0, total_ms - baseline_ms)
+            modules = _import_times(scenario_args, env)
+            ours = {m: t for m, t in modules.items() if m not in baseline_modules}
+            loaded_forbidden = [m for m in forbidden if m in ours]
+
+            status = "OK"
+            if overhead_ms > args.budget_ms or loaded_forbidden:
+                status = "FAIL"
+                failed = True
+            print(f"[{status}] {name}: {total_ms:.1f} ms (工具开销 {overhead_ms:.1f} ms / 预算 {args.budget_ms:.0f} ms)")
+            if loaded_forbidden:
+                print(f"       加载了不应加载的模块: {', '.join(loaded_forbidden)}")
+            top_level = sorted(((t[1], m) for m, t in ours.items() if t[2] <= 1), reverse=True)
+            for cumulative_us, module in top_level[:args.top]:
+                print(f"       {cumulative_us / 1000:7.1f} ms  {module}")
+            print()
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
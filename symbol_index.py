@@ -0,0 +1,451 @@
+"""
+P4-AI-Reviewer — 工作区符号索引
+模型只看得到当前文件，跨文件的类型、函数、宏、成员声明只能靠猜。
+本模块用正则做 ctags 式的声明提取，把工作区（或已同步的 depot 快照）的符号存入 SQLite：
+    - `index` 子命令按 mtime/size 增量更新，只重新解析变化的文件；
+    - 审查时取 Diff 增删行中出现的标识符，查出其在其他文件中的声明签名，
+      以 <related_declarations> 注入 Prompt，代替发送整个头文件。
+"""
+import logging
+import os
+import re
+import sqlite3
+import threading
+from contextlib import closing
+from dataclasses import dataclass
+
+from config import (
+    CODE_EXTENSIONS,
+    SYMBOL_INDEX_PATH,
+    SYMBOL_CONTEXT_MAX_CHARS,
+)
+from text_codec import read_text
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path  TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    size  INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS symbols (
+    name      TEXT NOT NULL,
+    kind      TEXT NOT NULL,
+    path      TEXT NOT NULL,
+    line      INTEGER NOT NULL,
+    signature TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_symbols_name ON symbols(name);
+CREATE INDEX IF NOT EXISTS idx_symbols_path ON symbols(path);
+"""
+
+# 不参与索引的目录（生成物、依赖、版本库元数据）
+_SKIP_DIRS = {
+    "Intermediate", "Binaries", "DerivedDataCache", "Saved", "node_modules",
+    "__pycache__", "obj", "bin", "build", "out",
+}
+# 超过该大小的文件视为生成代码，不索引
+_MAX_FILE_BYTES = 2 * 1024 * 1024
+# 每批写入的文件数
+_BATCH_FILES = 500
+_SIGNATURE_MAX_CHARS = 240
+# 同名声明超过该数量时视为过于泛化（如 Init / Get），不注入
+_MAX_DEFINITIONS_PER_NAME = 8
+# 每个标识符最多注入的声明数
+_MAX_SNIPPETS_PER_NAME = 3
+
+# 声明种类优先级（越小越优先注入）
+_KIND_ORDER = {"type": 0, "function": 1, "macro": 2, "alias": 3, "member": 4}
+_HEADER_EXTENSIONS = {".h", ".hpp", ".hxx", ".inl"}
+
+
+@dataclass
+class Symbol:
+    """一条声明"""
+    name: str
+    kind: str        # type / function / macro / alias / member
+    path: str
+    line: int
+    signature: str
+
+
+# ============================================================
+# 声明提取
+# ============================================================
+
+_C_LIKE_EXTENSIONS = {".cpp", ".cc", ".cxx", ".c", ".h", ".hpp", ".hxx", ".inl", ".cs", ".java"}
+
+_COMMENT_OR_STRING_RE = re.compile(
+    r'//[^\n]*|/\*.*?\*/|"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\'',
+    re.S,
+)
+
+_C_MODIFIERS = (r"(?:(?:public|private|protected|internal|static|sealed|abstract|partial|final|"
+                r"export|inline|unsafe|readonly|ref)\s+)*")
+_C_TYPE_RE = re.compile(
+    r"^(?:template\s*<.*>\s*)?" + _C_MODIFIERS +
+    r"(class|struct|union|enum(?:\s+class|\s+struct)?|interface)\s+"
+    r"(?:[A-Z][A-Z0-9_]*(?:\([^)]*\))?\s+)*"      # 导出宏，如 ENGINE_API / alignas(16)
+    r"([A-Za-z_]\w*)"
+)
+_C_NAMESPACE_RE = re.compile(r'^(?:namespace\b|extern\s*""\s*\{?\s*$)')
+_C_DEFINE_RE = re.compile(r"^#\s*define\s+([A-Za-z_]\w*)")
+_C_TYPEDEF_RE = re.compile(r"^typedef\b.*?\b([A-Za-z_]\w*)\s*(?:\[[^\]]*\]\s*)?;\s*$")
+_C_USING_RE = re.compile(r"^using\s+([A-Za-z_]\w*)\s*=")
+_C_FUNCTION_RE = re.compile(
+    r"^(?P<prefix>(?:[\w:<>,*&~\[\]]+\s*[\s*&]\s*)*)"
+    r"(?P<name>~?[A-Za-z_]\w*(?:::~?[A-Za-z_]\w*)*)\s*\("
+)
+_C_MEMBER_RE = re.compile(
+    r"^(?:[\w:<>,*&]+[\s*&]+)+\**([A-Za-z_]\w*)\s*(?:\[[^\]]*\]\s*)*(?:[:=][^;]*|\{[^}]*\})?;\s*$"
+)
+# 以这些词开头的行是语句而不是声明
+_STATEMENT_WORDS = {
+    "return", "if", "else", "while", "for", "foreach", "switch", "case", "do", "new", "delete",
+    "throw", "goto", "sizeof", "co_return", "co_await", "using", "typedef", "static_assert",
+    "friend", "break", "continue", "default", "operator",
+}
+
+
+def _strip_comments(text: str) -> str:
+    """去掉注释、清空字符串字面量内容（保留换行，行号不变）。"""
+    def repl(m: re.Match) -> str:
+        s = m.group(0)
+        if s.startswith("/"):
+            return "\n" * s.count("\n")
+        return s[0] * 2
+    return _COMMENT_OR_STRING_RE.sub(repl, text)
+
+
+def _signature(lines: list[str], start: int) -> str:
+    """从 start 行起拼接声明直到括号闭合（最多 4 行），去掉函数体。"""
+    parts: list[str] = []
+    depth = 0
+    for line in lines[start:start + 4]:
+        parts.append(line.strip())
+        depth += line.count("(") - line.count(")")
+        if depth <= 0 and "(" in " ".join(parts):
+            break
+    sig = " ".join(" ".join(parts).split())
+    sig = sig.split("{", 1)[0].rstrip().rstrip(";").rstrip()
+    return sig[:_SIGNATURE_MAX_CHARS]
+
+
+def _extract_c_like(text: str) -> list[tuple[str, str, int, str]]:
+    """
+    C/C++/C#/Java 声明提取。跟踪花括号作用域，只在命名空间/类型作用域内识别声明，
+    函数体内的局部变量与调用不会被误认。返回 [(name, kind, line, signature)]。
+    """
+    lines = _strip_comments(text).split("\n")
+    out: list[tuple[str, str, int, str]] = []
+    stack: list[str] = []          # "ns" / "type" / "block"
+    pending: str | None = None     # 下一个「{」打开的作用域类型
+    paren_depth = 0                # 跨行的未闭合括号（多行参数列表的续行不单独识别）
+
+    for idx, line in enumerate(lines):
+        stripped = line.strip()
+        if stripped and "block" not in stack and paren_depth == 0:
+            first_word = re.match(r"[\w#]*", stripped).group(0)
+            m = _C_TYPE_RE.match(stripped)
+            if m:
+                rest = stripped[m.end():]
+                head = rest.split("{", 1)[0]
+                # 排除前置声明「class Foo;」与变量声明「struct Foo x;」
+                is_decl = (";" not in head and not re.match(r"\s*[*&]?\s*[A-Za-z_]", rest)) \
+                    or re.match(r"\s*(?:final|extends|implements|where)\b", rest)
+                if is_decl:
+                    out.append((m.group(2), "type", idx + 1, _signature(lines, idx)))
+                    pending = "type"
+            elif _C_NAMESPACE_RE.match(stripped):
+                pending = "ns"
+            elif (m := _C_DEFINE_RE.match(stripped)):
+                out.append((m.group(1), "macro", idx + 1, stripped[:_SIGNATURE_MAX_CHARS]))
+            elif (m := _C_TYPEDEF_RE.match(stripped) or _C_USING_RE.match(stripped)):
+                out.append((m.group(1), "alias", idx + 1, stripped[:_SIGNATURE_MAX_CHARS]))
+            elif first_word not in _STATEMENT_WORDS and not stripped.startswith("#"):
+                m = _C_FUNCTION_RE.match(stripped)
+                if m:
+                    name = m.group("name").rsplit("::", 1)[-1]
+                    in_type = bool(stack) and stack[-1] == "type"
+                    # 无返回类型的只认类内构造/析构；全大写视为宏调用（如 GENERATED_BODY()）
+                    if (m.group("prefix").strip() or in_type) and not name.isupper() \
+                            and not name.startswith("~"):
+                        out.append((name, "function", idx + 1, _signature(lines, idx)))
+                elif stack and stack[-1] == "type":
+                    m = _C_MEMBER_RE.match(stripped)
+                    if m:
+                        out.append((m.group(1), "member", idx + 1, stripped[:_SIGNATURE_MAX_CHARS]))
+
+        for ch in line:
+            if ch == "(":
+                paren_depth += 1
+            elif ch == ")":
+                paren_depth = max(0, paren_depth - 1)
+            elif ch == "{":
+                stack.append(pending or "block")
+                pending = None
+            elif ch == "}":
+                if stack:
+                    stack.pop()
+            elif ch == ";":
+                pending = None
+    return out
+
+
+# 其他语言：按行匹配（name 取最后一个分组）
+_LINE_PATTERNS: dict[str, list[tuple[re.Pattern, str]]] = {
+    ".py": [
+        (re.compile(r"^\s*class\s+(\w+)"), "type"),
+        (re.compile(r"^\s*(?:async\s+)?def\s+(\w+)"), "function"),
+    ],
+    ".lua": [
+        (re.compile(r"^\s*(?:local\s+)?function\s+(?:[\w.]+[.:])?(\w+)\s*\("), "function"),
+        (re.compile(r"^\s*(?:local\s+)?(?:[\w.]+\.)?(\w+)\s*=\s*function\b"), "function"),
+    ],
+    ".go": [
+        (re.compile(r"^type\s+(\w+)"), "type"),
+        (re.compile(r"^func\s+(?:\([^)]*\)\s*)?(\w+)"), "function"),
+    ],
+    ".rs": [
+        (re.compile(r"^\s*(?:pub(?:\([^)]*\))?\s+)?(?:struct|enum|trait|type|union)\s+(\w+)"), "type"),
+        (re.compile(r"^\s*(?:pub(?:\([^)]*\))?\s+)?(?:(?:async|unsafe|const|extern\s+\"\w+\")\s+)*fn\s+(\w+)"),
+         "function"),
+        (re.compile(r"^\s*macro_rules!\s*(\w+)"), "macro"),
+    ],
+    ".js": [
+        (re.compile(r"^\s*(?:export\s+)?(?:default\s+)?class\s+(\w+)"), "type"),
+        (re.compile(r"^\s*(?:export\s+)?(?:default\s+)?(?:async\s+)?function\s*\*?\s*(\w+)"), "function"),
+    ],
+}
+_LINE_PATTERNS[".ts"] = _LINE_PATTERNS[".js"] + [
+    (re.compile(r"^\s*(?:export\s+)?(?:declare\s+)?(?:interface|type|enum)\s+(\w+)"), "type"),
+]
+
+
+def extract_symbols(path: str, text: str) -> list[tuple[str, str, int, str]]:
+    """按扩展名提取声明，返回 [(name, kind, line, signature)]；不支持的语言返回空列表。"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext in _C_LIKE_EXTENSIONS:
+        return _extract_c_like(text)
+    patterns = _LINE_PATTERNS.get(ext)
+    if not patterns:
+        return []
+    out = []
+    for idx, line in enumerate(text.split("\n")):
+        for pattern, kind in patterns:
+            m = pattern.match(line)
+            if m:
+                sig = " ".join(line.strip().split()).rstrip("{:").rstrip()
+                out.append((m.group(1), kind, idx + 1, sig[:_SIGNATURE_MAX_CHARS]))
+                break
+    return out
+
+
+# ============================================================
+# 索引存储
+# ============================================================
+
+def _normalize_path(path: str) -> str:
+    return os.path.abspath(path).replace("\\", "/")
+
+
+class SymbolIndex:
+    """符号索引库。每次操作使用独立连接，可被多线程共享。"""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        parent = os.path.dirname(db_path)
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+        self._lock = threading.Lock()
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            conn.commit()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def update(self, roots: list[str]) -> tuple[int, int, int]:
+        """
+        增量更新：遍历 roots 下的代码文件，mtime/size 变化的重新解析，已删除的移出索引。
+        返回 (扫描文件数, 重新解析数, 移除数)。
+        """
+        roots = [_normalize_path(r) for r in roots]
+        with closing(self._connect()) as conn:
+            known = {row["path"]: (row["mtime"], row["size"])
+                     for row in conn.execute("SELECT path, mtime, size FROM files")}
+
+        seen: set[str] = set()
+        changed: list[tuple[str, float, int]] = []
+        for root in roots:
+            for dirpath, dirnames, filenames in os.walk(root):
+                dirnames[:] = [d for d in dirnames if not d.startswith(".") and d not in _SKIP_DIRS]
+                for filename in filenames:
+                    if os.path.splitext(filename)[1].lower() not in CODE_EXTENSIONS:
+                        continue
+                    path = _normalize_path(os.path.join(dirpath, filename))
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    if st.st_size > _MAX_FILE_BYTES:
+                        continue
+                    seen.add(path)
+                    if known.get(path) != (st.st_mtime, st.st_size):
+                        changed.append((path, st.st_mtime, st.st_size))
+
+        removed = [p for p in known
+                   if p not in seen and any(p == r or p.startswith(r.rstrip("/") + "/") for r in roots)]
+
+        for start in range(0, len(changed), _BATCH_FILES):
+            batch = changed[start:start + _BATCH_FILES]
+            parsed = []
+            for path, mtime, size in batch:
+                try:
+                    text = read_text(path)
+                except (OSError, ValueError) as e:
+                    logger.debug("读取 %s 失败: %s", path, e)
+                    continue
+                parsed.append((path, mtime, size, extract_symbols(path, text)))
+            self._write_batch(parsed)
+            logger.info("符号索引: 已解析 %d / %d 个变化文件", min(start + _BATCH_FILES, len(changed)),
+                        len(changed))
+
+        if removed:
+            with self._lock, closing(self._connect()) as conn, conn:
+                conn.executemany("DELETE FROM symbols WHERE path = ?", [(p,) for p in removed])
+                conn.executemany("DELETE FROM files WHERE path = ?", [(p,) for p in removed])
+        return len(seen), len(changed), len(removed)
+
+    def _write_batch(self, parsed: list[tuple[str, float, int, list[tuple[str, str, int, str]]]]):
+        with self._lock, closing(self._connect()) as conn, conn:
+            for path, mtime, size, symbols in parsed:
+                conn.execute("DELETE FROM symbols WHERE path = ?", (path,))
+                conn.executemany(
+                    "INSERT INTO symbols (name, kind, path, line, signature) VALUES (?, ?, ?, ?, ?)",
+                    [(name, kind, path, line, sig) for name, kind, line, sig in symbols],
+                )
+                conn.execute(
+                    "INSERT INTO files (path, mtime, size) VALUES (?, ?, ?) "
+                    "ON CONFLICT(path) DO UPDATE SET mtime = excluded.mtime, size = excluded.size",
+                    (path, mtime, size),
+                )
+
+    def lookup(self, names: list[str], max_per_name: int = _MAX_DEFINITIONS_PER_NAME) -> dict[str, list[Symbol]]:
+        """
+        批量查询声明，返回 {name: [Symbol, ...]}。
+        同名声明超过 max_per_name 的名字视为过于泛化，不返回（先按索引计数，避免取回大量行）。
+        """
+        found: dict[str, list[Symbol]] = {}
+        with closing(self._connect()) as conn:
+            for start in range(0, len(names), 500):
+                chunk = names[start:start + 500]
+                placeholders = ", ".join("?" * len(chunk))
+                wanted = [row[0] for row in conn.execute(
+                    f"SELECT name FROM symbols WHERE name IN ({placeholders}) "
+                    f"GROUP BY name HAVING COUNT(*) <= ?",
+                    [*chunk, max_per_name],
+                )]
+                if not wanted:
+                    continue
+                rows = conn.execute(
+                    f"SELECT name, kind, path, line, signature FROM symbols "
+                    f"WHERE name IN ({', '.join('?' * len(wanted))})",
+                    wanted,
+                )
+                for row in rows:
+                    found.setdefault(row["name"], []).append(Symbol(
+                        row["name"], row["kind"], row["path"], row["line"], row["signature"]))
+        return found
+
+
+# ============================================================
+# Prompt 上下文
+# ============================================================
+
+_IDENT_RE = re.compile(r"\b[A-Za-z_]\w{2,}\b")
+
+
+def touched_identifiers(diff_text: str) -> list[str]:
+    """Diff 增删行中出现的标识符（按首次出现顺序去重，忽略注释）。"""
+    names: dict[str, None] = {}
+    for line in (diff_text or "").splitlines():
+        if not line or line[0] not in "+-" or line.startswith(("+++", "---")):
+            continue
+        code = _strip_comments(line[1:])
+        for m in _IDENT_RE.finditer(code):
+            names.setdefault(m.group(0), None)
+    return list(names)
+
+
+def _same_file(stored_path: str, depot_path: str) -> bool:
+    """索引中的本地路径与 depot 路径是否为同一文件（比较末两级路径）。"""
+    tail = "/".join(depot_path.replace("\\", "/").rstrip("/").split("/")[-2:])
+    return stored_path == tail or stored_path.endswith("/" + tail)
+
+
+def _short_path(path: str) -> str:
+    return "/".join(path.split("/")[-3:])
+
+
+def build_related_context(
+    index: SymbolIndex, depot_path: str, diff_text: str, max_chars: int
+) -> str:
+    """
+    为 Diff 中出现的标识符查找其他文件中的声明，按出现顺序、声明种类（类型 > 函数 > 宏 > 别名 > 成员）、
+    头文件优先排序，总长不超过 max_chars。无命中时返回空字符串。
+    """
+    names = touched_identifiers(diff_text)
+    if not names or max_chars <= 0:
+        return ""
+    found = index.lookup(names)
+
+    lines: list[str] = []
+    used = 0
+    for name in names:
+        symbols = [s for s in found.get(name, []) if not _same_file(s.path, depot_path)]
+        if not symbols:
+            continue
+        symbols.sort(key=lambda s: (_KIND_ORDER.get(s.kind, 9),
+                                    os.path.splitext(s.path)[1].lower() not in _HEADER_EXTENSIONS))
+        for s in symbols[:_MAX_SNIPPETS_PER_NAME]:
+            entry = f"// {_short_path(s.path)}:{s.line}\n{s.signature}"
+            if used + len(entry) + 1 > max_chars:
+                return "\n".join(lines)
+            lines.append(entry)
+            used += len(entry) + 1
+    return "\n".join(lines)
+
+
+_default_index: SymbolIndex | None = None
+_default_index_lock = threading.Lock()
+
+
+def get_default_index() -> SymbolIndex | None:
+    """按 SYMBOL_INDEX_PATH 打开的共享索引；未配置或索引文件尚未建立（未运行 index）时返回 None。"""
+    global _default_index
+    if not SYMBOL_INDEX_PATH or not os.path.exists(SYMBOL_INDEX_PATH):
+        return None
+    if _default_index is None:
+        with _default_index_lock:
+            if _default_index is None:
+                _default_index = SymbolIndex(SYMBOL_INDEX_PATH)
+    return _default_index
+
+
+def related_declarations(depot_path: str, diff_text: str) -> str:
+    """供审查 Prompt 使用的跨文件声明上下文；未启用或查询失败时返回空字符串。"""
+    if SYMBOL_CONTEXT_MAX_CHARS <= 0:
+        return ""
+    index = get_default_index()
+    if index is None:
+        return ""
+    try:
+        return build_related_context(index, depot_path, diff_text, SYMBOL_CONTEXT_MAX_CHARS)
+    except sqlite3.Error as e:
+        logger.warning("查询符号索引失败: %s", e)
+        return ""
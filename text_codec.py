@@ -0,0 +1,122 @@
+"""
+P4-AI-Reviewer — 源码编码识别与按需解码
+同一代码树中 UTF-8 与 GBK 文件混杂时，单一编码解码必然乱码一部分。这里按文件识别编码：
+BOM → UTF-8 严格校验（纯 ASCII 直接通过）→ SOURCE_ENCODING → GB18030，都失败才按
+SOURCE_ENCODING 替换解码。本地文件经 mmap 只取出并解码调用方需要的前缀（如 Prompt 的
+全量内容上限），生成的超大文件不会被整体读入和解码；识别出的编码按路径缓存，下次优先尝试。
+"""
+import codecs
+import logging
+import mmap
+import os
+import re
+import threading
+
+from config import SOURCE_ENCODING
+
+logger = logging.getLogger(__name__)
+
+# 有 BOM 时直接按 BOM 解码（utf-8-sig / utf-16 会去掉 BOM 本身）
+_BOMS = (
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+)
+
+# UTF-8 校验失败后依次尝试的编码（GB18030 是 GBK 的超集，兜底少见字符）
+_FALLBACKS = tuple(dict.fromkeys(("utf-8", SOURCE_ENCODING, "gb18030")))
+
+# 单个字符最多占用的字节数（UTF-8），按字符数截取前缀时据此估算需要映射的字节
+_MAX_BYTES_PER_CHAR = 4
+
+# p4 输出按文件分段识别编码（describe / diff2 的 "==== " 与 diff 的 "--- //" 文件头）
+_SECTION_RE = re.compile(rb"^(?===== |--- //)", re.MULTILINE)
+
+_CACHE_MAX = 50000
+_cache: dict[str, str] = {}
+_cache_lock = threading.Lock()
+
+
+def _decode_strict(data: bytes, encoding: str, final: bool) -> str | None:
+    """严格解码；final=False 时末尾不完整的多字节字符被丢弃（截取前缀时）。失败返回 None。"""
+    decoder = codecs.getincrementaldecoder(encoding)(errors="strict")
+    try:
+        return decoder.decode(data, final=final)
+    except UnicodeDecodeError:
+        return None
+
+
+def _remember(key: str | None, encoding: str):
+    if key is None:
+        return
+    with _cache_lock:
+        if len(_cache) >= _CACHE_MAX:
+            _cache.clear()
+        _cache[key] = encoding
+
+
+def cached_encoding(key: str) -> str | None:
+    """返回 key（路径）上次识别出的编码，未识别过时为 None。"""
+    with _cache_lock:
+        return _cache.get(key)
+
+
+def decode_bytes(data: bytes, key: str | None = None, final: bool = True) -> str:
+    """
+    识别编码并解码一段字节。key 为文件路径时使用并更新编码缓存（缓存只是优先尝试的提示，
+    文件改存为其他编码后会重新识别）。final=False 表示 data 只是文件前缀。
+    """
+    for bom, encoding in _BOMS:
+        if data.startswith(bom):
+            _remember(key, encoding)
+            return codecs.getincrementaldecoder(encoding)(errors="replace").decode(data, final=final)
+    if data.isascii():
+        return data.decode("ascii")
+
+    cached = cached_encoding(key) if key is not None else None
+    candidates = (cached,) + _FALLBACKS if cached else _FALLBACKS
+    for encoding in dict.fromkeys(candidates):
+        text = _decode_strict(data, encoding, final)
+        if text is not None:
+            if encoding != cached:
+                _remember(key, encoding)
+            return text
+    logger.debug("无法识别编码，按 %s 替换解码: %s", SOURCE_ENCODING, key or "(p4 输出)")
+    return codecs.getincrementaldecoder(SOURCE_ENCODING)(errors="replace").decode(data, final=final)
+
+
+def decode_output(data: bytes) -> str:
+    """
+    解码 p4 命令输出。整体是合法 UTF-8（含纯 ASCII）时直接返回；否则按文件分段各自识别，
+    混合编码的 describe 输出中每个文件都能正确解码。分段都在行首，不会切断多字节字符。
+    """
+    if data.isascii():
+        return data.decode("ascii")
+    text = _decode_strict(data, "utf-8", final=True)
+    if text is not None:
+        return text
+    return "".join(decode_bytes(section) for section in _SECTION_RE.split(data) if section)
+
+
+def decode_prefix(data: bytes, key: str | None = None, max_chars: int | None = None) -> str:
+    """只解码 data 中前 max_chars 个字符所需的部分（p4 print 输出等已在内存中的内容）。"""
+    if max_chars is None or len(data) <= max_chars:
+        return decode_bytes(data, key)
+    return decode_bytes(data[:max_chars * _MAX_BYTES_PER_CHAR], key, final=False)[:max_chars]
+
+
+def read_text(path: str, max_chars: int | None = None) -> str:
+    """
+    读取本地文本文件，自动识别编码。max_chars 非空时经 mmap 只取出并解码足够容纳
+    max_chars 个字符的前缀，返回不超过 max_chars 个字符。读取失败抛出 OSError。
+    """
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return ""
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if max_chars is None or size <= max_chars:
+                return decode_bytes(mm[:], path)
+            window = min(size, max_chars * _MAX_BYTES_PER_CHAR)
+            text = decode_bytes(mm[:window], path, final=window == size)
+    return text[:max_chars]
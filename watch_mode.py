@@ -0,0 +1,194 @@
+"""
+P4-AI-Reviewer — 本地监视模式
+轮询 `p4 opened` 与文件修改时间，去抖后仅对 Diff 发生变化的文件重新审查，
+并原地更新同一份报告。
+"""
+import hashlib
+import logging
+import os
+import time
+
+from ai_reviewer import ReviewResult, review_files_batch
+from diff_parser import FileDiff, parse_local_diff
+from p4_client import (
+    get_diff_local,
+    get_file_content_local,
+    get_opened_files,
+    where_local_paths,
+)
+from config import REPORT_FORMATS
+from report_generator import write_reports
+from review_store import record_results
+
+logger = logging.getLogger(__name__)
+
+
+def _diff_hash(diff_text: str) -> str:
+    return hashlib.sha1(diff_text.encode("utf-8", errors="replace")).hexdigest()
+
+
+class LocalWatcher:
+    """
+    监视状态：
+        _local_paths: depot → 本地路径（p4 where 结果缓存）
+        _signatures:  depot → (mtime_ns, size)，用于发现保存动作
+        _diffs:       depot → 最近一次解析出的 FileDiff
+        _hashes:      depot → 最近一次已审查 Diff 的摘要
+        _results:     depot → 最近一次审查结果
+    """
+
+    def __init__(
+        self,
+        output_path: str,
+        interval: float,
+        debounce: float,
+        formats: list[str] | None = None,
+        include_diff: bool | None = None,
+    ):
+        self.output_path = output_path
+        self.formats = formats or REPORT_FORMATS
+        self.include_diff = include_diff
+        self.interval = interval
+        self.debounce = debounce
+        self._local_paths: dict[str, str] = {}
+        self._signatures: dict[str, tuple[int, int] | None] = {}
+        self._diffs: dict[str, FileDiff] = {}
+        self._hashes: dict[str, str] = {}
+        self._results: dict[str, ReviewResult] = {}
+        self._pending: set[str] = set()
+        self._last_change = 0.0
+
+    def _stat(self, depot_path: str) -> tuple[int, int] | None:
+        local_path = self._local_paths.get(depot_path)
+        if not local_path:
+            return None
+        try:
+            st = os.stat(local_path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _scan(self) -> set[str]:
+        """比较 opened 列表与文件签名，返回发生变化的 depot 路径集合。p4 opened 失败时本轮不做判断。"""
+        opened_files = get_opened_files()
+        if opened_files is None:
+            # 不能当作「全部已 revert」，否则会清空状态并在下一轮把所有文件重新审查一遍
+            return set()
+        opened = set(opened_files)
+        known = set(self._signatures)
+
+        new_paths = sorted(opened - known)
+        if new_paths:
+            self._local_paths.update(where_local_paths(new_paths))
+
+        changed = set(known - opened)  # 已 revert / submit 的文件
+        for depot_path in known - opened:
+            self._signatures.pop(depot_path, None)
+            self._local_paths.pop(depot_path, None)
+
+        for depot_path in opened:
+            sig = self._stat(depot_path)
+            if depot_path not in self._signatures or self._signatures[depot_path] != sig:
+                self._signatures[depot_path] = sig
+                changed.add(depot_path)
+        return changed
+
+    def _review_pass(self, paths: set[str]):
+        """对 paths 重新 diff，仅审查 Diff 摘要变化的代码文件，然后重写报告。"""
+        before = set(self._diffs)
+        still_opened = sorted(p for p in paths if p in self._signatures)
+        for depot_path in paths - set(still_opened):
+            self._forget(depot_path)
+
+        new_diffs: dict[str, FileDiff] = {}
+        if still_opened:
+            raw_diff = get_diff_local(still_opened)
+            for fd in parse_local_diff(raw_diff):
+                new_diffs[fd.depot_path] = fd
+
+        to_review: list[FileDiff] = []
+        for depot_path in still_opened:
+            fd = new_diffs.get(depot_path)
+            if fd is None or not fd.diff_text:
+                # 已无差异（例如改动被撤销）
+                self._forget(depot_path)
+                continue
+            self._diffs[depot_path] = fd
+            digest = _diff_hash(fd.diff_text)
+            if fd.is_code_file and self._hashes.get(depot_path) != digest:
+                to_review.append(fd)
+                self._hashes[depot_path] = digest
+
+        if to_review:
+            logger.info("监视模式: %d 个文件 Diff 有变化，重新审查", len(to_review))
+            file_data = [
+                (fd.depot_path, fd.diff_text, get_file_content_local(fd.local_path or fd.depot_path))
+                for fd in to_review
+            ]
+            results = review_files_batch(file_data)
+            record_results("local", to_review, results)
+            for fd, result in zip(to_review, results):
+                self._results[fd.depot_path] = result
+                if result.error:
+                    # 失败的文件下一轮变化时允许重试
+                    self._hashes.pop(fd.depot_path, None)
+
+        if not to_review and set(self._diffs) == before:
+            logger.debug("监视模式: 保存后 Diff 无变化，保持报告不变")
+            return
+        report_paths = self._write_report()
+        print(f"[{time.strftime('%H:%M:%S')}] 审查 {len(to_review)} 个文件，"
+              f"当前 {len(self._diffs)} 个修改文件，报告已更新: "
+              f"{', '.join(os.path.abspath(p) for p in report_paths)}")
+
+    def _forget(self, depot_path: str):
+        self._diffs.pop(depot_path, None)
+        self._hashes.pop(depot_path, None)
+        self._results.pop(depot_path, None)
+
+    def _write_report(self) -> list[str]:
+        file_diffs = [self._diffs[p] for p in sorted(self._diffs)]
+        code_files = [fd for fd in file_diffs if fd.is_code_file and fd.depot_path in self._results]
+        results = [self._results[fd.depot_path] for fd in code_files]
+        return write_reports(
+            self.formats, "local", None, file_diffs, results, self.output_path,
+            reviewed_code_files=code_files,
+            include_diff=self.include_diff,
+        )
+
+    def _poll(self):
+        """一轮轮询：记录变化，去抖时间已过则重新审查待处理的文件。"""
+        changed = self._scan()
+        now = time.monotonic()
+        if changed:
+            self._pending |= changed
+            self._last_change = now
+        if self._pending and now - self._last_change >= self.debounce:
+            paths, self._pending = self._pending, set()
+            try:
+                self._review_pass(paths)
+            except Exception:
+                # 本轮没审完：放回待处理集合并清掉摘要，下一轮重新 diff 与审查
+                self._pending |= paths
+                for depot_path in paths:
+                    self._hashes.pop(depot_path, None)
+                raise
+
+    def run(self):
+        """阻塞运行，Ctrl-C 退出。"""
+        print(f"👀 监视本地修改中（轮询 {self.interval}s，去抖 {self.debounce}s），Ctrl-C 退出 ...")
+        try:
+            while True:
+                try:
+                    self._poll()
+                except Exception as e:
+                    # 单轮 p4 / 审查失败不结束监视，下一轮继续
+                    logger.error("监视模式本轮失败，将在下一轮重试: %s", e)
+                time.sleep(self.interval)
+        except KeyboardInterrupt:
+            print("\n已停止监视。")
+
+
+def watch_local(output_path: str, interval: float, debounce: float, **report_options):
+    """local --watch 入口。report_options 同 LocalWatcher 的 formats / include_diff。"""
+    LocalWatcher(output_path, interval, debounce, **report_options).run()